@@ -6,7 +6,6 @@ http://gamma-astro-data-formats.readthedocs.io/en/latest/skymaps/healpix/index.h
 """
 import os, glob, StringIO, pickle
 import healpy
-from collections import Counter 
 import numpy as np
 from astropy.io import fits
 import pandas as pd
@@ -129,10 +128,41 @@ class BandList(object):
         df.nside = df.nside.astype(int)
         return df
     
+def merge_keys(keys, counts):
+    """ combine counts with the same key
+    keys : array of int64
+    counts : array of int
+    returns sorted unique keys, and the sum of the counts for each
+    """
+    if len(keys)==0: return keys, counts
+    order = np.argsort(keys, kind='mergesort')
+    keys, counts = keys[order], counts[order]
+    start = np.flatnonzero(np.concatenate([[True], keys[1:]!=keys[:-1]]))
+    return keys[start], np.add.reduceat(counts, start)
+
+def fill_band(band, pix, cnt):
+    """ add the pixels to a skymaps.Band object
+    pix, cnt : arrays of pixel index and count
+    The arrays are converted to lists of python ints in one step, and the C++ add method applied 
+    by map, avoiding the per-pixel conversions of numpy scalars in a python loop
+    """
+    if len(pix)==0: return band
+    list(map(band.add, np.asarray(pix).tolist(), np.asarray(cnt).tolist()))
+    return band
+
 class Pixels(object):
     """The list of pixels
     Each line is a pixel, with a HEALPix index, a channel index, and the number of photons in the pixel 
     """
+    skymap_keywords = dict(
+            PIXTYPE='HEALPIX',
+            INDXSCHM='SPARSE',
+            ORDERING='RING',
+            COORDSYS='GAL',
+            BANDSHDU='BANDS',
+            AXCOLS='E_MIN,E_MAX',
+            )
+
     def __init__(self, pixel_hdu, pixel_count=None):
         """pixel_hdu : HDU 
            pixel_count : array of int | None
@@ -156,39 +186,37 @@ class Pixels(object):
             self.pix = pixeldata.field('PIX')     # pixel index (depends on channel)
             self.cnt = pixeldata.field('VALUE')   # number of photons in bin
         
-        self.counter = None
+        self._pending = []
         self._sorted = False
 
-    def _make_counter(self):
-        # Make a Counter, with keys combined from channel and pixel id
-        if self.counter is None:
-            chn = np.array(self.chn,int) # convert to int for shift
-            keys = list(np.left_shift(chn,32) + self.pix)
-            self.counter = Counter(dict(zip(keys, self.cnt)))
-        return self.counter
+    def keys(self):
+        """ return array of int64 keys combining channel and pixel index"""
+        return np.left_shift(np.asarray(self.chn, np.int64), 32) + np.asarray(self.pix, np.int64)
  
     def add(self, other):
         """combine the current list of pixels with another
         other : Pixels object
+        The merge is deferred until the pixel arrays are needed, so that adding a set of files
+        requires a single sort.
         """
-        # combine the pixels by updating the Counter dictionary-like objects
-        self._make_counter() # create local Counter only if adding another
-        self.counter.update(other._make_counter())
+        other._merge()
+        self._pending.append((other.keys(), np.asarray(other.cnt)))
+        self._sorted = False
     
-    def _decode_counter(self):
-        # Update the three arrays following adding another set of data
-        assert self.counter is not None, 'logic failure'
-        items = np.array(self.counter.items(), int)
-        keys = items[:,0]
+    def _merge(self):
+        # Update the three arrays following adding other sets of data
+        if len(self._pending)==0: return
+        keys = np.concatenate([self.keys()]+[k for k,c in self._pending])
+        cnt  = np.concatenate([np.asarray(self.cnt)]+[c for k,c in self._pending])
+        self._pending = []
+        keys, self.cnt = merge_keys(keys, cnt)
         self.chn = np.right_shift(keys,32)
         self.pix = np.bitwise_and(keys, 2**32-1)
-        self.cnt = items[:,1]
 
     def dataframe(self):
         """return a DataFrame with number of pixels and photons per channel
         """
-        if self.counter is not None:
-            self._decode_counter()
+        self._merge()
         channels = sorted(list(set(self.chn))); 
         d = dict()
         for channel in channels:
@@ -201,9 +229,13 @@ class Pixels(object):
     def __getitem__(self, channel):
         """return a list of (pixel, count) pairs for the band 
         """
+        return zip(*self.arrays(channel))
+
+    def arrays(self, channel):
+        """return a tuple of arrays (pixel, count) for the band; views into the sorted arrays
+        """
         if not self._sorted:
-            if self.counter is not None:
-                self._decode_counter()
+            self._merge()
             # sort the list of pixels according to channel number (band)
             # create a lookup dictionary with limits for the pixel and count lists
             csort = self.chn.argsort()
@@ -216,38 +248,27 @@ class Pixels(object):
             self._sorted = True
         try:
             a,b = self.lookup[channel]
-            return zip(self.pix[a:b], self.cnt[a:b])
         except KeyError:
-            return [] # empty list of no entry
+            a=b=0 # empty arrays if no entry
+        return self.pix[a:b], self.cnt[a:b]
 
     def make_hdu(self):
         """ create a new HDU in new format
             
         """
-        if self.counter is not None:
-            # needed it result of combining
-            self._decode_counter()
+        self._merge() # needed if result of combining
         skymap_cols = [
             fits.Column(name='PIX', format='J',    array=self.pix),
             fits.Column(name='CHANNEL', format='I',array=self.chn),
             fits.Column(name='VALUE', format='J',  array=self.cnt),
         ]
         skymap_hdu=fits.BinTableHDU.from_columns(skymap_cols, name='SKYMAP')
-        skymap_hdu.header.update(
-            PIXTYPE='HEALPIX',
-            INDXSCHM='SPARSE',
-            ORDERING='RING',
-            COORDSYS='GAL',
-            BANDSHDU='BANDS',
-            AXCOLS='E_MIN,E_MAX',
-            )
+        skymap_hdu.header.update(self.skymap_keywords)
         return skymap_hdu
     
     def __repr__(self):
-        if self.counter is not None:
-            npix, nphot = len(self.counter), sum(self.counter.values())
-        else:
-            npix, nphot = len(self.cnt), sum(self.cnt)
+        self._merge()
+        npix, nphot = len(self.cnt), np.sum(self.cnt)
         return '{}: {:,} pixels, {:,} photons'.format(self.__class__, npix, nphot) 
 
 
@@ -288,6 +309,7 @@ class BinFile(object):
         if not adding: 
             if not quiet: print ()
 
+        self.roi_mask = None
         if outfile is not None:
             self.writeto(outfile)
 
@@ -310,11 +332,34 @@ class BinFile(object):
         from skymaps import Band
         b = self.bands[index]
         bb = Band(int(b.nside), int(b.event_type), b.e_min, b.e_max, 0,0)
-        # this is an unfortunate loop: need to consider an interface for adding a set of pixels
-        for pix, cnt in self.pixels[index]:
-            bb.add(int(pix), int(cnt))
+        pix, cnt = self.pixels.arrays(index)
+        if self.roi_mask is not None:
+            sel = np.isin(pix, self.roi_pixels(int(b.nside)), assume_unique=True)
+            pix, cnt = pix[sel], cnt[sel]
+        fill_band(bb, pix, cnt)
         return bb
 
+    def select_rois(self, roi_list, radius=5):
+        """ restrict the pixels returned by __getitem__ to those within radius (deg) of the centers
+        of the nside=12 ROIs in roi_list. If roi_list is None, use all pixels
+        """
+        if roi_list is None:
+            self.roi_mask = None
+            return
+        self.roi_mask = [roi_circle(int(i), radius=radius) for i in roi_list]
+        self._roi_pixels = dict()
+
+    def roi_pixels(self, nside):
+        """ return the sorted array of pixels with the given nside in the ROI mask
+        The pixel size is added to the radius to include all pixels that may be queried.
+        """
+        if nside not in self._roi_pixels:
+            margin = np.degrees(healpy.nside2resol(nside))
+            pix = [healpy.query_disc(nside, healpy.dir2vec(l,b,lonlat=True), np.radians(r+margin), inclusive=True)
+                    for l,b,r in self.roi_mask]
+            self._roi_pixels[nside] = np.unique(np.concatenate(pix))
+        return self._roi_pixels[nside]
+
     def __len__(self): return len(self.bands.bands)
 
     def add(self, other):
@@ -661,10 +706,75 @@ def run_binner(monthly_ft1_files='/afs/slac/g/glast/groups/catalog/P8_P305/zmax1
         bdt.create_fits(outfile)
         print ('\twrote {}'.format(outfile))
 
+def combine_files(filenames, outfile, overwrite=True, quiet=False):
+    """Combine a set of binned files in the new format, writing directly to outfile
+    
+    The pixels are merged one channel at a time, so the memory needed is set by the largest channel
+    of all the files, not by the total number of pixels. The BANDS and GTI tables are written first, 
+    then the SKYMAP table is streamed to the end of the file, channel by channel. 
+    Its row count is set in the header when done.
+    """
+    filenames = [os.path.expandvars(f) for f in filenames]
+    if os.path.exists(outfile) and not overwrite:
+        raise Exception('File {} exists'.format(outfile))
+    hdus = [fits.open(f, memmap=True) for f in filenames]
+    for f,h in zip(filenames,hdus):
+        assert 'SKYMAP' in h, 'File {} not in new format'.format(f)
+    gti = GTI(hdus[0]['GTI'])
+    for h in hdus[1:]:
+        gti.add(GTI(h['GTI']))
+    bands = BandList(hdus[0]['BANDS'])
+    fits.HDUList([hdus[0][0], bands.make_hdu(), gti.make_hdu()]).writeto(outfile, overwrite=True)
+    
+    # template for the SKYMAP header, same columns as Pixels.make_hdu
+    cols = [fits.Column(name='PIX', format='J', array=np.zeros(0,np.int32)),
+            fits.Column(name='CHANNEL', format='I', array=np.zeros(0,np.int16)),
+            fits.Column(name='VALUE', format='J', array=np.zeros(0,np.int32)),]
+    skymap_hdu = fits.BinTableHDU.from_columns(cols, name='SKYMAP')
+    skymap_hdu.header.update(Pixels.skymap_keywords)
+    header = skymap_hdu.header
+    row = np.dtype([('PIX','>i4'), ('CHANNEL','>i2'), ('VALUE','>i4')])
+    
+    chn = [np.asarray(h['SKYMAP'].data.field('CHANNEL')) for h in hdus]
+    channels = np.unique(np.concatenate([np.unique(c) for c in chn]))
+    nrows = nphot = 0
+    with open(outfile, 'r+b') as out:
+        out.seek(0, 2)
+        header_pos = out.tell()
+        out.write(header.tostring().encode())
+        for channel in channels:
+            pix = []; cnt = []
+            for h,c in zip(hdus, chn):
+                sel = np.flatnonzero(c==channel)
+                if len(sel)==0: continue
+                data = h['SKYMAP'].data
+                pix.append(np.asarray(data.field('PIX')[sel], np.int64))
+                cnt.append(np.asarray(data.field('VALUE')[sel], np.int64))
+            keys, counts = merge_keys(np.concatenate(pix), np.concatenate(cnt))
+            rows = np.empty(len(keys), row)
+            rows['PIX'] = keys; rows['CHANNEL']=channel; rows['VALUE']=counts
+            out.write(rows.tobytes())
+            nrows += len(rows); nphot += counts.sum()
+            if not quiet:
+                print ('channel {:2d}: {:10,} pixels {:12,} photons'.format(channel, len(rows), counts.sum()))
+        # pad the data, then rewrite the header (same length) with the number of rows
+        nbytes = nrows*row.itemsize
+        out.write(b'\0'*((2880-nbytes%2880)%2880))
+        header['NAXIS2'] = nrows
+        out.seek(header_pos)
+        out.write(header.tostring().encode())
+    for h in hdus: h.close()
+    if not quiet:
+        print ('wrote file {}: {:,} pixels, {:,} photons'.format(outfile, nrows, nphot))
+
 def combine_monthly(
         infolder='$FERMI/data/P8_P305/monthly',
         outfolder='$FERMI/data/P8_P305/yearly',
-        overwrite=False, test=False):
+        overwrite=False, test=False, streaming=False):
+    """ combine monthly files into yearly files
+    streaming : bool
+        if True, use combine_files to write each output file with bounded memory
+    """
     infolder = os.path.expandvars(infolder)
     months = sorted(glob.glob(os.path.join(infolder, '*.fits'))) 
     assert len(months)>0, 'No files found at {}'.format(infolder)
@@ -677,12 +787,15 @@ def combine_monthly(
         print ('created {}'.format(outfolder))
     os.chdir(outfolder) 
     
-    for year in range((len(months)+1)/12):
-        t = BinFile(months[12*year])
+    for year in range((len(months)+1)//12):
         outfile = 'P305_Source_year{:02d}_zmax100_4bpd.fits'.format(year+1)
         if not overwrite and os.path.exists(outfile):
             print ('File {} exists'.format(outfile))
             continue
+        if streaming and not test:
+            combine_files(months[12*year:12*year+12], outfile)
+            continue
+        t = BinFile(months[12*year])
         for m in months[12*year+1:12*year+12]:
             t.add(BinFile(m))
         if not test:
@@ -696,7 +809,12 @@ def combine_yearly(
         outfilename='{}years_zmax100_4bpd_v2.fits',
         nyears=10,
         overwrite=False, 
-        test=False):
+        test=False,
+        streaming=False):
+    """ combine yearly files 
+    streaming : bool
+        if True, use combine_files to write the output with bounded memory; return None
+    """
     infolder = os.path.expandvars(infolder)
     years = sorted(glob.glob(os.path.join(infolder, '*.fits'))) 
     assert len(years)>0, 'No files found at {}'.format(infolder)
@@ -705,6 +823,9 @@ def combine_yearly(
     
     outfolder=os.path.expandvars(outfolder)
     os.chdir(outfolder) 
+    if streaming and not test:
+        combine_files(years[:nyears], outfilename.format(nyears), overwrite=overwrite)
+        return
     print ('loading {}'.format(os.path.split(years[0])[-1]))
     t = BinFile(years[0])
     for year in years[1:nyears]:
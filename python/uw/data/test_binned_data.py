@@ -0,0 +1,59 @@
+"""
+Tests of the sparse pixel merge: run with python -m unittest uw.data.test_binned_data
+"""
+import unittest
+from collections import Counter
+import numpy as np
+from astropy.io import fits
+from uw.data import binned_data
+
+def skymap_hdu(chn, pix, cnt):
+    return fits.BinTableHDU.from_columns([
+            fits.Column(name='PIX', format='J', array=pix),
+            fits.Column(name='CHANNEL', format='I', array=chn),
+            fits.Column(name='VALUE', format='J', array=cnt),
+        ], name='SKYMAP')
+
+def random_pixels(rng, n, nchan=4, npix=50):
+    return rng.randint(0, nchan, n), rng.randint(0, npix, n), rng.randint(1, 10, n)
+
+
+class TestMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(2)
+
+    def test_merge_keys(self):
+        """ same as summing with a Counter, as before """
+        keys = self.rng.randint(0, 100, 1000).astype(np.int64)
+        counts = self.rng.randint(1, 10, 1000)
+        expect = Counter()
+        for k, c in zip(keys, counts): expect[k] += c
+        ukeys, ucounts = binned_data.merge_keys(keys, counts)
+        self.assertEqual(list(ukeys), sorted(expect.keys()))
+        self.assertEqual(list(ucounts), [expect[k] for k in ukeys])
+        k0, c0 = binned_data.merge_keys(np.zeros(0, np.int64), np.zeros(0, int))
+        self.assertEqual(len(k0), 0)
+
+    def test_pixels_add(self):
+        """ adding Pixels objects combines the counts of the same channel and pixel """
+        sets = []
+        for i in range(3):
+            # each input has unique (channel, pixel) entries, as in a file
+            chn, pix, cnt = random_pixels(self.rng, 200)
+            keys = sorted(set(zip(chn, pix)))
+            sets.append((np.array([k[0] for k in keys]), np.array([k[1] for k in keys]),
+                    self.rng.randint(1, 10, len(keys))))
+        expect = Counter()
+        for chn, pix, cnt in sets:
+            for k in zip(chn, pix, cnt): expect[k[:2]] += k[2]
+        pixels = binned_data.Pixels(skymap_hdu(*sets[0]))
+        for s in sets[1:]:
+            pixels.add(binned_data.Pixels(skymap_hdu(*s)))
+        pixels._merge()
+        result = dict(((c, p), n) for c, p, n in zip(pixels.chn, pixels.pix, pixels.cnt))
+        self.assertEqual(result, dict(expect))
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Tests of the PhotonStore: run with python -m unittest uw.data.test_timed_data
+"""
+import os, shutil, pickle, tempfile, unittest
+import healpy
+import numpy as np
+import pandas as pd
+from uw.data import timed_data
+
+nside = 64
+
+def time_record(rng, n, tstart, l=30, b=20, size=10):
+    """ a record like ConvertFT1.time_record for n photons near (l,b), with distinct times """
+    hpindex = healpy.ang2pix(nside, l+rng.uniform(-size, size, n), b+rng.uniform(-size, size, n),
+        nest=False, lonlat=True).astype(np.int32)
+    return dict(tstart=tstart, timerec=np.rec.fromarrays([
+            rng.randint(0, 16, n).astype(np.int8), hpindex, rng.permutation(n).astype(np.float32)],
+        names='band hpindex time'.split()))
+
+def time_info(records):
+    """ TimeInfo for the combined records, as if read from a single file """
+    ti = timed_data.TimeInfo.__new__(timed_data.TimeInfo)
+    ti.tstart = 0
+    ti.df = pd.DataFrame(np.rec.fromarrays([
+            np.concatenate([r['timerec'].band for r in records]),
+            np.concatenate([r['timerec'].hpindex for r in records]),
+            np.concatenate([r['timerec'].time.astype(float)+r['tstart'] for r in records])],
+        names='band hpindex time'.split()))
+    return ti
+
+
+class TestPhotonStore(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.RandomState(4)
+        self.records = [time_record(rng, 5000, tstart=1e6*(i+1)) for i in range(3)]
+        self.store = timed_data.PhotonStore(os.path.join(self.folder, 'store'), nside=nside)
+        for i, rec in enumerate(self.records):
+            self.assertTrue(self.store.add(rec, source='month_{}'.format(i)))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def check_select(self, store, records):
+        """ the same photons as TimeInfo.select, sorted by time """
+        expect = time_info(records).select(30, 20, radius=5, nside=nside).sort_values('time')
+        df = store.select(30, 20, radius=5)
+        self.assertGreater(len(df), 0)
+        self.assertTrue(np.all(np.diff(df.time)>=0))
+        for col in ('band', 'time', 'delta'):
+            self.assertTrue(np.all(df[col].values==expect[col].values), col)
+
+    def test_select(self):
+        self.assertEqual(len(self.store), 15000)
+        self.check_select(self.store, self.records)
+
+    def test_add_existing(self):
+        self.assertFalse(self.store.add(self.records[0], source='month_0'))
+        self.assertEqual(len(self.store.index['segments']), 3)
+
+    def test_file(self):
+        """ add a file, and reopen the store """
+        filename = os.path.join(self.folder, 'month_3.pkl')
+        rec = time_record(np.random.RandomState(5), 1000, tstart=4e6)
+        pickle.dump(rec, open(filename, 'wb'))
+        self.assertTrue(self.store.add(filename))
+        self.assertFalse(self.store.add(filename))
+        store = timed_data.PhotonStore(self.store.folder)
+        self.assertEqual(store.nside, nside)
+        self.assertEqual(store.index['sources'][-1], 'month_3.pkl')
+        self.check_select(store, self.records+[rec])
+
+    def test_consolidate(self):
+        """ merging the last two segments leaves the first one, and the selection """
+        first, rest = self.store.index['segments'][0], self.store.index['segments'][1:]
+        self.store.consolidate(rest)
+        segments = self.store.index['segments']
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(segments[0], first)
+        for name in rest:
+            self.assertFalse(os.path.exists(os.path.join(self.store.folder, name)))
+        self.check_select(self.store, self.records)
+        self.store.consolidate()
+        self.assertEqual(len(self.store.index['segments']), 1)
+        self.check_select(timed_data.PhotonStore(self.store.folder), self.records)
+
+
+if __name__=='__main__':
+    unittest.main()
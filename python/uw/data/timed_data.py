@@ -4,7 +4,7 @@ see create_timed_data to generate files with times for all
 Extract a single data set around a cone with TimedData
 """
 
-import os, glob, pickle
+import os, glob, pickle, shutil
 import healpy
 import numpy as np
 import pandas as pd
@@ -57,6 +57,141 @@ class TimeInfo(object):
         return pd.DataFrame(np.rec.fromarrays(
             [df.band[incone], t, np.degrees(t2)], names='band time delta'.split()))
 
+class PhotonStore(object):
+    """A persistent, spatially indexed store of the photons from ConvertFT1.time_record
+    
+    The store is a folder with a set of segments, each made from one or more monthly time records.
+    In a segment the photons are sorted by HEALPix index, then time, with columns in .npy files:
+        pixels : sorted unique HEALPix indices (int32)
+        starts : offset of the first photon for each pixel, with the total as the last entry (int64)
+        band   : band index (int8)
+        time   : MET (float64)
+    The columns are memory-mapped, so a cone selection only reads the pixel ranges within the cone.
+    Adding a month writes a new segment; consolidate merges segments into one.
+    """
+    columns = ('pixels', 'starts', 'band', 'time')
+
+    def __init__(self, folder, nside=1024):
+        """folder : path to the store; created if it does not exist
+        nside : HEALPix nside of the time records, RING ordering
+        """
+        self.folder = os.path.expandvars(folder)
+        self.index_file = os.path.join(self.folder, 'index.pkl')
+        if os.path.exists(self.index_file):
+            self.index = pickle.load(open(self.index_file, 'rb'))
+        else:
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+            self.index = dict(nside=nside, segments=[], sources=[], next_segment=0)
+            self._save_index()
+        self.nside = self.index['nside']
+        self._segments = dict()
+            
+    def __repr__(self):
+        return '{}: {} segments, {} sources, {:,} photons'.format(
+            self.__class__.__name__, len(self.index['segments']), len(self.index['sources']), len(self))
+    
+    def __len__(self):
+        return sum(len(self.segment(name)['time']) for name in self.index['segments'])
+        
+    def _save_index(self):
+        tmp = self.index_file+'.tmp'
+        pickle.dump(self.index, open(tmp, 'wb'))
+        os.rename(tmp, self.index_file)
+        
+    def segment(self, name):
+        """return dict of memory-mapped columns for the segment"""
+        if name not in self._segments:
+            path = os.path.join(self.folder, name)
+            self._segments[name] = dict((col, np.load(os.path.join(path, col+'.npy'), mmap_mode='r'))
+                    for col in self.columns)
+        return self._segments[name]
+        
+    def _write_segment(self, hpindex, band, time, sources):
+        """ sort the photons, write a new segment, and add it to the index"""
+        order = np.lexsort((time, hpindex))
+        hpindex = hpindex[order]
+        pixels, starts = np.unique(hpindex, return_index=True)
+        name = 'segment_{:04d}'.format(self.index['next_segment'])
+        path = os.path.join(self.folder, name)
+        tmp = path+'.tmp'
+        if not os.path.exists(tmp): os.makedirs(tmp)
+        for col, data in zip(self.columns, [pixels.astype(np.int32), np.append(starts, len(hpindex)).astype(np.int64),
+                np.asarray(band[order], np.int8), np.asarray(time[order], np.float64)]):
+            np.save(os.path.join(tmp, col+'.npy'), data)
+        os.rename(tmp, path)
+        self.index['segments'].append(name)
+        self.index['sources'] += sources
+        self.index['next_segment'] +=1
+        self._save_index()
+        return name
+        
+    def add(self, time_record, source=None):
+        """ add photons as a new segment
+        time_record : dict returned by ConvertFT1.time_record, or the name of a pickle file with it
+        source : string, to identify the data; default the file name. If already in the store, skip
+        returns True if added
+        """
+        if not hasattr(time_record, 'keys'):
+            source = source or os.path.split(time_record)[-1]
+            if source in self.index['sources']: return False
+            time_record = pickle.load(open(time_record, 'rb'))
+        elif source in self.index['sources']: 
+            return False
+        rec = time_record['timerec']
+        self._write_segment(np.asarray(rec['hpindex'], np.int64), rec['band'], 
+            np.asarray(rec['time'],float)+time_record['tstart'], [source])
+        return True
+
+    def consolidate(self, names=None):
+        """ merge segments into a single one, deleting the old ones
+        names : list of segment names | None
+            the segments to merge, for example those just added; if None, all of them,
+            which needs memory for all the photons in the store
+        """
+        names = list(self.index['segments'] if names is None else names)
+        if len(names)<2: return
+        hp, band, time = [], [], []
+        for name in names:
+            seg = self.segment(name)
+            hp.append(np.repeat(seg['pixels'], np.diff(seg['starts'])))
+            band.append(np.asarray(seg['band'])); time.append(np.asarray(seg['time']))
+        self.index['segments'] = [name for name in self.index['segments'] if name not in names]
+        self._write_segment(np.concatenate(hp), np.concatenate(band), np.concatenate(time), [])
+        for name in names:
+            self._segments.pop(name, None)
+            shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+    
+    def select(self, l, b, radius=5):
+        """create DataFrame with times, band id, distance from center, sorted by time
+        parameters and returned DataFrame as for TimeInfo.select
+        """
+        nside = self.nside
+        cart = lambda l,b: healpy.dir2vec(l,b, lonlat=True) 
+        center = cart(l,b)
+        ipix = np.sort(healpy.query_disc(nside, center, np.radians(radius), nest=False))
+        hp, band, time = [np.zeros(0,int)], [np.zeros(0,np.int8)], [np.zeros(0)]
+        for name in self.index['segments']:
+            seg = self.segment(name)
+            pixels = seg['pixels']
+            k = np.searchsorted(pixels, ipix)
+            valid = k<len(pixels)
+            k = k[valid][pixels[k[valid]]==ipix[valid]]
+            a, n = seg['starts'][k], seg['starts'][k+1]-seg['starts'][k]
+            # indices of all photons in the ranges: ranges are increasing, so reads are sequential
+            rows = np.repeat(a-np.cumsum(n)+n, n) + np.arange(n.sum())
+            hp.append(np.repeat(pixels[k], n))
+            band.append(seg['band'][rows]); time.append(seg['time'][rows])
+        hp, band, time = np.concatenate(hp), np.concatenate(band), np.concatenate(time)
+        order = np.argsort(time, kind='mergesort')
+        hp, band, time = hp[order], band[order], time[order]
+
+        ll,bb = healpy.pix2ang(nside, hp, nest=False, lonlat=True)
+        t2 = np.array(np.sqrt((1.-np.dot(center, cart(ll,bb)))*2), np.float32) 
+        return pd.DataFrame(np.rec.fromarrays(
+            [band, time, np.degrees(t2)], names='band time delta'.split()))
+
+        
 class TimedData(object):
     """Create a data set at a given position
     """
@@ -64,19 +199,28 @@ class TimedData(object):
     plt.rc('font', size=12)
     
     def __init__(self, position, name='', radius=5, 
-            file_pattern='$FERMI/data/P8_P305/time_info/month_*.pkl'):
+            file_pattern='$FERMI/data/P8_P305/time_info/month_*.pkl',
+            store=None):
         """Set up combined data from set of monthly files
 
         position : l,b in degrees
         name :    string, optional name to describe source
         radius :  float, cone radius for selection
         file_pattern : string for glob use 
+        store :   PhotonStore object, or folder name | None
+            if set, select from the store rather than the monthly files
         """
 
         assert hasattr(position, '__len__') and len(position)==2, 'expect position to be (l,b)'
+        self.name = name
+        if store is not None:
+            if not isinstance(store, PhotonStore):
+                store = PhotonStore(store)
+            self.df = store.select(*position, radius=radius)
+            print ('Selected {} photons'.format(len(self.df)))
+            return
         files = sorted(glob.glob(os.path.expandvars(file_pattern)))
         assert len(files)>0, 'No files found using pattern {}'.format(file_pattern)
-        self.name = name
         gbtotal = np.array([os.stat(filename).st_size for filename in files]).sum()/2**30
         print ('Opening {} files, with {} GB total'.format(len(files), gbtotal))
 
@@ -140,3 +284,22 @@ def create_timed_data(
         print ('writing {}'.format(outfile),)
         tr = binned_data.ConvertFT1(filename).time_record()
         pickle.dump(tr, open(outfile, 'w'))
+
+def create_photon_store(
+        file_pattern='$FERMI/data/P8_P305/time_info/month_*.pkl',
+        folder='$FERMI/data/P8_P305/photon_store',
+        consolidate=False):
+    """ Add the monthly files from create_timed_data that are not already in the PhotonStore at folder
+    consolidate : bool
+        if True, merge the segments added by this call into one; existing segments are not changed
+    """
+    files = sorted(glob.glob(os.path.expandvars(file_pattern)))
+    assert len(files)>0, 'No files found using pattern {}'.format(file_pattern)
+    store = PhotonStore(folder)
+    existing = set(store.index['segments'])
+    added = [f for f in files if store.add(f)]
+    print ('Added {} files'.format(len(added)))
+    if consolidate:
+        store.consolidate([name for name in store.index['segments'] if name not in existing])
+    print (store)
+    return store
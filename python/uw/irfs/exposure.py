@@ -67,6 +67,13 @@ class BandExposure(Exposure):
             energy = self.energy
         return Exposure.value(self,skydir,energy)
 
+    @property
+    def skyspectrum(self):
+        """ the C++ SkySpectrum, with the energy set, to allow evaluation on a grid without python calls
+        """
+        self._cpp_exposure.setEnergy(self.energy)
+        return self._cpp_exposure
+
 
 class ExposureCorrection(object):
     """ logarithmic interpolation function
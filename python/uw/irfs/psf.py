@@ -6,10 +6,11 @@ Author: Eric Wallace
 __version__='$Revision: 1.4 $'
 
 import os
+import hashlib
 
 import numpy as np
 from astropy.io import fits
-from scipy import integrate
+from scipy import integrate, interpolate
 
 from uw.utilities import keyword_options
 from . import caldb, IrfError
@@ -263,10 +264,100 @@ class BandPSF(PSF):
             itail = np.pi*2*st**2*nt*self.psf_base_integral(dmax, st*scale, gt, dmin)
             return (self.weights[:,mask]*(icore+itail)).sum(axis=-2)
 
+    # Overlap tables, keyed by a hash of the PSF parameters. If overlap_table_folder is set,
+    # tables are also saved there, and loaded by later processes.
+    overlap_tables = dict()
+    overlap_table_folder = None
+    # table axes: x = asinh((offset-radius)/sigma), y = log(radius/sigma), sigma the scaled core width
+    overlap_table_grid = (np.linspace(-10, 10, 241), np.linspace(-4.6, 9.2, 70))
+
     def overlap(self, roi_dir, radius, skydir):
-        """Calculate the fractional PSF overlap with a circle."""
+        """Calculate the fractional PSF overlap with a circle.
+        skydir may be a SkyDir or a list of them; uses the interpolation table"""
         #NOTE: radius in degrees currently. Seems preferable for it to be radians for
         #consistency with other PSF code, but would require changes to clients
+        if hasattr(skydir,'__iter__'):
+            return self.overlap_offsets(np.asarray([roi_dir.difference(sd) for sd in skydir]), radius)
+        return self.overlap_offsets(np.asarray([roi_dir.difference(skydir)]), radius).item()
+
+    def overlap_offsets(self, offset, radius):
+        """Fractional PSF overlap with a circle for an array of source offsets
+        offset : array of float
+            distances from the center of the circle, radians
+        radius : float
+            radius of the circle, degrees
+        """
+        radius = np.radians(radius)
+        offset = np.asarray(offset, float)
+        sigma = self._sigma()
+        x = np.arcsinh((offset-radius)/sigma)
+        y = np.log(radius/sigma)*np.ones_like(x)
+        (xa,ya) = self.overlap_table_grid
+        # the table is not used near the center, where the spline follows the plateau poorly
+        intable = (x>=xa[0]) & (x<=xa[-1]) & (y>=ya[0]) & (y<=ya[-1]) & (offset>radius/2)
+        ret = np.empty(offset.shape)
+        ret[intable] = self.overlap_table().ev(x[intable], y[intable])
+        if np.any(~intable):
+            ret[~intable] = self._overlap_direct(offset[~intable], radius)
+        return np.clip(ret, 0, 1)
+
+    def _sigma(self):
+        nc,nt,sc,st,gc,gt = self[-1]
+        return sc*self.scale_function()
+
+    def overlap_table(self):
+        """Return a spline representation of the overlap, as a function of the table axes
+        It depends only on the PSF parameters, so is shared by all bands in the same IRF energy bin
+        """
+        key = hashlib.sha1(repr(np.round(self[-1], 12).tolist()).encode()).hexdigest()
+        if key in self.overlap_tables:
+            return self.overlap_tables[key]
+        (xa,ya) = self.overlap_table_grid
+        filename = None
+        if self.overlap_table_folder is not None:
+            filename = os.path.join(os.path.expandvars(self.overlap_table_folder), 'psf_overlap_%s.npy' % key)
+        if filename is not None and os.path.exists(filename):
+            z = np.load(filename)
+        else:
+            sigma = self._sigma()
+            radius = sigma*np.exp(ya)
+            offset = np.maximum(radius[None,:] + sigma*np.sinh(xa)[:,None], 0)
+            z = self._overlap_direct(offset, radius[None,:]*np.ones_like(offset))
+            if filename is not None:
+                if not os.path.exists(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename))
+                tmp = filename+'.%d.npy' % os.getpid()
+                np.save(tmp, z)
+                os.rename(tmp, filename)
+        table = interpolate.RectBivariateSpline(xa, ya, z)
+        self.overlap_tables[key] = table
+        return table
+
+    def _overlap_direct(self, offset, radius, order=8):
+        """Overlap computed by Gauss-Legendre quadrature, vectorized over offset and radius (radians)
+
+        The integral is over the distance r from the source: the fraction of the circle of radius r
+        inside the ROI, times the PSF density. It is split into subintervals, geometrically 
+        spaced from the inner limit, to follow the PSF core when it is small compared with the ROI.
+        """
+        o = np.maximum(np.asarray(offset, float), 1e-12)
+        R = np.asarray(radius, float)*np.ones_like(o)
+        a, b = np.abs(o-R), o+R
+        # interior part: the full circle of radius R-o is in the ROI
+        ret = np.where(o<R, self.integral(np.where(o<R, R-o, 0)), 0.)
+        breaks = np.concatenate([[0], np.logspace(-6,0,25)])
+        xg, wg = np.polynomial.legendre.leggauss(order)
+        u = np.concatenate([lo+(hi-lo)*(xg+1)/2 for lo,hi in zip(breaks[:-1], breaks[1:])])
+        w = np.concatenate([wg*(hi-lo)/2 for lo,hi in zip(breaks[:-1], breaks[1:])])
+        r = a[...,None] + (b-a)[...,None]*u
+        cphi = (o[...,None]**2 + r**2 - R[...,None]**2)/(2*o[...,None]*r)
+        frac = np.arccos(np.clip(cphi,-1,1))/np.pi
+        density = 2*np.pi*r*self(r.ravel()).reshape(r.shape)
+        return ret + (b-a) * np.sum(w*frac*density, axis=-1)
+
+    def _overlap_quad(self, roi_dir, radius, skydir):
+        """Calculate the fractional PSF overlap with a circle, with scipy.integrate.quad 
+        (the original version, for checking)"""
         radius = np.radians(radius)
         if hasattr(skydir,'__iter__'):
             scalar = False
@@ -16,6 +16,7 @@ from scipy import vectorize
 from scipy.interpolate import interp1d, griddata, UnivariateSpline, SmoothBivariateSpline, LinearNDInterpolator
 from scipy.integrate import quad
 from scipy.optimize import fmin
+from scipy.special import j1
 
 from skymaps import PySkySpectrum,PySkyFunction,SkyDir,Hep3Vector,\
         SkyImage,SkyIntegrator,CompositeSkyFunction,PythonUtilities
@@ -771,6 +772,12 @@ class RadiallySymmetricModel(SpatialModel):
             r is in degrees. """
         pass
 
+    def hankel_transform(self,k):
+        """ The Hankel transform, 2*pi*int r J0(k*r) PDF(r) dr, of the profile, for 
+            wavenumbers k in 1/radians. Used by utilities.convolution.HankelConvolution.
+            Returns None if there is no closed form, in which case the profile is tabulated. """
+        return None
+
     def approximate_profile(self,numpoints=200):
         """ For outputting radial profile with sufficient accuracy. Rapidly varying spatial
             models should implement their own version of this function."""
@@ -875,6 +882,9 @@ class Gaussian(RadiallySymmetricModel):
     def at_r_in_deg(self,r,energy=None):
         return self.pref*np.exp(-r**2/(2*self.sigma2))
 
+    def hankel_transform(self,k):
+        return np.exp(-0.5*(np.asarray(k)*np.radians(self.sigma))**2)
+
     def analytic_r68(self): return Gaussian.x68*self.sigma
     def analytic_r99(self): return Gaussian.x99*self.sigma
     def template_diameter(self): return 2*self.r99()
@@ -1103,6 +1113,10 @@ class Disk(RadiallySymmetricModel):
     def at_r_in_deg(self,r,energy=None):
         return np.where(r<=self.sigma,self.pref,0)
 
+    def hankel_transform(self,k):
+        x = np.asarray(k)*np.radians(self.sigma)
+        return np.where(x>0, 2*j1(x)/np.where(x>0,x,1), 1.)
+
     def analytic_r68(self): return Disk.x68*self.sigma
     def analytic_r99(self): return Disk.x99*self.sigma
     def template_diameter(self): return 2.0*(self['sigma']*6./5.)
@@ -9,7 +9,7 @@ import pandas as pd
 from  matplotlib import (patches, gridspec)
 from skymaps import SkyDir, Band 
 from . import (diffuse_fits, analysis_base,)
-from .. import (tools, configuration,  diffuse)
+from .. import (tools, configuration,  diffuse, model_store)
 from ..pipeline import stream
 
 
@@ -29,13 +29,17 @@ class IsotropicModel(object):
         self.isomodel_file = self.isoinfo['filename']
         if self.isoinfo.get('key', None)=='iso':
             zipfilename='pickle'
-            #z = zipfile.ZipFile(zipfilename)
-            files = sorted( glob.glob('{}/*.pickle'.format(zipfilename)) ) 
-            print ('Loading %d *.pickle files in folder %s' % (len(files), zipfilename))
+            store = model_store.ModelStore('.')
+            if store.is_current('pickle.zip' if os.path.exists('pickle.zip') else zipfilename):
+                dnorms = store.diffuse_normalization()
+            else:
+                #z = zipfile.ZipFile(zipfilename)
+                files = sorted( glob.glob('{}/*.pickle'.format(zipfilename)) ) 
+                print ('Loading %d *.pickle files in folder %s' % (len(files), zipfilename))
+                dnorms = [pickle.load(open(f))['diffuse_normalization'] for f in files]
             fnorm=[]; bnorm=[]
-            for f in files:
-                pk = pickle.load(open(f))
-                t =pk['diffuse_normalization']['iso']
+            for dn in dnorms:
+                t =dn['iso']
                 fnorm.append(t['front'])
                 bnorm.append(t['back'])
 
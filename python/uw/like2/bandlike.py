@@ -9,6 +9,7 @@ import sys, types
 import numpy as np
 from  uw.utilities import keyword_options
 from skymaps import SkyDir, Band
+from . import tools
 
 config=None
    
@@ -17,6 +18,7 @@ class BandLike(object):
     """
     defaults = (
         ('quiet', True, 'set False for info'),
+        ('packed', True, 'use the packed (nfree x npixels) matrix for model pixels and gradient'),
         )
     @keyword_options.decorate(defaults)
     def __init__(self, band, sources, free, roi, **kwargs):
@@ -122,6 +124,19 @@ class BandLike(object):
                 print ('Source {} is inactive, but free'.format(m.source.name) )
                 continue # should be no inactive free sources?
             self.model_pixels += m.pix_counts
+        if self.packed: self.pack()
+
+    def pack(self):
+        """ copy the pixel values of the free sources into the rows of a contiguous 
+        (nfree x npixels) matrix, so that the model pixels and the pixel part of the gradient 
+        are each a single matrix-vector product. 
+        The references are saved to detect a later initialization of a source.
+        """
+        self.packed_refs = [getattr(m, 'pixel_values', None) if m.active else None 
+                for m in self.free_sources]
+        self.free_pixel_values = np.zeros((len(self.free_sources), self.pixels))
+        for i, pv in enumerate(self.packed_refs):
+            if pv is not None: self.free_pixel_values[i] = pv
        
     def update(self, reset=False, force=False, **kwargs):
         """ assume that parameters have changed. Update only contributions 
@@ -133,6 +148,8 @@ class BandLike(object):
         force: bool, default False
             Force update of response even if source unchanged.
         """
+        if self.packed and self.band.has_pixels:
+            return self._packed_update(reset, force)
         self.model_pixels[:]=self.fixed_pixels
         self.counts = self.fixed_counts
         for bandsource in self.free_sources:
@@ -147,6 +164,28 @@ class BandLike(object):
  
         if self.band.has_pixels: 
             self.weights = self.data / self.model_pixels
+
+    def _packed_update(self, reset, force):
+        # version of update using the packed matrix: only the normalizations are collected per source
+        norms = np.zeros(len(self.free_sources))
+        self.counts = self.fixed_counts
+        for i, bandsource in enumerate(self.free_sources):
+            if reset: 
+                bandsource.initialize()
+                bandsource.source.changed=False
+            elif bandsource.source.changed or force:
+                bandsource.update()
+            self.counts+= bandsource.counts
+            if not bandsource.active: continue
+            pv = getattr(bandsource, 'pixel_values', None)
+            if pv is not self.packed_refs[i]:
+                # source was reinitialized: replace its row
+                self.packed_refs[i] = pv
+                self.free_pixel_values[i] = pv if pv is not None else 0
+            norms[i] = bandsource.pix_norm
+        self.model_pixels[:] = self.fixed_pixels
+        self.model_pixels += np.dot(norms, self.free_pixel_values)
+        self.weights = self.data / self.model_pixels
  
     def log_like(self):
         """ return the Poisson extended log likelihood """
@@ -164,14 +203,50 @@ class BandLike(object):
         """ gradient of the likelihood with resepect to the free parameters
         """
         if len(self.free_sources)==0: return np.array([])
-        grads = []
-        for m in self.free_sources:
-            grads.append(m.grad(self.weights, self.exposure_factor))
+        if self.packed:
+            # all weighted pixel sums in one product 
+            pixterms = np.dot(self.free_pixel_values, self.weights) if self.band.has_pixels\
+                else np.zeros(len(self.free_sources))
+            grads = []
+            for m, pixterm in zip(self.free_sources, pixterms):
+                g, apterm = m.grad_terms(self.exposure_factor)
+                grads.append(g * (apterm - pixterm))
+            return self.unweight * np.concatenate(grads)
             
         return self.unweight * np.concatenate(
                 [m.grad(self.weights, self.exposure_factor) for m in self.free_sources]
             )
        
+    def hessian(self, delta=1e-6):
+        """ hessian of the negative log likelihood with respect to the free parameters, the sum of 
+            * the Poisson Fisher term: sum over pixels of data/model**2 times the products of 
+              the derivatives of the model pixels, which are the pixel values times the spectral gradients
+            * the curvature term, for each source: the derivative of its spectral gradient times
+              the aperture minus weighted pixel terms from the gradient
+        delta : float
+            step for the derivative of the spectral gradients
+        """
+        terms = [m.hess_terms(self.exposure_factor, delta) for m in self.free_sources]
+        npar = [len(t[0]) for t in terms]
+        if sum(npar)==0: return np.zeros((0,0))
+        gvec = np.concatenate([t[0] for t in terms])
+        if self.band.has_pixels:
+            pvals = self.free_pixel_values if self.packed else np.array(
+                [getattr(m, 'pixel_values', np.zeros(self.pixels)) for m in self.free_sources])
+            pixterms = np.dot(pvals, self.weights)
+            a = pvals * (np.sqrt(self.data)/self.model_pixels)
+            fisher = np.dot(a, a.T)
+        else:
+            pixterms = np.zeros(len(terms))
+            fisher = np.zeros((len(terms),len(terms)))
+        index = np.repeat(np.arange(len(terms)), npar)
+        hess = np.outer(gvec, gvec) * fisher[np.ix_(index,index)]
+        offsets = np.cumsum([0]+npar)
+        for i, (g, apterm, dg) in enumerate(terms):
+            j,k = offsets[i], offsets[i+1]
+            hess[j:k, j:k] += dg * (apterm - pixterms[i])
+        return self.unweight * hess
+
     def model_counts(self, sourcemask=None):
         """ return the model predicted counts for all or a subset of the sources
         sourcemask : array of bool
@@ -274,6 +349,30 @@ class BandLike(object):
                 t.append(0)
         return np.array(t)
 
+    def fluxes_at(self, skydirs, vecs=None):
+        """Return an array, shape (number of models, number of positions), of the fluxes
+        for all models at each of a list of positions, evaluated for all positions at once
+        skydirs : list of SkyDir objects
+        vecs : None | array, shape (number of positions, 3)
+            unit vectors for the positions, if already calculated
+        """
+        if vecs is None: vecs = tools.unit_vectors(skydirs)
+        t = np.zeros((len(self.bandsources), len(skydirs)))
+        for i,bb in enumerate(self):
+            try:
+                t[i] = bb.values(skydirs, vecs)
+            except Exception as msg:
+                print ('Fail flux calculation for {}:{}'.format(bb, msg))
+        return t
+
+    def values(self, skydirs, vecs=None):
+        """Return an array of the total counts/sr at each of a list of positions,
+        the array version of __call__
+        """
+        ret = self.fluxes_at(skydirs, vecs).sum(axis=0)
+        assert not np.any(np.isnan(ret)), 'NaN value(s) detected in band {}'.format(self.band)
+        return ret
+
     def __call__(self, skydir):
         """ return the total counts/sr for the given direction
         skydir : Skydir object | (ra,dec) tuple
@@ -459,13 +558,16 @@ class BandLikeList(list):
     def gradient(self):
         return np.array([blike.gradient() for blike in self._selected]).sum(axis=0) 
         
-    def hessian(self, mask=None, delta=1e-6):
+    def hessian(self, mask=None, delta=1e-6, numerical=False):
         """ return a hessian matrix based on the current parameter set
-        This makes a numerical derivative of the analytic gradient, so not exactly
-        symmetric, but the the result must be (nearly) symmetric.
+        The default is the analytic form, the sum of the BandLike.hessian contributions,
+        at the cost of about one gradient evaluation.
         
         mask : [None | array of bool]
             If present, must have dimension of the parameters, will generate a sub matrix
+        numerical : bool
+            if True, use the numerical derivative of the analytic gradient, so not exactly
+            symmetric, but the the result must be (nearly) symmetric. For a cross-check.
         
         For sigmas and correlation coefficients, invert to covariance
                 cov =  self.hessian().I
@@ -479,6 +581,10 @@ class BandLikeList(list):
         else:
             mask = np.asarray(mask)
             assert len(mask)==len(parz)
+        if not numerical:
+            self.update()
+            hess = np.array([b.hessian(delta) for b in self._selected]).sum(axis=0)
+            return hess[np.ix_(mask,mask)]
         # initial values for the likelihood and gradient
         fzero = self.log_like()
         glast = gzero = self.gradient()[mask]
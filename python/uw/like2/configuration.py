@@ -5,7 +5,7 @@ Manage the analysis configuration
 import os, sys, types, StringIO, pprint, yaml
 import numpy as np
 from uw.irfs import irfman
-from . import ( dataset, exposure, psf, from_xml)
+from . import ( dataset, exposure, psf, from_xml, diffuse_cache, convolution)
 import skymaps
 from uw.utilities import keyword_options
         
@@ -158,6 +158,28 @@ class Configuration(dict):
         else:       
             self.irfs = irfman.IrfManager(self.dataset, 
                 irf_dir=self.caldb, irfname=self.dataset.irf)
+
+        # optional persistent cache of convolved diffuse grids
+        cache_spec = config.get('diffuse_cache', None)
+        if cache_spec:
+            if not isinstance(cache_spec, dict): cache_spec = dict()
+            diffuse_cache.setup(
+                cache_spec.get('folder', os.path.join(self.configdir, 'diffuse_cache')),
+                identity=(irf, self.caldb, repr(exposure_correction), 
+                    diffuse_cache.file_identity(self.dataset.binfile),
+                    diffuse_cache.file_identity(self.dataset.ltcube)),
+                maxsize=cache_spec.get('maxsize', 4000), 
+                quiet=self.quiet)
+
+        # in-memory cache of exposure on the extended source grids: False to disable, or a dict
+        # with optional keys 'maxsize' (MB) and 'max_dloge' (see convolution.ExposureGridCache)
+        cache_spec = config.get('exposure_grid_cache', True)
+        if not cache_spec:
+            convolution.exposure_grids = None
+        elif isinstance(cache_spec, dict):
+            convolution.exposure_grids = convolution.ExposureGridCache(**cache_spec)
+        elif convolution.exposure_grids is None:
+            convolution.exposure_grids = convolution.ExposureGridCache()
         
         # check location of model
         # possibilites are the all-sky pickle.zip, from which any ROI can be extraccted, or a specific set of
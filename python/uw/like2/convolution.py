@@ -6,7 +6,7 @@ Extends classes from uw.utilities
 $Header: /nfs/slac/g/glast/ground/cvs/pointlike/python/uw/like2/convolution.py,v 1.9 2018/01/27 15:37:17 burnett Exp $
 author:  Toby Burnett
 """
-import os, pickle, zipfile 
+import os, pickle, zipfile, collections
 import numpy as np
 import pandas as pd
 from uw.utilities import keyword_options
@@ -14,17 +14,50 @@ from uw.utilities import convolution as utilities_convolution
 
 import skymaps #from Science Tools: for SkyDir 
 
+def native_fill(skyfun):
+    """ True if skyfun can be evaluated on a grid without a python call per point: 
+    it is a C++ SkySpectrum, provides one with a skyspectrum property, or implements eval_vectors
+    """
+    return isinstance(skyfun, skymaps.SkySpectrum) or hasattr(skyfun, 'skyspectrum')\
+        or hasattr(skyfun, 'eval_vectors')
+
 class FillMixin(object):
     """A Mixin class for like2 convolution, to replace functions in utilities.convolution
     """
+    def grid_vectors(self):
+        """ return a (npix*npix, 3) array of the unit vectors, in galactic coordinates, for the grid
+        points, in the order used by fill.
+        The points are on the equator, at the longitude of the center, rotated about the axis
+        at 90 degrees longitude from it, to the latitude of the center.
+        """
+        key = (self.npix, self.pixelsize, self.center.l(), self.center.b())
+        if getattr(self, '_grid_vectors', None) is not None and self._grid_key==key:
+            return self._grid_vectors
+        lon = np.radians(np.array(list(self.lons)))[:,None]
+        lat = np.radians(np.array(list(self.lats)))[None,:]
+        v = np.array([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)*np.ones_like(lon)])
+        v = v.reshape(3,-1).T
+        # rotation about the axis by -b of the center (Rodrigues formula)
+        clon, theta = np.radians(self.center.l()), -np.radians(self.center.b())
+        axis = np.array([np.cos(clon+np.pi/2), np.sin(clon+np.pi/2), 0])
+        self._grid_vectors = v*np.cos(theta) + np.cross(axis, v)*np.sin(theta) \
+            + np.outer(np.dot(v, axis), axis)*(1-np.cos(theta))
+        self._grid_key = key
+        return self._grid_vectors
+
     def fill(self, skyfun):
         """ Evaluate skyfun along the internal grid and return the resulting array.
-        (Identical to superclass, except skyfun can be either a python functor or a 
-        C++ SkySkySpectrum)
+        (Identical to superclass, except skyfun can be either a python functor, a 
+        C++ SkySkySpectrum, an object with a skyspectrum property returning one,
+        or an object with a method eval_vectors which evaluates an array of galactic unit vectors)
         """
         v = np.empty(self.npix*self.npix)
-        if isinstance(skyfun, skymaps.SkySpectrum):
+        if hasattr(skyfun, 'eval_vectors'):
+            v[:] = skyfun.eval_vectors(self.grid_vectors())
+        elif isinstance(skyfun, skymaps.SkySpectrum):
             skymaps.PythonUtilities.val_grid(v,self.lons,self.lats,self.center,skyfun)
+        elif hasattr(skyfun, 'skyspectrum'):
+            skymaps.PythonUtilities.val_grid(v,self.lons,self.lats,self.center,skyfun.skyspectrum)
         else:
             def pyskyfun(u):
                 return skyfun(skymaps.SkyDir(skymaps.Hep3Vector(u[0],u[1],u[2])))
@@ -43,6 +76,9 @@ class FillMixin(object):
         if dm is None:
             assert cache is not None, 'Logic error'
             self.bg_vals = self.fill(exp) * cache
+        elif native_fill(exp) and native_fill(dm):
+            # both can be evaluated on the grid without python callbacks
+            self.bg_vals = self.fill(exp) * self.fill(dm)
         else:
             def exp_dm(skydir):
                     return exp(skydir)*dm(skydir)
@@ -178,6 +214,92 @@ class ConvolvableGrid(FillMixin, ShowMixin, utilities_convolution.BackgroundConv
         return '%s.%s: center %s npix %d pixelsize %.2f' %(
             self.__module__,self.__class__.__name__, self.center, self.npix, self.pixelsize)
 
+class ExposureGridCache(object):
+    """ In-memory cache of the exposure evaluated on a ConvolvableGrid, for response.ExtendedResponse.
+    Filling a grid is expensive, about 1.6 s for npix=201, and the grid for an extended source, centered on it,
+    is the same for each of the ROIs containing the source, and when it is refit.
+    Layers are grouped by (exposure, event type, grid center, npix, pixelsize), then keyed by energy.
+    Groups are discarded, least recently used first, when the total size exceeds maxsize.
+    
+    If max_dloge>0, the layer for an energy between two cached layers separated by at most max_dloge 
+    in log10(energy) is interpolated linearly in log energy rather than filled.
+    """
+    def __init__(self, maxsize=500, max_dloge=0):
+        """ maxsize : float
+                maximum size in MB
+            max_dloge : float
+                maximum separation of the layers used for interpolation; 0 to disable
+        """
+        self.maxsize, self.max_dloge = maxsize, max_dloge
+        self.clear()
+
+    def __repr__(self):
+        n = self.hits+self.misses+self.interpolated
+        return '%s.%s: %d grids, %d layers, %.1f MB; %d hits, %d interpolated, %d filled' % (
+            self.__module__,self.__class__.__name__, len(self.groups), 
+            sum(len(g[1]) for g in self.groups.values()), self.size, 
+            self.hits, self.interpolated, self.misses)
+
+    def clear(self):
+        self.groups = collections.OrderedDict() # key: (exposure source, {energy: layer})
+        self.hits = self.misses = self.interpolated = 0
+
+    @staticmethod
+    def exposure_source(exposure):
+        """ the object which provides the exposure for all energies"""
+        for name in ('_cpp_exposure', 'eman'):
+            if hasattr(exposure, name): return getattr(exposure, name)
+        return exposure
+
+    def key(self, grid, band):
+        center = grid.center
+        return (id(self.exposure_source(band.exposure)), band.event_type, 
+            round(center.ra(),6), round(center.dec(),6), grid.npix, round(grid.pixelsize,6))
+
+    @property
+    def size(self):
+        return sum(a.nbytes for g in self.groups.values() for a in g[1].values())/1e6
+
+    def __call__(self, grid, band):
+        """ return the exposure for the band on the grid, a read-only npix x npix array"""
+        key = self.key(grid, band)
+        # (re)insert the group to mark it most recently used; it holds a reference to the 
+        # exposure source so that its id is not reused
+        group = self.groups.pop(key, None) or (self.exposure_source(band.exposure), dict())
+        self.groups[key] = group
+        layers = group[1]
+        energy = round(band.energy, 3)
+        if energy in layers:
+            self.hits +=1
+            return layers[energy]
+        v = self.interpolate(layers, energy)
+        if v is not None:
+            self.interpolated +=1
+            return v
+        self.misses +=1
+        v = layers[energy] = grid.fill(band.exposure)
+        v.flags.writeable=False
+        self.purge()
+        return v
+
+    def interpolate(self, layers, energy):
+        """ return a layer interpolated between the cached layers bracketing energy, or None"""
+        if self.max_dloge<=0 or len(layers)<2: return None
+        energies = np.array(sorted(layers.keys()))
+        i = np.searchsorted(energies, energy)
+        if i==0 or i==len(energies): return None
+        e1, e2 = energies[i-1], energies[i]
+        if np.log10(e2/e1) > self.max_dloge: return None
+        w = np.log(energy/e1)/np.log(e2/e1)
+        return (1-w)*layers[e1] + w*layers[e2]
+
+    def purge(self):
+        while len(self.groups)>1 and self.size>self.maxsize:
+            self.groups.popitem(last=False)
+
+# the cache used by response.ExtendedResponse; set to None to disable
+exposure_grids = ExposureGridCache()
+
 def spherical_harmonic(f, lmax, thetamax=45):
     """ Calculate spherical harmonics for a function f, l<=lmax
     thetamax : float, optionial. units degrees
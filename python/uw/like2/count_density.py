@@ -8,7 +8,10 @@ author:  Toby Burnett
 import numpy as np
 import pandas as pd
 from astropy.io import fits
-import os, healpy, argparse
+import os, healpy, argparse, hashlib
+from scipy import ndimage
+import skymaps
+from pointlike import DoubleVector
 
 from uw.like2.pub import healpix_map #make this local in future
 from uw.like2 import (diffuse, convolution, configuration )
@@ -35,6 +38,145 @@ class Simpson(object):
             r += w[i] * self(x[i])
         return r
 
+def transfer_function(psf, lmax, thetamax, npoints=None):
+    """ Return the spherical harmonic transfer function b_l, l=0..lmax, of a PSF, normalized to b_0=1:
+    the integral over x=cos(theta) from cos(thetamax) to 1 of psf(sqrt(2(1-x))) P_l(x).
+    (Same as convolution.SphericalHarmonicContent, but with Gauss-Legendre quadrature and the Legendre
+    recurrence for all l at once, rather than quad for a sample of l values)
+    psf : function of the angle in radians
+    thetamax : float
+        upper limit for the angle, degrees
+    """
+    npoints = npoints or 2*lmax+200
+    t, w = np.polynomial.legendre.leggauss(npoints)
+    ctmin = np.cos(np.radians(min(thetamax, 180.)))
+    x = ctmin + (1-ctmin)*(t+1)/2.
+    fw = np.asarray(psf(np.sqrt(2*(1-x))), float) * w
+    b = np.empty(lmax+1)
+    p0, p1 = np.ones_like(x), x
+    b[0] = fw.sum()
+    if lmax>0: b[1] = np.dot(fw, p1)
+    for l in range(1, lmax):
+        p0, p1 = p1, ((2*l+1)*x*p1 - l*p0)/(l+1)
+        b[l+1] = np.dot(fw, p1)
+    return b/b[0]
+
+class AllSkyConvolution(object):
+    """ Convolve the layers of a diffuse cube, times exposure, with the PSF, using spherical harmonics.
+
+    The alm of each energy layer of the cube are computed once, and used for all event types. Since the 
+    alm are for the diffuse map alone, the exposure, which varies slowly, multiplies the convolved map.
+    PSF transfer functions are saved as .npy files in cache_folder, if set, named by a hash of the 
+    sampled PSF, lmax and thetamax, so they are reused by later runs.
+    """
+    def __init__(self, hpcube, irfman, lmax=500, psf_energy_factor=1.0, cache_folder=None,
+            exposure_gridsize=0.5, quiet=True):
+        """
+        hpcube : diffuse.HealpixCube object or filename
+        irfman : irf/IrfMan object for exposure, PSF
+        lmax : int
+            maximum l; limited by the nside of the cube
+        cache_folder : string | None
+            folder for transfer functions; None to keep them in memory only
+        exposure_gridsize : float | None
+            grid spacing, degrees, for exposure_map
+        """
+        if not isinstance(hpcube, diffuse.HealpixCube):
+            hpcube = diffuse.HealpixCube(hpcube)
+            hpcube.load()
+        self.hpcube = hpcube
+        self.nside = hpcube.nside
+        self.irfman = irfman
+        self.lmax = min(lmax, 3*self.nside-1)
+        self.psf_energy_factor = psf_energy_factor
+        self.cache_folder = os.path.expandvars(cache_folder) if cache_folder is not None else None
+        if self.cache_folder is not None and not os.path.exists(self.cache_folder):
+            try: os.makedirs(self.cache_folder)
+            except OSError: pass # another process made it
+        self.exposure_gridsize = exposure_gridsize
+        self.quiet = quiet
+        self.alms = dict()   # by energy
+        self.transfer = dict() # by (event_type, energy)
+
+    def __repr__(self):
+        return '%s.%s: nside %d, lmax %d, %d alms, %d transfer functions' % (self.__module__,
+            self.__class__.__name__, self.nside, self.lmax, len(self.alms), len(self.transfer))
+
+    def compute_alm(self, energy):
+        """ the alm of the cube at energy; NaN pixels are set to zero"""
+        iem_map = np.array(self.hpcube.column(energy), float) #note will interpolate
+        bad = np.isnan(iem_map)
+        if np.any(bad):
+            print ('Warning: {} Nan pixels at {:.0f} MeV'.format(np.sum(bad),energy))
+            iem_map[bad]=0
+        return healpy.map2alm(iem_map, lmax=self.lmax)
+
+    def alm(self, energy):
+        if energy not in self.alms:
+            self.alms[energy] = self.compute_alm(energy)
+        return self.alms[energy]
+
+    def load_alms(self, energies, processes=None):
+        """ compute the alm for a list of energies, in a pool of forked processes if processes>1"""
+        global _engine
+        todo = [e for e in sorted(set(energies)) if e not in self.alms]
+        if processes is None or processes<=1 or len(todo)<2:
+            for e in todo: self.alm(e)
+            return
+        import multiprocessing
+        _engine = self
+        pool = multiprocessing.get_context('fork').Pool(processes)
+        try:
+            for energy, alm in pool.imap_unordered(_layer_alm, todo):
+                self.alms[energy] = alm
+        finally:
+            pool.close(); pool.join()
+            _engine = None
+
+    def transfer_function(self, event_type, energy):
+        """ b_l for the PSF at energy, from memory, the cache folder, or computed"""
+        key = (event_type, energy)
+        if key in self.transfer: return self.transfer[key]
+        psf = self.irfman.psf(event_type, energy* self.psf_energy_factor)
+        thetamax = 5*psf.r68
+        filename = None
+        if self.cache_folder is not None:
+            sample = np.asarray(psf(np.radians(np.linspace(0, thetamax, 64))), float)
+            h = hashlib.sha1(sample.tobytes())
+            h.update(repr((self.lmax, round(thetamax,6))).encode())
+            filename = os.path.join(self.cache_folder, 'bl_{}.npy'.format(h.hexdigest()[:16]))
+        if filename is not None and os.path.exists(filename):
+            b = np.load(filename)
+        else:
+            b = transfer_function(psf, self.lmax, thetamax)
+            if filename is not None:
+                tmp = filename+'.{}.npy'.format(os.getpid())
+                np.save(tmp, b)
+                os.rename(tmp, filename)
+        self.transfer[key] = b
+        return b
+
+    def exposure(self, event_type, energy):
+        return exposure_map(self.irfman, event_type, energy, self.nside, self.exposure_gridsize)
+
+    def __call__(self, energy, event_type):
+        """ return the count density map for the event type at energy"""
+        if not self.quiet:
+            print ('Convolving for energy {:.0f}, event type {}'.format(energy, event_type))
+        alm = healpy.almxfl(self.alm(energy), self.transfer_function(event_type, energy))
+        return healpy.alm2map(alm, nside=self.nside, lmax=self.lmax, verbose=False) \
+            * self.exposure(event_type, energy)
+
+# the engine or CountDensity object used by forked worker processes
+_engine = None
+_count_density = None
+
+def _layer_alm(energy):
+    return energy, _engine.compute_alm(energy)
+
+def _convert_layer(bin_index):
+    return _count_density.convert_layer(bin_index)
+
 class CountDensity(object):
     """Manage computation of expected count density from a diffuse map.
     Includes exposure and convolution with PSF
@@ -44,7 +186,8 @@ class CountDensity(object):
             energies=None, 
             ebins=None, simpson_index=[], 
             psf_energy_factor=1.0,
-            newfilename=None, overwrite=True, adjuster=None):
+            newfilename=None, overwrite=True, adjuster=None,
+            engine=None, processes=None, lmax=None, cache_folder=None):
         """
         filename : string
             name of a file in HEALPix format
@@ -64,6 +207,16 @@ class CountDensity(object):
             Adjust the energy at which the PSF is evaluated
         adjuster : None | function object
             Multiply the resulting map by adjuster(energy), perhaps for dispersion correction            
+        engine : AllSkyConvolution | None
+            Share one, for the same diffuse file, among event types, to reuse the alm.
+            If None, create one with lmax (default 500), psf_energy_factor and cache_folder. 
+            Otherwise these must be the same as, or, for lmax and cache_folder, None to use, 
+            those of the engine.
+        processes : int | None
+            If >1, number of processes for the energy layers 
+        
+        If newfilename exists, the lowest energy layer is compared with the previous method
+        before it is replaced, see compare_old.
         """
         print ('loading filename {}\nConvolving with event type {}, psf factor {}'.format(filename, event_type, psf_energy_factor))
         print ('Will write to {}'.format(newfilename) if newfilename is not None else 'No output file specified')
@@ -73,6 +226,18 @@ class CountDensity(object):
         self.nside = self.hpcube.nside
         self.irfman = irfman
         self.event_type= event_type
+        if engine is None:
+            engine = AllSkyConvolution(self.hpcube, irfman, lmax=lmax or 500,
+                psf_energy_factor=psf_energy_factor, cache_folder=cache_folder)
+        else:
+            assert engine.psf_energy_factor==psf_energy_factor, \
+                'psf_energy_factor {} differs from the engine: {}'.format(psf_energy_factor, engine.psf_energy_factor)
+            assert lmax is None or engine.lmax==min(lmax, 3*self.nside-1), \
+                'lmax {} differs from the engine: {}'.format(lmax, engine.lmax)
+            assert cache_folder is None or engine.cache_folder==os.path.expandvars(cache_folder), \
+                'cache_folder {} differs from the engine: {}'.format(cache_folder, engine.cache_folder)
+        self.engine = engine
+        self.processes = processes
         if ebins is not None:
             #set up for Simpson integration
             self.simpson = Simpson(self)
@@ -91,6 +256,7 @@ class CountDensity(object):
             print ('IEM adjuster specified, {}'.format(self.adjuster.__class__))
 
         if newfilename is not None:
+            self.comparison = self.compare_old() if os.path.exists(newfilename) else None
             self.replace_skymaps()
             self.replace_energies()
             self.writeto(newfilename, overwrite=overwrite)
@@ -99,12 +265,7 @@ class CountDensity(object):
         print ('Convolving for energy {:.0f}'.format(energy))
         if energy==self.last_energy: return self.last_map
         self.last_energy=energy
-        self.hpcube.setEnergy(energy)
-        iem_map = self.hpcube.column(energy) #note will interpolate
-        exp_map = exposure_map(self.irfman, 
-            self.event_type, energy, self.nside )
-        psf = self.irfman.psf(self.event_type, energy* self.psf_energy_factor)
-        count_density_map=convolve_healpix(iem_map * exp_map, psf, 5*psf.r68, lmax_limit=500)
+        count_density_map = self.engine(energy, self.event_type)
         if self.adjuster is not None and energy<10000.:
             count_density_map *= self.adjuster(energy, self.event_type)
         self.last_map=count_density_map
@@ -132,8 +293,57 @@ class CountDensity(object):
         #     count_density_map *= self.adjuster(energy, self.event_type)
         # return count_density_map
 
+    def layer_energies(self):
+        """list of the energies at which the cube is evaluated by convert_layer"""
+        energies = []
+        for i, energy in enumerate(self.energies):
+            if self.simpson is None or i>len(self.simpson_index)-1:
+                energies.append(energy); continue
+            a, b, n = self.emin[i], self.emax[i], self.simpson_index[i]
+            energies += [np.sqrt(a*b)] if n==1 else list(np.logspace(np.log10(a),np.log10(b),n+1))
+        return energies
+
+    def convert_layers(self):
+        """return a list of the layers, computed in a pool of forked processes if processes>1
+        """
+        global _count_density
+        # the alm are computed first, so they are shared by the workers
+        self.engine.load_alms(self.layer_energies(), self.processes)
+        nbins = len(self.energies)
+        if self.processes is None or self.processes<=1:
+            return [self.convert_layer(i) for i in range(nbins)]
+        import multiprocessing
+        _count_density = self
+        pool = multiprocessing.get_context('fork').Pool(self.processes)
+        try:
+            return list(pool.imap(_convert_layer, range(nbins)))
+        finally:
+            pool.close(); pool.join()
+            _count_density = None
+
+    def compare_old(self, energy=None):
+        """ Compare the engine, which multiplies the convolved diffuse map by the exposure, with the
+        previous method, the convolution of the product, with the exposure evaluated at each pixel.
+        The difference is largest where the PSF is widest, so the default energy is the lowest used.
+        Print and return a dict with the energy, the maximum and rms of the relative difference 
+        in each pixel, and the ratio of the totals
+        """
+        if energy is None: energy = min(self.layer_energies())
+        new = self.engine(energy, self.event_type)
+        psf = self.irfman.psf(self.event_type, energy* self.psf_energy_factor)
+        iem_map = self.hpcube.column(energy) #note will interpolate
+        old = convolve_healpix(iem_map * exposure_map(self.irfman, self.event_type, energy, self.nside),
+            psf, 5*psf.r68, lmax_limit=self.engine.lmax)
+        ok = old>0
+        rel = new[ok]/old[ok]-1
+        ret = dict(energy=energy, max_diff=np.abs(rel).max(), rms_diff=np.sqrt(np.mean(rel**2)), 
+            total_ratio=new.sum()/old.sum())
+        print ('Comparison with previous method at {energy:.0f} MeV: relative difference max {max_diff:.2e},'\
+            ' rms {rms_diff:.2e}; ratio of totals {total_ratio:.5f}'.format(**ret))
+        return ret
+
     def replace_skymaps(self):
-        tt = np.array([self.convert_layer(i) for i in range(len(self.energies))])
+        tt = np.array(self.convert_layers())
         newcols=[fits.Column(name='Bin{:d}'.format(i), format='E', array=tt[i]) for i,t in enumerate(tt)]
         skymap_hdu = fits.BinTableHDU.from_columns(newcols)
 
@@ -162,6 +372,9 @@ class CountDensity(object):
         header.add_comment('Input file {}'.format(hdus.filename()))
         header.add_comment('live-time cube {}'.format(self.irfman.ltcube))
         header.add_comment('Event type {}'.format(self.event_type))
+        if getattr(self, 'comparison', None) is not None:
+            header.add_comment('Change from previous method at {energy:.0f} MeV: max {max_diff:.2e},'\
+                ' rms {rms_diff:.2e}, total ratio {total_ratio:.5f}'.format(**self.comparison))
         print ('Writing to file {}'.format(newfilename))
         hdus.writeto(newfilename, overwrite=overwrite)
         
@@ -195,18 +408,40 @@ def convolve_healpix(input_map,  func, thetamax, quiet=True, lmax_limit=None ):
     healpy.almxfl(alm, fact, inplace=True)
     return healpy.alm2map(alm, nside=nside, verbose=False)
 
-def exposure_map(irfman, event_type, energy, nside=128):
+def exposure_map(irfman, event_type, energy, nside=128, gridsize=None):
     """
     Return an exposure map for the given event type and entry
+    gridsize : float | None
+        If set, and the exposure is a C++ SkySpectrum, evaluate it all at once on a full-sky grid
+        in galactic longitude and latitude with this spacing in degrees, and interpolate to the
+        pixel centers. Otherwise evaluate it for each pixel.
     """
     exp = irfman.exposure(event_type, energy)
-    return healpix_map.HPskyfun('exposure', exp, nside=nside).getcol()
+    if gridsize is None or not hasattr(exp, 'skyspectrum'):
+        return healpix_map.HPskyfun('exposure', exp, nside=nside).getcol()
+    nlon, nlat = int(round(360./gridsize)), int(round(180./gridsize))+1
+    # offset longitudes by half a step: problem with C++ code at exactly 180 deg.
+    lons = (np.arange(nlon)+0.5)*360./nlon
+    lats = np.linspace(-90, 90, nlat)
+    v = np.empty(nlon*nlat)
+    skymaps.PythonUtilities.val_grid(v, DoubleVector(lons), DoubleVector(lats), 
+        skymaps.SkyDir(0,0,skymaps.SkyDir.GALACTIC), exp.skyspectrum)
+    grid = v.reshape(nlon, nlat)
+    assert not np.any(np.isnan(grid)), 'NaN exposure value(s) at {:.0f} MeV'.format(energy)
+    grid = np.vstack([grid[-1:], grid, grid[:1]]) # wrap in longitude
+    glon, glat = healpy.pix2ang(nside, np.arange(12*nside**2), lonlat=True)
+    x = glon*nlon/360. + 0.5
+    y = (glat+90)*(nlat-1)/180.
+    return ndimage.map_coordinates(grid, [x,y], order=1, mode='nearest').astype(np.float32)
 
 
 def main(factor=1.0,energies=None, adjuster=None, simpson_index=[4,4,2,2,1], 
-        ebins=np.logspace(2, 6, 17)):
+        ebins=np.logspace(2, 6, 17), processes=None, cache_folder='$FERMI/misc/psf_transfer'):
     """
-
+    processes : int | None
+        number of processes for the energy layers
+    cache_folder : string | None
+        folder for the PSF transfer functions
     """
     config= configuration.Configuration('.', quiet=True, postpone=True)
     iem_file = config.diffuse['ring']['iemfile'] #original file
@@ -222,13 +457,19 @@ def main(factor=1.0,energies=None, adjuster=None, simpson_index=[4,4,2,2,1],
         energies = sorted(list(set(np.sqrt(emin*emax) * 1e-3) ))#from keV
     
     factor = config.diffuse['ring'].get('psf_energy_factor', 1.0)
+    if cache_folder is not None and '$' in os.path.expandvars(cache_folder):
+        cache_folder = None # environment variable not defined
 
+    # one engine for all event types, so that the alm of the cube are computed once
+    engine = AllSkyConvolution(iem_file, config.irfs, psf_energy_factor=factor, 
+        cache_folder=cache_folder, exposure_gridsize=0.5)
     for i,fb in enumerate(config.event_type_names):
         
         newfile = os.path.expandvars('$FERMI/diffuse/'+filename.replace('*',fb) )
         cd = CountDensity(iem_file, config.irfs, event_type=i, 
             psf_energy_factor=factor, adjuster=adjuster,
-            energies=energies, newfilename=newfile, ebins=ebins, simpson_index=simpson_index)
+            energies=energies, newfilename=newfile, ebins=ebins, simpson_index=simpson_index,
+            engine=engine, processes=processes)
 
 if __name__=='__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -237,6 +478,7 @@ if __name__=='__main__':
             uses configuration in current folder to obtain the IRF and exposure info
     """)
     #parser.add_argument('stream', nargs='*', default=None, help='optional Stream number')
+    parser.add_argument('--processes', type=int, default=None, help='number of processes for the energy layers')
     args = parser.parse_args()
-    main()
+    main(processes=args.processes)
      
\ No newline at end of file
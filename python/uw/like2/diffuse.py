@@ -8,6 +8,7 @@ author:  Toby Burnett
 import os, types, collections, zipfile, pickle, glob
 import numpy as np
 import pandas as pd
+import healpy
 from astropy.io import fits
 from astropy import wcs
 
@@ -152,6 +153,10 @@ class Isotropic(DiffuseBase):
         return np.exp(    np.log(self.spectrum[i])   * (1-a) 
                         + np.log(self.spectrum[i+1]) * a     ) 
 
+    def eval_vectors(self, vecs):
+        """ values for an (N,3) array of galactic unit vectors, at the current energy"""
+        return np.full(len(vecs), self(None))
+
     def plot_spectrum(self, ax=None,  erange=None, title=None, label=None):
         from matplotlib import pylab as plt
         ee = np.logspace(1.5,6,101) if erange is None else erange
@@ -267,6 +272,21 @@ class HealpixCube(DiffuseBase):
             ret = 0
         return ret
 
+    def eval_vectors(self, vecs):
+        """ values for an (N,3) array of galactic unit vectors, at the current energy
+        (vectorized version of __call__)
+        """
+        skyindex = healpy.vec2pix(self.nside, vecs[:,0], vecs[:,1], vecs[:,2])
+        a = self.energy_interpolation
+        u, v = self.eplane1[skyindex], self.eplane2[skyindex]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            use_u = (np.abs(a) < 1e-2) | (v<=0) | np.isnan(v)
+            use_v = ~use_u & ((np.abs(1-a)< 1e-2) | (u<=0) | np.isnan(u))
+            ret = np.where(use_u, u, np.where(use_v, v, np.exp( np.log(u) * (1-a) + np.log(v) * a )))
+        assert np.all(np.isfinite(ret)), 'Not finite for some directions at {} MeV'.format(self.energy)
+        ret[ret<=0] = 0
+        return ret
+
     def setEnergy(self, energy): 
         # set up logarithmic interpolation
         if not self.loaded:
@@ -381,6 +401,31 @@ class FitsMapCube(DiffuseBase):
         
         return ret
 
+    def eval_vectors(self, vecs):
+        """ values for an (N,3) array of galactic unit vectors, at the current energy
+        (vectorized version of __call__)
+        """
+        if not self.galactic:
+            vecs = healpy.rotator.Rotator(coord=['G','C'])(vecs.T).T
+        lon, lat = healpy.vec2dir(vecs.T, lonlat=True)
+        lon = np.where(lon<0, lon+360, lon)
+        world = np.array([lon, lat, np.ones(len(lon))]).T
+        pix = np.array(self.w.wcs_world2pix(world, 0)[:,:2], int)
+        ret = np.zeros(len(vecs))
+        ok = np.all(pix>=0, axis=1) & np.all(pix<self.naxis, axis=1)
+        i,j = pix[ok].T
+        a = self.energy_interpolation
+        f1, f2 = self.eplane1[j,i], self.eplane2[j,i]
+        if np.abs(a)<1e-2:
+            t = f1
+        elif np.abs(1-a)< 1e-2:
+            t = f2
+        else:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                t = np.exp( np.log(f1) * (1-a) + np.log(f2) * a  )
+        ret[ok] = np.where((f1==0) | (f2==0), 0, t)
+        return ret
+
 class FitsMapCubeList():
     def __init__(self, filename):
         filenames = open(filename).read().split('\n')
@@ -0,0 +1,183 @@
+"""
+Persistent cache of the convolved diffuse grids used by response.DiffuseResponse
+
+Each entry is a folder, named by a hash of everything that determines the convolution:
+the diffuse file, the correction factor, the IRF and data identity, the event type, the energy band,
+and the grid geometry. It contains .npy files for the convolved grid, cvals, and the
+per-pixel values, and a small file with the aperture average.
+The arrays are memory-mapped when loaded.
+
+Enable by adding a key 'diffuse_cache' to config.txt, with value either True or a dict with
+optional keys 'folder' (default "diffuse_cache" in the model folder) and 'maxsize' (in MB).
+"""
+import os, time, hashlib, shutil, tempfile
+import numpy as np
+
+# the cache in use, set by setup. If None, no caching
+cache = None
+
+def setup(folder, identity=(), maxsize=4000, quiet=True):
+    """ create the global cache
+    folder : string
+    identity : tuple
+        information that applies to all entries, such as the IRF and data files
+    maxsize : float
+        maximum size in MB. When exceeded, the least recently used entries are deleted
+    """
+    global cache
+    cache = DiffuseCache(folder, identity, maxsize, quiet)
+    return cache
+
+def file_identity(filename):
+    """ return a tuple with the name, size and modification time of a file, or just the name
+    if it does not exist """
+    if filename is None: return (None,)
+    try:
+        st = os.stat(filename)
+        return (filename, st.st_size, int(st.st_mtime))
+    except OSError:
+        return (filename,)
+
+
+class DiffuseCache(object):
+    """ A content-addressed, LRU-limited cache of convolved diffuse grids
+    """
+    arrays = ('cvals', 'pixel_values')
+    # number of puts between scans of the folder, which also count entries written by other processes
+    purge_interval = 100
+    # a purge deletes entries until the size is below this fraction of maxsize, so that a full cache
+    # is not scanned again at the next put
+    low_water = 0.9
+
+    def __init__(self, folder, identity=(), maxsize=4000, quiet=True):
+        self.folder = os.path.expandvars(folder)
+        if not os.path.exists(self.folder):
+            try: os.makedirs(self.folder)
+            except OSError: pass # in case some other process made it
+        self.identity = tuple(identity)
+        self.maxsize = maxsize
+        self.quiet = quiet
+        self.hits = self.misses = self.evicted = 0
+        self.load_time = 0.
+        self._size = None # estimate of the total size in MB, from the last scan and the puts since
+        self._puts = 0
+
+    def __repr__(self):
+        return '%s.%s: %s' % (self.__module__, self.__class__.__name__, self.report(out=False))
+
+    def key(self, response):
+        """ return the hash key for a DiffuseResponse object, which must have set corr and the grid geometry
+        """
+        band, dmodel = response.band, response.dmodel
+        center = response.roicenter
+        spec = (self.identity,
+            response.__class__.__name__,
+            file_identity(getattr(dmodel, 'fullfilename', None)) if hasattr(dmodel, 'fullfilename')
+                else repr(dmodel),
+            np.round(np.asarray(getattr(response, 'corr', 1.0), float), 8).tolist(),
+            band.event_type, round(band.emin, 3), round(band.emax, 3), round(band.radius, 3),
+            round(center.ra(), 6), round(center.dec(), 6),
+            response.grid_npix, round(response.pixelsize, 6),
+            band.has_pixels, band.pixels,
+            )
+        return hashlib.sha1(repr(spec).encode()).hexdigest()
+
+    def get(self, key):
+        """ return a dict with the cached values for key, or None if not found
+        """
+        path = os.path.join(self.folder, key)
+        if not os.path.exists(path):
+            self.misses +=1
+            return None
+        t = time.time()
+        try:
+            entry = dict(ap_average=float(np.load(os.path.join(path, 'ap_average.npy'))))
+            for name in self.arrays:
+                fname = os.path.join(path, name+'.npy')
+                if os.path.exists(fname):
+                    entry[name] = np.load(fname, mmap_mode='r')
+            os.utime(path, None) # mark as recently used
+        except Exception as msg:
+            print ('Diffuse cache: failed to load entry %s: %s' % (key, msg))
+            self.misses +=1
+            return None
+        self.hits +=1
+        self.load_time += time.time()-t
+        return entry
+
+    def put(self, key, ap_average, cvals, pixel_values=None):
+        """ save an entry. It is written to a temporary folder which is then renamed, so that
+        processes sharing the cache never see a partial entry
+        """
+        path = os.path.join(self.folder, key)
+        if os.path.exists(path): return
+        tmp = tempfile.mkdtemp(dir=self.folder, prefix='.tmp')
+        try:
+            np.save(os.path.join(tmp, 'ap_average.npy'), np.asarray(ap_average, float))
+            np.save(os.path.join(tmp, 'cvals.npy'), np.asarray(cvals))
+            if pixel_values is not None:
+                np.save(os.path.join(tmp, 'pixel_values.npy'), np.asarray(pixel_values))
+            size = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp))
+            os.rename(tmp, path)
+        except OSError:
+            # another process got there first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        if self.maxsize is None: return
+        # scan the folder only for the first put, every purge_interval puts, or when the estimate is too large
+        self._puts +=1
+        if self._size is None or self._puts % self.purge_interval == 0:
+            self.purge()
+            return
+        self._size += size/1e6
+        if self._size > self.maxsize:
+            self.purge()
+
+    def entries(self):
+        """ return a list of (last use time, size in bytes, path) for the entries, oldest first
+        """
+        t = []
+        for name in os.listdir(self.folder):
+            if name.startswith('.'): continue
+            path = os.path.join(self.folder, name)
+            try:
+                size = sum(os.path.getsize(os.path.join(path,f)) for f in os.listdir(path))
+                t.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+        return sorted(t)
+
+    @property
+    def size(self):
+        """ total size in MB"""
+        return sum(e[1] for e in self.entries())/1e6
+
+    def purge(self):
+        """ if the total size is above maxsize, delete least recently used entries until it is 
+        below low_water*maxsize
+        """
+        if self.maxsize is None: return
+        t = self.entries()
+        total = sum(e[1] for e in t)/1e6
+        limit = self.low_water*self.maxsize if total > self.maxsize else total
+        while total > limit and len(t)>1:
+            mtime, size, path = t.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size/1e6
+            self.evicted +=1
+        self._size = total
+
+    def clear(self):
+        """ remove all entries """
+        for e in self.entries():
+            shutil.rmtree(e[2], ignore_errors=True)
+        self._size = None
+
+    def report(self, out=True):
+        """ summary of hits and misses; print it, or return the string if out is False"""
+        n = self.hits+self.misses
+        ret = 'folder %s: %d entries, %.1f MB; %d hits, %d misses (%.0f%%), %d evicted, %.1f s loading' % (
+            self.folder, len(self.entries()), self.size, self.hits, self.misses,
+            100.*self.hits/n if n>0 else 0, self.evicted, self.load_time)
+        if not out: return ret
+        print (ret)
@@ -236,6 +236,11 @@ class Localization(object):
         val= 2*(self.log_like(skydir)-self.maxlike)
         return val / self.factor
 
+    def TSmap_grid(self, skydirs):
+        """ return an array of TSmap values for a list of directions, evaluated together
+        """
+        return (self.tsm.grid(skydirs) - 2*self.maxlike) / self.factor
+
     # the following 3 functions are for a minimizer
     def get_parameters(self):
         return np.array([self.tsm.skydir.ra(), self.tsm.skydir.dec()])
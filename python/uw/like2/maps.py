@@ -9,8 +9,9 @@ import numpy as np
 import pandas as pd
 from skymaps import Band, SkyDir, PySkyFunction, Hep3Vector, PythonUtilities 
 from uw.like import Models
-from . import (sources, sedfuns, ) 
+from . import (sources, sedfuns, tools) 
 from uw.utilities import image
+from uw.utilities.healpix_index import make_index_table
 from uw.like2.pipeline import check_ts
 
 # the default nside
@@ -34,22 +35,6 @@ def PLSuperExpCutoff(*pars):
     sources.set_default_bounds(model)
     return model
 
-def make_index_table(nside=12, subnside=nside, usefile=True):
-    """create, and/or use a table to convert between different nside pixelizations
-    The indexing is RING
-    """
-    filename = os.path.expandvars('$FERMI/misc/index_table_%02d_%03d.pickle' % (nside, subnside) )
-    if os.path.exists(filename) and usefile:
-        return pickle.load(open(filename))
-    print ('generating index table for nside, subnside= %d %d' % (nside, subnside))
-    band, subband = Band(nside), Band(subnside)
-    npix, nsubpix = 12*nside**2, 12*subnside**2
-    t=np.array([band.index(subband.dir(i)) for i in range(nsubpix)])
-    a = np.arange(nsubpix)
-    index_table = [a[t==i] for i in range(npix)]
-    if usefile:
-        pickle.dump(index_table, open(filename,'w'))
-    return index_table  
 
 class CountsMap(dict):
     """ A map with counts per HEALPix bin """
@@ -96,24 +81,52 @@ def default_geom():
     g.nside = g.nside.astype(int)
     return g
 
+def band_counts_array(subdir, band_index, nside):
+    """ return a writable, memory-mapped full-sky float32 array of model counts for a band,
+    the file subdir/{band_index:02d}/counts.npy. If it does not exist, it is created filled with NaN.
+    It is written under a temporary name then linked, so that concurrent ROI jobs share one file.
+    Only for processes on a single host: with a file system shared between hosts, such as NFS, 
+    each host writes back whole pages, which would overwrite pixels written by the others.
+    """
+    subsubdir = subdir+'/{:02d}'.format(band_index)
+    if not os.path.exists(subsubdir):
+        try: os.makedirs(subsubdir)
+        except OSError: pass # another process made it
+    filename = subsubdir+'/counts.npy'
+    if not os.path.exists(filename):
+        tmp = filename+'.{}.tmp'.format(os.getpid())
+        a = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(12*nside**2,))
+        a[:] = np.nan
+        a.flush(); del a
+        try:
+            os.link(tmp, filename)
+        except OSError: pass # another process got there first
+        os.remove(tmp)
+    return np.load(filename, mmap_mode='r+')
+
 class ModelCountMaps(object):
     """ This is not the same as other map-producing classes here.
-    It makes, and saves, a list of predicted counts for all the pixels within the central
-    HEALPix pixel.
+    It makes, and saves, the predicted counts for all the pixels within the central
+    HEALPix pixel. They are written to a pickle file for each ROI and band, which 
+    simulation.BandCounts combines into a full-sky array, or, for a pool of processes on
+    a single host, directly into the full-sky array, see band_counts_array.
     """
     nside_array = np.ones(32,int) * 1024
     nside_array[:10] = 64,64, 128,64 ,256,128, 256,256, 512,512
 
-    def __init__(self, roi, nbands=None, bandlist=None,  subdir='model_counts'):
+    def __init__(self, roi, nbands=None, bandlist=None,  subdir='model_counts', shared=False):
         """
         roi : ROI object
             Expect it to behave like an array, indexed by the band index,
-            and each element is a SkyFunction, returning the count density.
+            and each element is a BandLike object, returning the count density.
         bandlist : list of int | None
             bands to process. If None, do them all
 
         subdir : string | None
             folder name to write results to
+        shared : bool
+            if set, write to the full-sky array for each band rather than the per-ROI pickle file.
+            Only for processes that run on the same host.
         """
         roi_index = Band(12).index(roi.roi_dir)  
 
@@ -129,18 +142,24 @@ class ModelCountMaps(object):
             dirfun = Band(nside).dir
             pixel_area = Band(nside).pixelArea()
             index_table = make_index_table(12, nside)
-            pix_ids = index_table[roi_index]
-            dirs = map(dirfun, pix_ids)
-            cnts = np.array(map(eb, dirs),np.float32) * pixel_area
-            assert sum(np.isnan(cnts))==0, 'NaN value(s) found'
+            pix_ids = np.asarray(index_table[roi_index])
+            dirs = list(map(dirfun, pix_ids))
+            cnts = (eb.values(dirs) * pixel_area).astype(np.float32)
             
             print ('{:4d} {:4d} {:6d} {:8.2e} {:8.2e} {:8.2e}'.format(
                 ebi,nside,len(cnts), cnts.mean(), cnts.min(), cnts.max()),)
-            if subdir is not None:
+            if subdir is not None and shared:
+                counts = band_counts_array(subdir, ebi, nside)
+                counts[pix_ids] = cnts
+                counts.flush(); del counts
+                print ('\t--> {}/{:02d}/counts.npy'.format(subdir, ebi))
+            elif subdir is not None:
                 subsubdir = subdir+'/{:02d}'.format(ebi)
-                if not os.path.exists(subsubdir): os.makedirs(subsubdir)
+                if not os.path.exists(subsubdir):
+                    try: os.makedirs(subsubdir)
+                    except OSError: pass # another process made it
                 outfile = subsubdir+'/HP12_{:04d}.pickle'.format(roi_index)
-                pickle.dump(cnts, open(outfile, 'w'))
+                pickle.dump(cnts, open(outfile, 'wb'))
                 print ('\t--> {}'.format(outfile))
             else:
                 print ('\t (not saved)')
@@ -330,13 +349,146 @@ class ResidualUpperLimit(ResidualTS):
                 return 0
  
 
+class FastResidualTS(object):
+    """ Residual TS for a batch of positions, with the rest of the model frozen
+    
+    The model pixels of each band are saved when created, and, for each position, only the normalization
+    of the test source is fit, by a Newton iteration done on all the positions of a batch at once.
+    The test source response is the same as a PointResponse: the PSF at the pixels, times the pixel area
+    and the expected counts from the band's exposure integral, and the PSF overlap for the total counts.
+    
+    Positions with TS above refit_ts are evaluated again with ResidualTS, which does a full refit.
+    """
+    def __init__(self, roi, **kwargs):
+        """
+        roi : a ROI_user object
+        model : a string
+            must evaluate to a Models.Model. e.g. 'LogParabola(6e-14, 1.2, 0, 4500)'
+        par_sets : list of list of float or None
+            if not None, sets of parameters to apply to the model
+        refit_ts : float or None
+            if not None, use ResidualTS for positions with at least this TS
+        batch_size : int
+            number of positions to evaluate together
+        """
+        self.roi = roi
+        self.kwargs = dict(model=kwargs.pop('model'), par_sets=kwargs.pop('par_sets', None))
+        self.model = eval(self.kwargs['model'])
+        self.pars = self.kwargs['par_sets']
+        self.refit_ts = kwargs.pop('refit_ts', 100)
+        self.batch_size = kwargs.pop('batch_size', 100)
+        self.exact = None # the ResidualTS object, if needed
+        
+        # save the current state of each band
+        self.bands = []
+        for blike in roi.selected:
+            band = blike.band
+            self.bands.append(dict(band=band,
+                data = np.asarray(blike.data, float),
+                background = np.array(blike.model_pixels, float),
+                pixels = tools.unit_vectors(blike.pixel_dirs) if blike.pixels>0 else np.zeros((0,3)),
+                exposure_factor = blike.exposure_factor,
+                unweight = blike.unweight,
+                ))
+        # expected counts for each band and set of parameters: shape (nsets, nbands)
+        par_sets = [None] if self.pars is None else self.pars
+        self.expected = np.empty((len(par_sets), len(self.bands)))
+        for i,pars in enumerate(par_sets):
+            if pars is not None: self.model.set_all_parameters(pars)
+            self.expected[i] = [b['band'].integrator(self.model) for b in self.bands]
+            
+    def reset(self):
+        if self.exact is not None:
+            self.exact.reset()
+            self.exact = None
+
+    def responses(self, skydirs):
+        """ return a list with, for each band, a tuple of 
+            the (npos, npix) array of PSF values times pixel area, and the array of overlaps
+        """
+        v = tools.unit_vectors(skydirs)
+        ret = []
+        for b in self.bands:
+            band = b['band']
+            overlap = np.array([band.psf.overlap(band.skydir, band.radius, sd) for sd in skydirs])
+            if len(b['data'])==0:
+                ret.append((None, overlap))
+                continue
+            delta = np.arccos(np.clip(np.dot(v, b['pixels'].T), -1, 1))
+            psf = np.asarray(band.psf(delta.ravel())).reshape(delta.shape)
+            ret.append( (psf*band.pixel_area, overlap) )
+        return ret
+
+    def fit(self, responses, expected, niter=50, tol=1e-6):
+        """ maximize the likelihood with respect to the normalization factor of the test source,
+        for each position
+        responses : list returned by self.responses
+        expected  : array of expected counts per band
+        returns array of TS values
+        """
+        npos = len(responses[0][1])
+        terms = []
+        total = np.zeros(npos) # d(log likelihood)/d alpha from the total counts: constant
+        for b, (pv, overlap), n in zip(self.bands, responses, expected):
+            u = b['unweight']
+            total += u * b['exposure_factor'] * n * overlap 
+            if pv is not None:
+                terms.append((u, b['data'], n*pv/b['background']))
+        def derivs(alpha):
+            f1, f2 = -total, np.zeros(npos)
+            for u, d, q in terms:
+                r = q/(1+alpha[:,None]*q)
+                f1 = f1 + u*np.dot(r, d)
+                f2 = f2 - u*np.dot(r**2, d)
+            return f1, f2
+        # the log likelihood is concave in alpha, and its derivative decreasing and convex, 
+        # so Newton iterations from alpha=0 increase monotonically to the maximum
+        alpha = np.zeros(npos)
+        f1, f2 = derivs(alpha)
+        active = f1>0
+        for i in range(niter):
+            if not np.any(active): break
+            step = np.where(active, -f1/np.where(f2<0, f2, -1), 0)
+            alpha += step
+            f1, f2 = derivs(alpha)
+            active &= (step > tol*alpha)
+        ts = -alpha*total
+        for u, d, q in terms:
+            ts += u*np.dot(np.log1p(alpha[:,None]*q), d)
+        return np.maximum(0, 2*ts)
+
+    def batch(self, skydirs):
+        """ return an array of TS values for a list of SkyDir objects,
+        with shape (npos,) or (npos, nsets) if par_sets is set
+        """
+        ts = np.empty((len(skydirs), len(self.expected)))
+        for start in range(0, len(skydirs), self.batch_size):
+            sdirs = skydirs[start:start+self.batch_size]
+            resp = self.responses(sdirs)
+            for j, expected in enumerate(self.expected):
+                ts[start:start+len(sdirs), j] = self.fit(resp, expected)
+        if self.refit_ts is not None:
+            for i in np.flatnonzero(np.any(ts>=self.refit_ts, axis=1)):
+                if self.exact is None:
+                    self.exact = ResidualTS(self.roi, **self.kwargs)
+                ts[i] = self.exact.tsfun(skydirs[i])
+        return ts[:,0] if self.pars is None else ts
+
+    def tsfun(self, skydir):
+        return self.batch([skydir])[0]
+
+    def __call__(self, v):
+        skydir = SkyDir(Hep3Vector(v[0],v[1],v[2]))
+        return self.tsfun(skydir)
+
+
 class ROItables(object):
     """ manage one or more tables of values subdividing a HEALpix roi
     
         skyfuns : list of 3-tuples
             the 3-tuples must have: (skyfunction, tablename, dict)
             Implemented now, and default here:
-                (ResidualTS,'ts',  dict(photon_index=2.0),) , 
+                (FastResidualTS,'ts',  dict(model='LogParabola(1e-13, 2.3, 0, 1000.)'),) , 
                 (KdeMap,    'kde', dict()),
             If skyfunction is a string, evaluate it 
     """
@@ -345,7 +497,7 @@ class ROItables(object):
         self.index_table = make_index_table(roi_nside, nside)
         self.subdirfun = Band(nside).dir
         self.skyfuns = kwargs.pop('skyfuns', 
-              ( (ResidualTS, 'ts', dict(photon_index=2.3),) , 
+              ( (FastResidualTS, 'ts', dict(model='LogParabola(1e-13, 2.3, 0, 1000.)'),) , 
                 (KdeMap,     'kde', dict()),
               ),
             )
@@ -355,7 +507,10 @@ class ROItables(object):
                     
     def process_table(self, skyfun, name, pos_list, outfile=None, **kwargs):
         sys.stdout.flush()
-        skytable = np.array([skyfun(p) for p in pos_list])
+        if hasattr(skyfun, 'batch'):
+            skytable = np.array(skyfun.batch(pos_list))
+        else:
+            skytable = np.array([skyfun(p) for p in pos_list])
         print (' min=%6.2e, max=%6.2e, mean=%6.2e ' \
             % (skytable.min(), skytable.max(),skytable.mean()) ,)
         if outfile is not None:
@@ -444,19 +599,19 @@ class DisplayTable(object):
         fig.set_facecolor('white')
         return zea
 
-table_info={'ts':  (ResidualTS, dict(model='LogParabola(1e-13, 2.2, 0, 1000.)')),
+table_info={'ts':  (FastResidualTS, dict(model='LogParabola(1e-13, 2.2, 0, 1000.)')),
             'kde': (KdeMap, dict()),
             'diffuse': (DiffuseMap, dict()),
-            'tsx': (ResidualTS, dict(model='LogParabola(1e-12, 2.3, 0, 1000.)')),
-            'tsp': (ResidualTS, dict(model='ExpCutoff(1e-13,1.3, 1500.)')),
-            'hard': (ResidualTS, dict( model='LogParabola(1e-15, 1.7, 0, 50000.)')),
-            'soft': (ResidualTS, dict(model='LogParabola(1e-12, 2.7, 0, 250.)')),
-            'peaked': (ResidualTS, dict(model='LogParabola(1e-14, 2.0, 0.5, 2000.)')),
+            'tsx': (FastResidualTS, dict(model='LogParabola(1e-12, 2.3, 0, 1000.)')),
+            'tsp': (FastResidualTS, dict(model='ExpCutoff(1e-13,1.3, 1500.)')),
+            'hard': (FastResidualTS, dict( model='LogParabola(1e-15, 1.7, 0, 50000.)')),
+            'soft': (FastResidualTS, dict(model='LogParabola(1e-12, 2.7, 0, 250.)')),
+            'peaked': (FastResidualTS, dict(model='LogParabola(1e-14, 2.0, 0.5, 2000.)')),
             'mspsens': (ResidualUpperLimit, dict(model='ExpCutoff(1e-13,1.2,2800.)')),
            'mspsens2': (ResidualUpperLimit, dict(model='ExpCutoff(1e-13,1.2,2800.)')),
-           'mspts': (ResidualTS, dict(model='ExpCutoff(1e-13,1.2, 2800.)')),
-            'mspts2': (ResidualTS, dict(model='ExpCutoff(1e-13,1.2, 2800.)')),
-            'all':  (ResidualTS, dict(model='LogParabola(1e-13, 2.2, 0, 1000.)', 
+           'mspts': (FastResidualTS, dict(model='ExpCutoff(1e-13,1.2, 2800.)')),
+            'mspts2': (FastResidualTS, dict(model='ExpCutoff(1e-13,1.2, 2800.)')),
+            'all':  (FastResidualTS, dict(model='LogParabola(1e-13, 2.2, 0, 1000.)', 
                     par_sets= [[1e-13, 1.7, 0,  50000.], #hard
                             [1e-13, 2.2, 0,   1000.], #flat
                             [1e-13, 2.7, 0,    250.], #soft
@@ -534,21 +689,6 @@ def assemble_tables(table_names, outputfile=None, folder= '.', nside=nside):
     f = HEALPixFITS(tables)
     f.write(os.path.join(folder,outputfile))
   
-def make_index_table(nside=12, subnside=nside, usefile=True):
-    """create, and/or use a table to convert between different nside pixelizations
-    """
-    filename = os.path.expandvars('$FERMI/misc/index_table_%02d_%03d.pickle' % (nside, subnside) )
-    if os.path.exists(filename) and usefile:
-        return pickle.load(open(filename))
-    print ('generating index table for nside, subnside= %d %d' % (nside, subnside))
-    band, subband = Band(nside), Band(subnside)
-    npix, nsubpix = 12*nside**2, 12*subnside**2
-    t=np.array([band.index(subband.dir(i)) for i in range(nsubpix)])
-    a = np.arange(nsubpix)
-    index_table = [a[t==i] for i in range(npix)]
-    if usefile:
-        pickle.dump(index_table, open(filename,'w'))
-    return index_table
 
 class MultiMap(object):
     
@@ -584,8 +724,7 @@ class MultiMap(object):
         index_table = make_index_table(roi_nside, nside)
         for index, pk in zip(i12,pklist):
             indeces = index_table[index]
-            for i,v in enumerate(pk):
-                mvec[indeces[i]] = v 
+            mvec[indeces[:len(pk)]] = pk
         bad = sum(mvec==fill)
         if np.any(bad)>0: print ('WARNING: %d pixels not filled in table %s' % (bad, tname))
         else:
@@ -0,0 +1,281 @@
+"""
+Columnar store of the all-sky model, for fast loading without unpickling the 1728 ROI records
+
+The store is the folder "model_store" in the model folder. It contains
+    parts/HP12_%04d.pickle : a small record for each ROI, written by to_healpix.pickle_dump along with
+        the full ROI pickle. It has the source columns, the spectral models, and the diffuse info,
+        but not the SED, profile, or association info
+and, after consolidate, which the pipeline runs when it makes pickle.zip:
+    sources.npy  : structured array, one row per source, ordered by ROI
+    diffuse.npy  : structured array, one row per global or extended source entry, ordered by ROI
+    roi_index.npy: for each ROI, the first row in sources.npy and diffuse.npy; the totals are the last row
+    objects.pickle : dict with lists of the spectral models, aligned with the rows of the two tables,
+        and the diffuse normalization dict for each ROI
+The tables are memory-mapped, so only the columns that are used are read.
+The names are unicode, widened as needed from the default widths in the dtypes, so they are not truncated.
+
+Create one for an existing model with ModelStore(folder).from_pickles().
+"""
+import os, glob, pickle, zipfile, time
+import numpy as np
+import pandas as pd
+from skymaps import SkyDir
+
+store_name = 'model_store'
+
+source_dtype = [
+    ('name', 'U40'), ('roi', 'i2'), ('ra', 'f8'), ('dec', 'f8'), ('isextended', '?'),
+    ('ts', 'f8'), ('band_ts', 'f8'), ('ts_beta', 'f4'), ('pivot_energy', 'f4'),
+    ('fixed_spectrum', '?'), ('modelname', 'U24'), ('npar', 'i1'),
+    ('pars', 'f8', (6,)), ('errs', 'f8', (6,)), ('free', '?', (6,)),
+    ('eflux', 'f8'), ('eflux_unc', 'f8'), ('ellipse', 'f8', (7,)),
+    ]
+diffuse_dtype = [('name', 'U40'), ('roi', 'i2'), ('modelname', 'U24'), ('npar', 'i1'),
+    ('pars', 'f8', (6,)), ('free', '?', (6,)),]
+
+def _str(s):
+    """ native str from a table entry: unicode, or bytes from a store made with the old dtypes"""
+    if isinstance(s, str): return s
+    return s.decode('utf-8') if isinstance(s, bytes) else s.encode('utf-8')
+
+def _text(s):
+    """ unicode for a name column """
+    return s.decode('utf-8') if isinstance(s, bytes) else s
+
+def _widen(dtype, **columns):
+    """ return dtype with the unicode fields in columns wide enough for the list of names """
+    return [(f[0], 'U%d' % max([int(f[1][1:])]+[len(t) for t in columns[f[0]]]))+f[2:]
+        if f[0] in columns else f for f in dtype]
+
+def _concatenate(tables):
+    """ concatenate structured arrays, using the widest version of each field """
+    dtype = [(name, max([t.dtype[name] for t in tables], key=lambda d: d.itemsize))
+        for name in tables[0].dtype.names]
+    return np.concatenate([t.astype(dtype) for t in tables])
+
+def _float(x, default=np.nan):
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return default
+
+def _model_columns(model, row, errors=False):
+    """ fill the model columns of row from a spectral model"""
+    n = min(model.len(), 6)
+    row['modelname'] = _text(model.name)
+    row['npar'] = n
+    row['pars'][:] = np.nan
+    row['pars'][:n] = model.parameters[:n]
+    free = np.asarray(model.free, bool)[:6]
+    row['free'][:len(free)] = free
+    if not errors: return
+    row['errs'][:] = np.nan
+    try:
+        d = np.diag(model.get_cov_matrix()).copy()[:n]
+        d[d<0] = 0
+        row['errs'][:n] = np.sqrt(d)
+    except Exception:
+        pass
+
+def roi_part(index, output):
+    """ return the store record for ROI index from an output dict created by to_healpix.pickle_dump
+    """
+    items = sorted(output.get('sources', {}).items())
+    rows = np.zeros(len(items), _widen(source_dtype, name=[_text(name) for name, item in items],
+        modelname=[_text(item['model'].name) for name, item in items]))
+    models = []
+    for row, (name, item) in zip(rows, items):
+        skydir, model = item['skydir'], item['model']
+        row['name'] = _text(name)
+        row['roi'] = index
+        row['ra'], row['dec'] = skydir.ra(), skydir.dec()
+        row['isextended'] = item.get('isextended', False)
+        row['ts'] = _float(item.get('ts'))
+        row['band_ts'] = _float(item.get('band_ts'))
+        row['ts_beta'] = _float(item.get('ts_beta'))
+        row['pivot_energy'] = _float(item.get('pivot_energy'))
+        row['fixed_spectrum'] = bool(item.get('fixed_spectrum', False))
+        _model_columns(model, row, errors=True)
+        eflux = item.get('eflux')
+        if eflux is not None:
+            eflux = np.atleast_1d(eflux)
+            row['eflux'] = eflux[0]
+            row['eflux_unc'] = eflux[1] if len(eflux)>1 else np.nan
+        else:
+            row['eflux'] = row['eflux_unc'] = np.nan
+        ellipse = item.get('ellipse')
+        row['ellipse'][:] = np.nan if ellipse is None else np.asarray(ellipse, float)[:7]
+        models.append(model)
+
+    names, dmodels = output.get('diffuse_names', []), output.get('diffuse', [])
+    drows = np.zeros(len(names), _widen(diffuse_dtype, name=[_text(name) for name in names],
+        modelname=[_text(model.name) for model in dmodels]))
+    for row, name, model in zip(drows, names, dmodels):
+        row['name'] = _text(name)
+        row['roi'] = index
+        _model_columns(model, row)
+    return dict(sources=rows, models=models, diffuse=drows, diffuse_models=list(dmodels),
+        diffuse_normalization=output.get('diffuse_normalization', None))
+
+def _dump(obj, filename, save=pickle.dump):
+    """ write to a temporary file, then rename, so that readers never see a partial file"""
+    tmp = filename+'.%d.tmp' % os.getpid()
+    with open(tmp, 'wb') as f:
+        save(f, obj) if save is np.save else save(obj, f)
+    os.rename(tmp, filename)
+
+
+class ModelStore(object):
+    """ Read or write the columnar store for the model in folder
+    """
+    def __init__(self, folder='.', nside=12):
+        self.folder = os.path.expandvars(folder)
+        self.path = os.path.join(self.folder, store_name)
+        self.nside = nside
+        self._objects = None
+        self._name_index = None
+
+    def __repr__(self):
+        return '%s.%s: %s' % (self.__module__, self.__class__.__name__, self.path)
+
+    def __len__(self):
+        return len(self.roi_index)-1
+
+    def part_filename(self, index):
+        return os.path.join(self.path, 'parts', 'HP%02d_%04d.pickle' % (self.nside, index))
+
+    def filename(self, name):
+        return os.path.join(self.path, name)
+
+    def write_roi(self, index, output):
+        """ save the record for ROI index, from the output dict of to_healpix.pickle_dump"""
+        folder = os.path.join(self.path, 'parts')
+        if not os.path.exists(folder):
+            try: os.makedirs(folder)
+            except OSError: pass # another process made it
+        _dump(roi_part(index, output), self.part_filename(index))
+
+    def from_pickles(self, quiet=False):
+        """ create the parts from pickle.zip, or the pickle folder, then consolidate """
+        zipname = os.path.join(self.folder, 'pickle.zip')
+        if os.path.exists(zipname):
+            z = zipfile.ZipFile(zipname)
+            files = sorted(n for n in z.namelist() if n.endswith('.pickle'))
+            opener = z.open
+        else:
+            files = sorted(glob.glob(os.path.join(self.folder, 'pickle', '*.pickle')))
+            opener = lambda f: open(f, 'rb')
+        assert len(files)>0, 'No pickle files found in %s' % self.folder
+        for f in files:
+            self.write_roi(int(os.path.splitext(f)[0][-4:]), pickle.load(opener(f)))
+        self.consolidate(quiet=quiet)
+
+    def consolidate(self, quiet=False):
+        """ combine the parts into the tables"""
+        t = time.time()
+        files = sorted(glob.glob(os.path.join(self.path, 'parts', '*.pickle')))
+        nroi = 12*self.nside**2
+        assert len(files)==nroi, 'Expected %d ROI records in %s, found %d' % (nroi, self.path, len(files))
+        parts = [pickle.load(open(f, 'rb')) for f in files]
+        sources = _concatenate([p['sources'] for p in parts])
+        diffuse = _concatenate([p['diffuse'] for p in parts])
+        roi_index = np.zeros((nroi+1, 2), np.int32)
+        roi_index[1:,0] = np.cumsum([len(p['sources']) for p in parts])
+        roi_index[1:,1] = np.cumsum([len(p['diffuse']) for p in parts])
+        objects = dict(
+            models=sum([p['models'] for p in parts], []),
+            diffuse_models=sum([p['diffuse_models'] for p in parts], []),
+            diffuse_normalization=[p['diffuse_normalization'] for p in parts],
+            )
+        _dump(objects, self.filename('objects.pickle'))
+        for name, a in (('sources', sources), ('diffuse', diffuse), ('roi_index', roi_index)):
+            _dump(a, self.filename(name+'.npy'), np.save)
+        self._objects = self._name_index = None
+        for name in ('sources', 'diffuse', 'roi_index'):
+            self.__dict__.pop(name, None)
+        if not quiet:
+            print ('Model store %s: %d sources, %d diffuse entries from %d ROIs, %.1f s' % (
+                self.path, len(sources), len(diffuse), nroi, time.time()-t))
+
+    def is_current(self, reference=None):
+        """ True if the tables exist, and are at least as new as the parts and the reference
+        reference : None, or the name of the pickle.zip file or the folder with the ROI pickles
+        """
+        fname = self.filename('roi_index.npy')
+        if not os.path.exists(fname): return False
+        mtime = os.path.getmtime(fname)
+        newer = [f for f in glob.glob(os.path.join(self.path, 'parts', '*.pickle'))
+            if os.path.getmtime(f)>mtime]
+        if reference is not None and os.path.exists(reference):
+            refs = glob.glob(os.path.join(reference, '*.pickle')) if os.path.isdir(reference) else [reference]
+            newer += [f for f in refs if os.path.getmtime(f)>mtime]
+        return len(newer)==0
+
+    def __getattr__(self, name):
+        # load a table on first reference
+        if name not in ('sources', 'diffuse', 'roi_index'):
+            raise AttributeError(name)
+        t = np.load(self.filename(name+'.npy'), mmap_mode='r')
+        self.__dict__[name] = t
+        return t
+
+    @property
+    def objects(self):
+        if self._objects is None:
+            with open(self.filename('objects.pickle'), 'rb') as f:
+                self._objects = pickle.load(f)
+        return self._objects
+
+    def roi_slices(self, index):
+        """ return the slices into the sources and diffuse tables for ROI index"""
+        a, b = self.roi_index[index], self.roi_index[index+1]
+        return slice(a[0], b[0]), slice(a[1], b[1])
+
+    def index(self, name):
+        """ return the row in the source table for a source name """
+        if self._name_index is None:
+            names = self.sources['name']
+            self._name_index = dict((_str(n), i) for i, n in enumerate(names))
+        return self._name_index[name]
+
+    def diffuse_normalization(self, index=None):
+        """ the diffuse normalization dict for ROI index, or a list for all ROIs"""
+        dn = self.objects['diffuse_normalization']
+        return dn if index is None else dn[index]
+
+    def dataframe(self, columns=None):
+        """ return a DataFrame, indexed by source name, with the selected columns of the source table.
+        Columns with multiple values per source, like pars, are entered as arrays
+        """
+        t = self.sources
+        columns = columns or [n for n in t.dtype.names if n!='name']
+        d = dict()
+        for col in columns:
+            v = np.asarray(t[col])
+            d[col] = list(v) if v.ndim>1 else v
+            if v.dtype.kind in 'SU': d[col] = [_str(x) for x in v]
+        return pd.DataFrame(d, index=[_str(n) for n in t['name']], columns=columns)
+
+    def records(self):
+        """ generate (index, dict) for each ROI, with the keys of the pickled ROI record
+        used by skymodel.SkyModel: sources, with skydir, model, ts, band_ts, isextended, ellipse,
+        and diffuse_names, diffuse, diffuse_normalization
+        """
+        t = self.sources
+        names, ra, dec = t['name'], np.asarray(t['ra']), np.asarray(t['dec'])
+        ts, band_ts, isext = np.asarray(t['ts']), np.asarray(t['band_ts']), np.asarray(t['isextended'])
+        ellipse = np.asarray(t['ellipse'])
+        dnames = self.diffuse['name']
+        models, dmodels = self.objects['models'], self.objects['diffuse_models']
+        for index in range(len(self)):
+            s, d = self.roi_slices(index)
+            sources = dict()
+            for i in range(s.start, s.stop):
+                e = ellipse[i]
+                sources[_str(names[i])] = dict(skydir=SkyDir(ra[i], dec[i]), model=models[i],
+                    ts=float(ts[i]), band_ts=float(band_ts[i]), isextended=bool(isext[i]),
+                    ellipse=None if np.all(np.isnan(e)) else e)
+            yield index, dict(sources=sources,
+                diffuse_names=[_str(n) for n in dnames[d]],
+                diffuse=dmodels[d],
+                diffuse_normalization=self.diffuse_normalization(index))
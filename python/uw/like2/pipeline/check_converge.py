@@ -12,7 +12,7 @@ import os, sys, glob, zipfile, logging, datetime, argparse, subprocess
 import numpy as np
 import pandas as pd
 
-from uw.like2 import (tools, maps, seeds,)
+from uw.like2 import (tools, maps, seeds, model_store,)
 from uw.like2.pipeline import (pipe, stream, stagedict, check_ts, )
 from uw.utilities import healpix_map
 
@@ -101,8 +101,11 @@ def main(args):
     next_stage = stagedict.stagenames[stage].get('next', None)
 
     
-    # always update the pickle for the ROIs, if changed
+    # always update the pickle for the ROIs, if changed, and the model store made from them
     make_zip('pickle')
+    store = model_store.ModelStore(absskymodel)
+    if len(glob.glob(os.path.join(store.path, 'parts', '*.pickle')))==1728 and not store.is_current():
+        store.consolidate()
     
     if stage=='update' or  stage=='betafix':
         logto = open(os.path.join(absskymodel,'converge.txt'), 'a')
@@ -68,6 +68,7 @@ def plot(localizer, name=None, center=None, size=0.5, pixelsize=None, outdir=Non
     tsfits = kwargs.pop('tsfits', False)
     tsp = image.TSplot(localizer.TSmap, sdir, size, 
                 pixelsize=pixelsize if pixelsize is not None else size/20. , 
+                grid=getattr(localizer, 'TSmap_grid', None),
                 axes=axes, galactic=galactic, galmap=galmap, galpos=galpos, **kwargs)
     if hasattr(source, 'ellipse') and source.ellipse is not None and not nooverplot: 
         loc = source.ellipse
@@ -8,9 +8,9 @@ import pickle
 import numpy as np
 import pandas as pd
 from scipy import optimize
-from skymaps import SkyDir, Band
+from skymaps import SkyDir, Band, WeightedSkyDirList
 from uw.utilities import keyword_options
-from uw.like2 import (main, tools, sedfuns, maps, sources, localization, roimodel, seeds, fit_diffuse,)
+from uw.like2 import (main, tools, sedfuns, maps, sources, localization, roimodel, seeds, fit_diffuse, diffuse,)
 
 
 
@@ -95,6 +95,91 @@ class Process(main.MultiROI):
             self.process()
         finally:
             if outtee is not None: outtee.close()
+
+    def roi_pixel_counts(self, roi_list):
+        """ return an array with the total number of data pixels, over all bands, for each ROI in roi_list
+        Used as an estimate of the relative processing time
+        """
+        dset = self.config.dataset
+        dset.load()
+        radius = np.radians(self.roi_radius)
+        cbands = list(dset.dmap) # each creates a C++ Band: only once
+        counts = np.zeros(len(roi_list), int)
+        for i, index in enumerate(roi_list):
+            roi_dir = Band(12).dir(int(index))
+            for cband in cbands:
+                counts[i] += len(WeightedSkyDirList(cband, roi_dir, radius, False))
+        return counts
+
+    @property
+    def roi_radius(self):
+        """ the radius (deg) used for the ROI bands: from the configured ROI if set, 
+        otherwise the bands.BandSet default for the HEALPix ROIs """
+        spec = self.config.roi_spec
+        return spec.radius if spec is not None and getattr(spec, 'radius', None) is not None else 5
+
+    def run_many(self, roi_list=range(1728), workers=None, costs=None, maxtasksperchild=None):
+        """ process a set of ROIs with a local pool of worker processes
+        
+        The configuration, diffuse models, IRFs and binned data are loaded once by this process 
+        before the pool is created, so the forked workers share them copy-on-write.
+        ROIs are queued largest first, and each idle worker takes the next one, so that the large
+        ROIs in the Galactic plane do not end up at the end of the run.
+        The output of each ROI is captured in its log file; pickles are written as each ROI finishes.
+        
+        roi_list : list of int
+        workers : int | None
+            number of processes; if None, use all cores
+        costs : array of float | None
+            relative cost for each ROI, used for ordering. If None, use the number of data pixels
+        maxtasksperchild : int | None
+            passed to the Pool, to limit growth of the workers
+            
+        returns a DataFrame with the time and status for each ROI, indexed by the ROI number
+        """
+        import multiprocessing
+        global _process
+        roi_list = np.asarray(roi_list, int)
+        # make sure that all state shared by the ROIs is loaded before forking 
+        self.config.dataset.load()
+        dmap = self.config.dataset.dmap
+        if hasattr(dmap, 'select_rois') and len(roi_list)<1728:
+            # each worker only loads data pixels that these ROIs will use; select_rois adds the 
+            # pixel size. The selection is not applied here, so the data of this process are unchanged
+            initializer, initargs = _select_rois, (roi_list, self.roi_radius)
+        else:
+            initializer, initargs = None, ()
+        for name, value in self.config.diffuse.items():
+            if value is None: continue
+            for dmodel in diffuse.diffuse_factory(value, event_type_names=self.config.event_type_names):
+                dmodel.load()
+        if costs is None:
+            costs = self.roi_pixel_counts(roi_list)
+        order = roi_list[np.argsort(-np.asarray(costs), kind='mergesort')]
+        if self.outdir is not None:
+            # for the logs of ROIs that fail in setup, before process_roi creates it
+            logpath = os.path.join(self.outdir, 'log')
+            if not os.path.exists(logpath): os.makedirs(logpath)
+        _process = self
+        pool = multiprocessing.get_context('fork').Pool(workers, initializer=initializer, initargs=initargs,
+            maxtasksperchild=maxtasksperchild)
+        t0 = time.time()
+        results = []
+        try:
+            for k, (index, status, elapsed) in enumerate(pool.imap_unordered(_process_one, order, chunksize=1)):
+                results.append((index, status, elapsed))
+                print ('{:4d}/{:4d} HP12_{:04d}: {:6.1f} s  {}'.format(k+1, len(order), index, elapsed, status))
+                sys.stdout.flush()
+        finally:
+            pool.close()
+            pool.join()
+            _process = None
+        print ('Processed {} ROIs in {:.0f} s'.format(len(results), time.time()-t0))
+        df = pd.DataFrame(results, columns=['roi', 'status', 'time']).set_index('roi').sort_index()
+        failed = df[df.status!='ok']
+        if len(failed)>0:
+            print ('{} ROIs failed: {}'.format(len(failed), list(failed.index)))
+        return df
         
         
     def process(self):
@@ -144,7 +229,9 @@ class Process(main.MultiROI):
                     write_pickle(self) # make sure to update anyway
                     return
         if self.model_counts is not None:
-            maps.ModelCountMaps(self, bandlist=self.model_counts, subdir='model_counts' )
+            # a run_many pool is on a single host, so the ROIs can share the full-sky arrays
+            maps.ModelCountMaps(self, bandlist=self.model_counts, subdir='model_counts', 
+                shared=_process is self)
             return
 
         if self.psc_flag:
@@ -468,6 +555,37 @@ def fix_spectra(roi):
         src.fixed_spectrum=True
 
 
+# the Process object used by the workers of Process.run_many, inherited when the pool forks
+_process = None
+
+def _select_rois(roi_list, radius):
+    """ initializer for the workers of Process.run_many: restrict the data pixels of the 
+    worker's copy of the binned data to the ROIs in roi_list
+    """
+    _process.config.dataset.dmap.select_rois(roi_list, radius=radius)
+
+def _process_one(index):
+    """ worker function for Process.run_many: process a single ROI, with the output, 
+    including any traceback, only to the log file 
+    """
+    import traceback
+    t = time.time()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        _process.process_roi(index)
+        status = 'ok'
+    except Exception as msg:
+        status = 'failed: {}'.format(msg)
+        if _process.outdir is not None:
+            with open(os.path.join(_process.outdir, 'log', 'HP12_%04d.txt' % index), 'a') as log:
+                traceback.print_exc(file=log)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return index, status, time.time()-t
+
+
 class BatchJob(Process):
     """special interface to be called from uwpipeline
     Expect current dir to be output dir.
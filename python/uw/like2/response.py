@@ -10,7 +10,9 @@ import pandas as pd
 import healpy
 import skymaps
 from uw.utilities import keyword_options
-from . import convolution, diffuse
+from uw.utilities import convolution as utilities_convolution
+from uw.like import SpatialModels
+from . import convolution, diffuse, diffuse_cache, tools
 
 class ResponseException(Exception): pass
 
@@ -26,6 +28,7 @@ extended_grid_defaults = [
         ['pixelsize', 0.2, 'Size of pixels to use for convolution grid'],
         ('size',      14,  'Size of grid; npix set to size/pixelsize'),
         ('quiet',     False, ''),
+        ('analytic',  False, 'Use Hankel transforms for radially symmetric spatial models, rather than fill and FFT'),
         ]
 
 class Response(object):
@@ -69,10 +72,54 @@ class Response(object):
     def exposure_integral(self):
         """Integral of the exposure times the flux at the given position"""
         return self.band.integrator(self.source.model)
+
+    def grad_terms(self, exposure_factor=1):
+        """ return the tuple (g, apterm) needed for the gradient, where
+            g : array of the derivatives of the spectral normalization wrt the free parameters
+            apterm : the aperture term, to which the weighted sum of the pixel values is compared
+        """
+        raise NotImplementedError('{} has no grad_terms'.format(self.__class__.__name__))
+
+    def grad(self, weights, exposure_factor=1): 
+        """ contribution to the overall gradient
+        weights : arrary of float
+            weights = self.data / self.model_pixels
+        """
+        g, apterm = self.grad_terms(exposure_factor)
+        if len(g)==0: return []
+        pixterm = (weights*self.pixel_values).sum() if self.band.has_pixels else 0
+        return g * (apterm - pixterm)
+
+    def hess_terms(self, exposure_factor=1, delta=1e-6):
+        """ return the tuple (g, apterm, dg) for the hessian, where g, apterm are from grad_terms,
+        and dg is the matrix of derivatives of g with respect to the free parameters.
+        Only the spectral model is differenced: the pixel values are not changed.
+        """
+        g, apterm = self.grad_terms(exposure_factor)
+        if len(g)==0: return g, apterm, np.zeros((0,0))
+        model = self.spectral_model
+        pars = model.get_parameters()
+        t = []
+        for i in range(len(pars)):
+            p = pars.copy(); p[i] += delta
+            model.set_parameters(p)
+            self.evaluate()
+            t.append( (self.grad_terms(exposure_factor)[0]-g)/delta )
+        model.set_parameters(pars) # restore
+        self.evaluate()
+        return g, apterm, np.array(t)
     
     def __call__(self, skydir):
         """return the counts/sr for the source at the position"""
         raise NotImplemented
+        
+    def values(self, skydirs, vecs=None):
+        """return an array of the counts/sr for the source at each of a list of positions
+        vecs : None | array, shape (n,3)
+            unit vectors for the positions, if already calculated
+        Subclasses evaluate all positions at once; this default calls __call__ for each
+        """
+        return np.array([self(sd) for sd in skydirs], float)
     @property
     def spectral_model(self):
         return self.source.model
@@ -83,8 +130,11 @@ class NoResponse(Response):
     def initialize(self): 
         self.counts=0
         self.pix_counts=0
+        self.pix_norm=0
     def __call__(self, skydir):
         return 0.
+    def values(self, skydirs, vecs=None):
+        return np.zeros(len(skydirs))
 
 class PointResponse(Response):
     """Manage predictions of the response of a point source
@@ -131,34 +181,33 @@ class PointResponse(Response):
         assert not np.isinf(self.expected), 'model integration failure'
         self.counts =  self.expected * self.overlap
         self.model_grad = self.band.integrator( model.gradient)[model.free] #* self.exposure_ratio
+        self.pix_norm = self.expected
         if self.band.has_pixels:
             self.pix_counts = self.pixel_values * self.expected
         
-    def grad(self, weights, exposure_factor=1): 
-        """ contribution to the overall gradient
-        weights : arrary of float
-            
-            weights = self.data / self.model_pixels
-        Assume that evaluate has set model_grad
+    def grad_terms(self, exposure_factor=1): 
+        """ Assume that evaluate has set model_grad
         """
-        if not self.active: return None # don't expect to be called
         model = self.spectral_model
-        if np.sum(model.free)==0 : return []
-        # Calculate the gradient of a spectral model (wrt its parameters) integrated over the exposure.
-        #g = self.band.integrator( model.gradient)[model.free] #* self.exposure_ratio
-        g = self.model_grad
-        apterm = exposure_factor* self.overlap
-        pixterm = (weights*self.pixel_values).sum() if self.band.has_pixels else 0
-        return g * (apterm - pixterm)
+        if not self.active or np.sum(model.free)==0 : return np.array([]), 0
+        # the gradient of a spectral model (wrt its parameters) integrated over the exposure.
+        return self.model_grad, exposure_factor* self.overlap
 
     def __call__(self, skydir):
         if not self.active: return 0
         return self.band.psf(skydir.difference(self.source.skydir))[0]  * self.expected
+
+    def values(self, skydirs, vecs=None):
+        if not self.active: return np.zeros(len(skydirs))
+        if vecs is None: vecs = tools.unit_vectors(skydirs)
+        cosines = np.dot(vecs, tools.unit_vectors([self.source.skydir])[0])
+        return np.asarray(self.band.psf(np.arccos(np.clip(cosines,-1,1)))) * self.expected
      
 
     
 class DiffuseResponse(Response):
         
+    cacheable = True # use diffuse_cache, if enabled
     defaults = diffuse_grid_defaults
     @keyword_options.decorate(defaults)
     def __init__(self, source, band, roi, **kwargs):
@@ -179,6 +228,7 @@ class DiffuseResponse(Response):
         
         roi_index = skymaps.Band(12).index(self.roicenter)
         self._keyword_check(roi_index)
+        key = entry = None
         if getattr(self, 'preconvolved', False):
             #print ('Using preconvolved')
             c = self.roicenter
@@ -197,23 +247,43 @@ class DiffuseResponse(Response):
             self.ap_average = self.evalpoints(dirs).mean()
         
         else:
-            self.create_grid() # will raise exception if no overlap
-            grid = self.grid
-            inside = grid.dists< self.band.radius_in_rad
-            self.ap_average = grid.cvals[inside].mean()
+            cache = diffuse_cache.cache if self.cacheable else None
+            key = cache.key(self) if cache is not None else None
+            entry = cache.get(key) if key is not None else None
+            if entry is not None:
+                # use the convolved grid and pixel values from the cache
+                grid = self.grid = convolution.ConvolvableGrid(center=self.roicenter, 
+                    npix=self.grid_npix, pixelsize=self.pixelsize)
+                grid.cvals = entry['cvals']
+                self.ap_average = entry['ap_average']
+            else:
+                self.create_grid() # will raise exception if no overlap
+                grid = self.grid
+                inside = grid.dists< self.band.radius_in_rad
+                self.ap_average = grid.cvals[inside].mean()
             self.evalpoints = lambda dirs : grid(dirs, grid.cvals)
 
         self.delta_e = self.band.emax - self.band.emin
         self.factor = self.ap_average * self.band.solid_angle * self.delta_e
         if self.band.has_pixels:
-            self.pixel_values = self.evalpoints(self.band.wsdl) * self.band.pixel_area * self.delta_e
+            if entry is not None and 'pixel_values' in entry:
+                self.pixel_values = np.array(entry['pixel_values'])
+            else:
+                self.pixel_values = self.evalpoints(self.band.wsdl) * self.band.pixel_area * self.delta_e
+        if key is not None and entry is None:
+            cache.put(key, self.ap_average, self.grid.cvals, 
+                self.pixel_values if self.band.has_pixels else None)
 
         self.evaluate()
+
+    @property
+    def grid_npix(self):
+        return self.npix if self.energy>1000 else self.npix2
         
     def create_grid(self):
         # create a grid for evaluating counts integral over ROI, individual pixel predictions
         grid = self.grid= convolution.ConvolvableGrid(center=self.roicenter, 
-                npix=self.npix if self.energy>1000 else self.npix2, 
+                npix=self.grid_npix, 
                 pixelsize=self.pixelsize)
         # this may be overridden
         self.fill_grid()
@@ -235,24 +305,24 @@ class DiffuseResponse(Response):
     def evaluate(self):
         norm = self.source.model(self.band.energy)
         self.counts = norm * self.factor
+        self.pix_norm = norm
         if self.band.has_pixels:
             self.pix_counts = self.pixel_values * norm
 
-    def grad(self, weights, exposure_factor=1): 
-        """ contribution to the overall gradient
-        weights : arrary of float
-            weights = self.data / self.model_pixels
-        """
+    def grad_terms(self, exposure_factor=1): 
         model = self.spectral_model
         if np.sum(model.free)==0 : 
-            return []
-        pixterm = ( self.pixel_values * weights ).sum() if self.band.has_pixels else 0
-        return (self.factor*exposure_factor - pixterm) * model.gradient(self.energy)[model.free] 
+            return np.array([]), 0
+        return model.gradient(self.energy)[model.free], self.factor*exposure_factor
         
     def __call__(self, skydir):
         self.dmodel.setEnergy(self.band.energy) # needed if convolved
         return self.evalpoints([skydir])[0] * self.delta_e
 
+    def values(self, skydirs, vecs=None):
+        self.dmodel.setEnergy(self.band.energy) # needed if convolved
+        return np.asarray(self.evalpoints(list(skydirs))) * self.delta_e
+
     def _keyword_check(self, roi_index):
         # check for extra keywords from diffuse spec.
         dfun = self.dmodel
@@ -298,7 +368,8 @@ class DiffuseResponse(Response):
         """
         if scale_factor != 1.:
             self.factor *= scale_factor
-            self.pixel_values *= scale_factor
+            # a new array, so that a packed BandLike sees the change
+            self.pixel_values = self.pixel_values * scale_factor
             self.corr *= scale_factor
             self.evaluate()
         return self.corr #new total correction
@@ -390,6 +461,7 @@ class DiffuseCorrection(object):
         
 class CachedDiffuseResponse(DiffuseResponse):
         
+    cacheable = False # already cached
     def create_grid(self):
         """ set up the grid from the cached files """
         
@@ -447,11 +519,11 @@ class IsotropicResponse(DiffuseResponse):
             self.source.model.ct=self.band.event_type
         super(IsotropicResponse, self).evaluate()
             
-    def grad(self, weights, exposure_factor=1): 
+    def grad_terms(self, exposure_factor=1): 
         # deal with FrontBackConstant case, which uses different conatants for front/back
         if hasattr(self.source.model, 'ct'): # bit ugly
             self.source.model.ct=self.band.event_type
-        return super(IsotropicResponse, self).grad(weights, exposure_factor)
+        return super(IsotropicResponse, self).grad_terms(exposure_factor)
 
 
     def fill_grid(self):
@@ -499,6 +571,7 @@ class ExtendedResponse(DiffuseResponse):
             defaults['npix'] = int(npix) | 1 # make odd
             #print ('setting npix', defaults)
         self.quiet=defaults.get('quiet', True)
+        self.analytic = defaults.pop('analytic')
         self.initialized = False
         super(ExtendedResponse, self).__init__(source, band, roi, **defaults)
             
@@ -546,9 +619,35 @@ class ExtendedResponse(DiffuseResponse):
         if not hasattr(self.source, 'grid'):
             self.source.grid = convolution.ConvolvableGrid(self.center, pixelsize=self.pixelsize, npix=self.npix)
         self.grid =self.source.grid
+        if self.radial: return # no need to fill
         self.dm_vals = self.grid.fill(self.source.dmodel)
         self.dm_vals/= (self.dm_vals.sum() * np.radians(self.pixelsize)**2) 
 
+    @property
+    def radial(self):
+        """ True if the convolution uses Hankel transforms """
+        return self.analytic and isinstance(self.source.dmodel, SpatialModels.RadiallySymmetricModel)
+
+    def hankel(self):
+        """ return the HankelConvolution object for the band PSF, which the source owns, like the grid.
+        It extends to twice the grid half-diagonal, to include the PSF tails, unless that is too 
+        many points for a step small compared with the PSF and source sizes: then it is reduced, but 
+        includes the source and ten times the PSF r68.
+        """
+        if not hasattr(self.source, 'hankel'):
+            self.source.hankel = dict()
+        rmax, npoints = 2*self.grid.dists.max(), 2048
+        psf_r68 = getattr(self.band.psf, 'r68', None)
+        if psf_r68 is not None:
+            dmodel = self.source.dmodel
+            rmax, npoints = utilities_convolution.HankelConvolution.sampling(
+                np.radians(min(psf_r68, dmodel.r68())), rmax,
+                rmin=np.radians(dmodel.effective_edge()+10*psf_r68))
+        key = (self.band.event_type, round(self.band.energy,3), round(rmax,6), npoints)
+        if key not in self.source.hankel:
+            self.source.hankel[key] = utilities_convolution.HankelConvolution(self.band.psf, rmax, npoints)
+        return self.source.hankel[key]
+
     def overlap_mask(self):
         """ 
         return a npix x npix array of bools for the part of the grid, which is centered on the source,
@@ -578,9 +677,15 @@ class ExtendedResponse(DiffuseResponse):
         self.grid.psf_fill(self.band.psf)
         
         # now look at values, decide if want to convolve    
-        exp_grid = self.grid.fill(self.band.exposure) # this is expensive, 1.6 s for npix=201
-        self.grid.bg_vals = exp_grid * self.dm_vals
-        self.grid.convolve()  
+        # filling is expensive, 1.6 s for npix=201: use the cache, shared by bands and ROIs, if enabled
+        cache = convolution.exposure_grids
+        exp_grid = cache(self.grid, self.band) if cache is not None else self.grid.fill(self.band.exposure)
+        if self.radial:
+            # the exposure is taken to vary slowly enough to multiply the convolved profile
+            self.grid.cvals = exp_grid * self.hankel()(self.source.dmodel, self.grid.dists)
+        else:
+            self.grid.bg_vals = exp_grid * self.dm_vals
+            self.grid.convolve()  
         
         # save a copy of cvals for this band
         self.cvals = self.grid.cvals.copy()
@@ -620,23 +725,16 @@ class ExtendedResponse(DiffuseResponse):
             return
         total_counts = self.exposure_integral()
         self.counts = total_counts * self.factor
+        self.pix_norm = total_counts
         if self.band.has_pixels:
             self.pix_counts = self.pixel_values * total_counts
         
-    def grad(self, weights, exposure_factor=1): 
-        """ contribution to the overall gradient
-        weights : arrary of float
-            weights = self.data / self.model_pixels
-        """
+    def grad_terms(self, exposure_factor=1): 
         model = self.spectral_model
         if np.sum(model.free)==0 : 
-            return []
-        #pixterm = ( self.pixel_values * weights ).sum() * self.exposure_at_center if self.band.has_pixels else 0
-        #return (self.factor*exposure_factor - pixterm) * model.gradient(self.energy)[model.free] 
+            return np.array([]), 0
         g = self.band.integrator( model.gradient)[model.free] #* self.exposure_ratio
-        apterm = exposure_factor * self.factor #self.overlap
-        pixterm = (weights*self.pixel_values).sum() if self.band.has_pixels else 0
-        return g * (apterm - pixterm)
+        return g, exposure_factor * self.factor #self.overlap
 
     def __call__(self, skydir, force=False):
         """ return value of perhaps convolved grid for the position
@@ -644,6 +742,10 @@ class ExtendedResponse(DiffuseResponse):
         """
         if not self.active: return 0
         return self.grid(skydir, self.cvals) / self.exposure_at_center * self.counts/self.factor
+
+    def values(self, skydirs, vecs=None):
+        if not self.active: return np.zeros(len(skydirs))
+        return np.asarray(self(list(skydirs)))
         
     def __repr__(self):
         return '%s.%s: \n\tsource: %s\n\tband  : %s\n\tpixelsize: %.1f, npix: %d' % (
@@ -747,19 +849,15 @@ class AllSkyDiffuse(Response):
     def evaluate(self):
         norm = self.source.model(self.band.energy)
         self.counts = norm * self.factor
+        self.pix_norm = norm
         if self.band.has_pixels:
             self.pix_counts = self.pixel_values * norm
 
-    def grad(self, weights, exposure_factor=1): 
-        """ contribution to the overall gradient
-        weights : arrary of float
-            weights = self.data / self.model_pixels
-        """
+    def grad_terms(self, exposure_factor=1): 
         model = self.spectral_model
         if np.sum(model.free)==0 : 
-            return []
-        pixterm = ( self.pixel_values * weights ).sum() if self.band.has_pixels else 0
-        return (self.factor*exposure_factor - pixterm) * model.gradient(self.energy)[model.free] 
+            return np.array([]), 0
+        return model.gradient(self.energy)[model.free], self.factor*exposure_factor
         
     def __call__(self, skydir):
         assert False
@@ -800,7 +898,8 @@ class AllSkyDiffuse(Response):
         """
         if scale_factor != 1.:
             self.factor *= scale_factor
-            self.pixel_values *= scale_factor
+            # a new array, so that a packed BandLike sees the change
+            self.pixel_values = self.pixel_values * scale_factor
             self.corr *= scale_factor
             self.evaluate()
         return self.corr #new total correction
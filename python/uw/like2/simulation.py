@@ -8,25 +8,11 @@ import pickle
 import numpy as np
 import pandas as pd
 from skymaps import Band
+from uw.utilities.healpix_index import make_index_table
 from ..data import binned_data
 from . import configuration
 from astropy.io import fits
 
-def make_index_table(nside=12, subnside=512, usefile=True):
-    """create, and/or use a table to convert between different nside pixelizations
-    """
-    filename = os.path.expandvars('$FERMI/misc/index_table_%02d_%03d.pickle' % (nside, subnside) )
-    if os.path.exists(filename) and usefile:
-        return pickle.load(open(filename))
-    print ('generating index table for nside, subnside= %d %d' % (nside, subnside))
-    band, subband = Band(nside), Band(subnside)
-    npix, nsubpix = 12*nside**2, 12*subnside**2
-    t=np.array([band.index(subband.dir(i)) for i in range(nsubpix)])
-    a = np.arange(nsubpix)
-    index_table = [a[t==i] for i in range(npix)]
-    if usefile:
-        pickle.dump(index_table, open(filename,'w'))
-    return index_table
     
 def default_geom():
     """return a DataFrame with indexed by the band, containing emin, emax, event_type, nside
@@ -77,20 +63,22 @@ class ModelCountMaps(object):
             pixel_area = Band(nside).pixelArea()
             index_table = make_index_table(12, nside)
             pix_ids = index_table[roi_index]
-            dirs = map(dirfun, pix_ids)
-            cnts = np.array(map(eb, dirs),np.float32) * pixel_area
+            dirs = list(map(dirfun, pix_ids))
+            cnts = (eb.values(dirs) * pixel_area).astype(np.float32)
             
             print ('{:4d} {:4d} {:6d} {:8.2e} {:8.2e} {:8.2e}'.format(
                 ebi,nside,len(cnts), cnts.mean(), cnts.min(), cnts.max()))
             if subdir is not None:
-                subsubdir = subdir+'/{}'.format(ebi)
+                subsubdir = subdir+'/{:02d}'.format(ebi)
                 if not os.path.exists(subsubdir): os.makedirs(subsubdir)
                 outfile = subsubdir+'/HP12_{:04d}.pickle'.format(roi_index)
-                pickle.dump(cnts, open(outfile, 'w'))
+                pickle.dump(cnts, open(outfile, 'wb'))
                 print ('\t\t--> {}'.format(outfile))
 
 class BandCounts(object):
     """Manage results of the Model counts for a Band
+    The full-sky array is the file counts.npy in the band folder, combined from the per-ROI pickle
+    files, or written directly by maps.ModelCountMaps with shared set. It is memory-mapped when loaded.
     """
     def __init__(self, band_index, path='model_counts', reload=False):
         """Assume in a skymodel folder, containg a model_counts subfolder
@@ -99,7 +87,7 @@ class BandCounts(object):
         self.path=path+'/{:02d}'.format(band_index)
         nside_list = ModelCountMaps.nside_array
         self.nside = nside_list[band_index]
-        self.filename = self.path+'/combined.pickle'
+        self.filename = self.path+'/counts.npy'
         if os.path.exists(self.filename) and not reload:
             self.load()
         else:
@@ -107,75 +95,151 @@ class BandCounts(object):
             self.dump()
 
     def combine(self):
+        """ scatter the values from the per-ROI pickle files into a full-sky array"""
         index_table = make_index_table(12, self.nside)
-        d = dict()
-        ff = sorted(glob.glob(self.path+'/HP12*.pickle'.format(self.bi)));
+        ff = sorted(glob.glob(self.path+'/HP12_*.pickle'))
         assert len(ff)==1728, 'only found {} pickle files in {}'.format(len(ff), self.path)
-        for i,f in enumerate(ff):
-            ids = index_table[i]
+        counts = np.empty(12*self.nside**2, np.float32)
+        counts[:] = np.nan
+        for f in ff:
+            ids = index_table[int(f[-11:-7])]
             try:
-                values = pickle.load(open(f))
+                values = pickle.load(open(f, 'rb'))
             except Exception as msg:
                 print ('Failed to load file {}: {}'.format(f, msg))
                 raise
             assert len(ids)==len(values), 'oops: {} ids, but {} values'.format(len(ids), len(values))
-            d.update(zip(ids, values))
-        self.counts= np.array(d.values(),np.float32)
+            counts[ids] = values
+        self.check(counts)
+        self.counts = counts
+
+    def check(self, counts):
+        nmissing = np.sum(np.isnan(counts))
+        assert nmissing==0, '{} pixels not filled for band {} in {}'.format(nmissing, self.bi, self.path)
 
     def plot(self, **kwargs):
         from uw.like2.pub import healpix_map as hpm
         name = 'band{:02d}'.format(self.bi)
-        hpm.HParray(name, self.counts).plot(log=True, title=name, **kwargs)
+        hpm.HParray(name, np.asarray(self.counts)).plot(log=True, title=name, **kwargs)
 
     def dump(self):
-        pickle.dump(self.counts, open(self.filename, 'w'))
+        tmp = self.filename+'.{}.tmp'.format(os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, self.counts)
+        os.rename(tmp, self.filename)
         print ('Saved file {}'.format(self.filename))
 
     def load(self):
-        self.counts = pickle.load(open(self.filename))
+        self.counts = np.load(self.filename, mmap_mode='r')
+        self.check(self.counts)
         
-    def simulate(self):
-        """Return sparsified Poisson simulation
+    def simulate(self, rng=None, chunk=1<<20):
+        """Return sparsified Poisson simulation, an array (2, number of nonzero pixels) of
+        the pixel ids and counts
+        rng : RandomState | None
+            if None, use np.random
+        chunk : int
+            number of pixels to draw at a time, to limit memory use
         """
-        sim =np.random.poisson(self.counts)
-        nonzero = sim>0
-        ids=np.arange(len(sim))[nonzero]
-        counts = sim[nonzero]
-        return np.array([ids, counts], np.int32)
+        if rng is None: rng = np.random
+        ids, counts = [], []
+        for start in range(0, len(self.counts), chunk):
+            sim = rng.poisson(self.counts[start:start+chunk])
+            nonzero = np.flatnonzero(sim)
+            ids.append(nonzero+start)
+            counts.append(sim[nonzero])
+        return np.array([np.concatenate(ids), np.concatenate(counts)], np.int32)
+
+def channel_seed(seed, realization, channel):
+    """ the seed for the RandomState used to simulate a channel, so that each (realization, channel)
+    has an independent stream, independent of the order or process in which it is run"""
+    return [seed, realization, channel]
+
+def _simulate_channel(args):
+    # worker function for SimulatedPixels: must be at module level to be pickled
+    countsfolder, channel, seed = args
+    return channel, BandCounts(channel, path=countsfolder).simulate(np.random.RandomState(seed))
 
 class SimulatedPixels(binned_data.Pixels):
     """Generate simulated pixel data, using pixel-based count predictions
     Inherits from the Pixels class in binned_data to export the simuulation to a sparse FITS representation
     """
-    def __init__(self, model_path='.', subfolder='model_counts', numchan=None):
+    def __init__(self, model_path='.', subfolder='model_counts', numchan=None, 
+            seed=None, realization=0, processes=None):
         """
         model_path : str
             expect to find a sky model folder, containing itself a folder with 
+            a folder for each channel, see BandCounts
+        seed, realization : int
+            define the random streams: channel c uses RandomState(channel_seed(seed, realization, c)).
+            Use different realizations, with the same seed, for a set of independent simulations.
+            If seed is None, one is drawn from np.random, so that each simulation is different.
+            Both are printed, and saved in the SKYMAP header, to allow it to be reproduced.
+        processes : int | None
+            number of processes for simulating the channels in parallel; None or 1 to run serially.
+            The result does not depend on it.
         """
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self.seed, self.realization = int(seed), int(realization)
         self.countsfolder=os.path.join(model_path, subfolder)
-        assert os.path.exists(self.countsfolder), 'did not find folder {}'.format(countsfolder)
-        band_folders = sorted(glob.glob(self.countsfolder+'/*'))
+        assert os.path.exists(self.countsfolder), 'did not find folder {}'.format(self.countsfolder)
+        band_folders = sorted(glob.glob(self.countsfolder+'/[0-9]*'))
         if numchan is None:
             numchan=len(band_folders)
+        channels = [int(os.path.split(f)[-1]) for f in band_folders[:numchan]]
+        # make sure the full-sky arrays exist before any parallel reads
+        for channel in channels: BandCounts(channel, path=self.countsfolder)
+        print ('Simulating from model predictions in\n  {}\n  seed {}, realization {}\n  chan   pixels    counts'.format(
+            os.path.abspath(self.countsfolder), seed, realization))
+        tasks = [(self.countsfolder, channel, channel_seed(seed, realization, channel)) for channel in channels]
         sim = dict()
-        print ('Simulating from model predictions in\n  {}\n  chan   pixels    counts'.format(
-            os.path.abspath(self.countsfolder)))
-        for f in  band_folders[:numchan]:
-            channel = int(os.path.split(f)[-1])
-            print ('{:6d}'.format(channel), )
-            sim[channel]= s= BandCounts(channel).simulate()
-            print ('{:8d} {:9d}'.format(s.shape[1], sum(s[1,:])))
-            
-        # set these to be consistent with base class    
+        if processes is None or processes<=1:
+            results = map(_simulate_channel, tasks)
+            pool = None
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap(_simulate_channel, tasks)
+        try:
+            for channel, s in results:
+                sim[channel] = s
+                print ('{:6d}{:8d} {:9d}'.format(channel, s.shape[1], s[1,:].sum()))
+        finally:
+            if pool is not None:
+                pool.close(); pool.join()
+        self._fill(sim)
+
+    def _fill(self, sim):
+        # create the SKYMAP table, then copy in the channels one at a time, releasing each
         keys = sorted(sim.keys())
-        self.cnt = np.hstack([sim[k][1,:] for k in keys]); 
-        self.pix = np.hstack([sim[k][0,:] for k in keys]);
-        self.chn = np.hstack([np.ones(sim[k].shape[1], dtype=np.int16)*k for k in keys])
+        sizes = [sim[k].shape[1] for k in keys]
+        offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+        skymap_cols = [
+            fits.Column(name='PIX', format='J'),
+            fits.Column(name='CHANNEL', format='I'),
+            fits.Column(name='VALUE', format='J'),
+        ]
+        self.hdu = fits.BinTableHDU.from_columns(skymap_cols, nrows=offsets[-1], name='SKYMAP')
+        data = self.hdu.data
+        for k, a, b in zip(keys, offsets[:-1], offsets[1:]):
+            s = sim.pop(k)
+            data['PIX'][a:b] = s[0]
+            data['VALUE'][a:b] = s[1]
+            data['CHANNEL'][a:b] = k
+        # set these to be consistent with base class    
+        self.pix, self.chn, self.cnt = data['PIX'], data['CHANNEL'], data['VALUE']
         self.counter=None
+        self._pending = []
         self._sorted=True
-        channels = sorted(list(set(self.chn)))
-        indexchan = list(np.searchsorted(self.chn, channels))+[len(self.chn)]
-        self.lookup = dict(zip(channels,zip(indexchan[:-1], indexchan[1:])))
+        self.lookup = dict(zip(keys, zip(offsets[:-1], offsets[1:])))
+
+    def make_hdu(self):
+        """ the SKYMAP HDU, already filled"""
+        self.hdu.header.update(binned_data.Pixels.skymap_keywords)
+        self.hdu.header['SIMSEED'] = (self.seed, 'seed for the simulation')
+        self.hdu.header['SIMREAL'] = (self.realization, 'realization for the simulation')
+        return self.hdu
 
 class DefaultBands(binned_data.BandList):
     """Define a BANDS table corresponding to traditional pointlike setup, but with power-of-2 nside values
@@ -216,7 +280,9 @@ class DefaultBands(binned_data.BandList):
 class Simulate(binned_data.BinFile):
     """
     """
-    def __init__(self, model_path='.', subfolder='model_counts', numchan=None):
+    def __init__(self, model_path='.', subfolder='model_counts', numchan=None, **kwargs):
+        """ kwargs : passed to SimulatedPixels: seed, realization, processes
+        """
         # get the GTI from the original file? Do we need it?
         config = configuration.Configuration('.', postpone=True, quiet=True)
         bf = config.dataset.binfile
@@ -224,7 +290,7 @@ class Simulate(binned_data.BinFile):
         self.hdu0 = hdus[0]
         self.gti = binned_data.GTI(hdus['GTI'])
 
-        self.pixels=SimulatedPixels(model_path, subfolder, numchan=numchan)
+        self.pixels=SimulatedPixels(model_path, subfolder, numchan=numchan, **kwargs)
         self.bands = DefaultBands(self.pixels.lookup.keys(), 
                 emin=config['input_model'].get('emin',(100,100)))
 
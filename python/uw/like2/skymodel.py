@@ -10,7 +10,7 @@ import pandas as pd
 from skymaps import SkyDir, Band
 from uw.utilities import keyword_options, makerec
 from uw.like import Models, pointspec_helpers
-from . import sources, diffusedict
+from . import sources, diffusedict, model_store
 
 class SkyModel(object):
     """
@@ -185,18 +185,26 @@ class SkyModel(object):
         """
         run through the pickled roi dictionaries, create lists of point and extended sources
         assume that the number of such corresponds to a HEALpix partition of the sky
-        Note that if 'pickle.zip' exists, use it instead of a pickle folder
+        Note that if 'pickle.zip' exists, use it instead of a pickle folder,
+        and if the model store is at least as new, use that
         """
         self.point_sources= []
-        if os.path.exists(os.path.join(self.folder,'pickle.zip')):
-            pzip = zipfile.ZipFile(os.path.join(self.folder,'pickle.zip'))
-            files = ['pickle/HP12_%04d.pickle' %i for i in range(1728)]
-            assert all(f in pzip.namelist() for f in files), 'Improper model zip file'
-            opener = pzip.open
+        zipname = os.path.join(self.folder,'pickle.zip')
+        store = model_store.ModelStore(self.folder)
+        if store.is_current(zipname if os.path.exists(zipname) else os.path.join(self.folder, 'pickle')):
+            files = range(len(store))
+            records = store.records()
         else:
-            files = glob.glob(os.path.join(self.folder, 'pickle', '*.pickle'))
-            files.sort()
-            opener = open
+            if os.path.exists(zipname):
+                pzip = zipfile.ZipFile(zipname)
+                files = ['pickle/HP12_%04d.pickle' %i for i in range(1728)]
+                assert all(f in pzip.namelist() for f in files), 'Improper model zip file'
+                opener = pzip.open
+            else:
+                files = glob.glob(os.path.join(self.folder, 'pickle', '*.pickle'))
+                files.sort()
+                opener = open
+            records = ((int(os.path.splitext(file)[0][-4:]), pickle.load(opener(file))) for file in files)
         self.nside = int(np.sqrt(len(files)/12))
         if len(files) != 12*self.nside**2:
             msg = 'Number of pickled ROI files, %d, found in folder %s, not consistent with HEALpix' \
@@ -209,11 +217,9 @@ class SkyModel(object):
         moved=0
         nfreed = 0
         self.tagged=set()
-        source_names =[]
-        for i,file in enumerate(files):
-            p = pickle.load(opener(file))
-            index = int(os.path.splitext(file)[0][-4:])
-            assert i==index, 'logic error: file name %s inconsistent with expected index %d' % (file, i)
+        source_names = set()
+        for i,(index, p) in enumerate(records):
+            assert i==index, 'logic error: ROI record %d inconsistent with expected index %d' % (index, i)
             roi_sources = p.get('sources',  {}) # don't know why this needed
             extended_names = {} if (self.__dict__.get('extended_catalog') is None) else self.extended_catalog.names
             for key,item in roi_sources.items():
@@ -221,7 +227,7 @@ class SkyModel(object):
                 if key in source_names:
                     #if not self.quiet: print ('SkyModel warning: source with name %s in ROI %d duplicates previous entry: ignored'%(key, i))
                     continue
-                source_names.append(key)
+                source_names.add(key)
                 skydir = item['skydir']
                 if self.update_positions is not None:
                     ellipse = item.get('ellipse', None)
@@ -285,7 +291,7 @@ class SkyModel(object):
                 self.extended_sources.append(t)
 
     def _check_position(self, ps):
-        if self.closeness_tolerance<0.: return
+        if self.closeness_tolerance<=0.: return # default: no check, which is O(n^2)
         tol = np.radians(self.closeness_tolerance)
         func = ps.skydir.difference
         for s in self.point_sources:
@@ -26,46 +26,50 @@ class Weights(object):
     @keyword_options.decorate(defaults)
     def __init__(self, source_name, **kwargs):
         """
+        source_name : string | (ra,dec) | list of either
+            If a list, the ROI is selected with the first one, and weights are made for all of them,
+            which must be in the ROI model
         """
         keyword_options.process(self,kwargs)
         if self.energy_count is not None:
             self.energy_bins = self.energy_bins[:self.energy_count]
-        if type(source_name)==str:
-            t = SkyCoord.from_name(source_name); 
-            ra,dec=( t.fk5.ra.value, t.fk5.dec.value) 
-        else:
-            ra,dec = source_name
+        source_names = source_name if type(source_name)==list else [source_name]
+        positions = []
+        for name in source_names:
+            if type(name)==str:
+                t = SkyCoord.from_name(name); 
+                positions.append(( t.fk5.ra.value, t.fk5.dec.value))
+            else:
+                positions.append(name)
+        ra,dec = positions[0]
 
         # select an ROI by the ra, dec specified or found from SkyCoord
         if self.verbose>0:
             print ('Selecting ROI at (ra,dec)=({:.2f},{:.2f})'.format(ra,dec))
         self.roi =roi =main.ROI('.', (ra,dec))
 
-        # find the model source by position and select it
-        distances = np.degrees(np.array([
-            s.skydir.difference(SkyDir(ra,dec)) if s.skydir is not None else 1e9 for s in roi.sources]))
-        min_dist = distances.min()
-        assert min_dist<self.min_dist, 'Not within {} deg of any source in RoI'.format(self.min_dist)
-        si = np.arange(len(distances))[distances==min_dist][0]
-        sname = roi.sources.source_names[si] 
-        self.source =roi.get_source(sname)
-        if self.verbose>0:
-            print ('Found model source "{}" within {:.3f} deg of "{}"'.format(self.source.name, min_dist, source_name))
-
-    def make_weights(self, ):
-        if self.verbose>0:
-            print ('Generating pixels with weights for {} energies'.format(len(self.energy_bins)))
-        # direection of source
-
-        source_dir = self.source.skydir
-        source_index = self.roi.sources.selected_source_index
-
-        def weight(band, skydir):
-            f = band.fluxes(skydir) # fluxes for all sources at the position
-            return f[source_index]/sum(f)
-
+        # find the model sources by position
+        self.sources = []
+        self.source_indices = []
+        for name, (ra,dec) in zip(source_names, positions):
+            distances = np.degrees(np.array([
+                s.skydir.difference(SkyDir(ra,dec)) if s.skydir is not None else 1e9 for s in roi.sources]))
+            min_dist = distances.min()
+            assert min_dist<self.min_dist, 'Not within {} deg of any source in RoI'.format(self.min_dist)
+            si = np.arange(len(distances))[distances==min_dist][0]
+            self.sources.append(roi.sources[si])
+            self.source_indices.append(si)
+            if self.verbose>0:
+                print ('Found model source "{}" within {:.3f} deg of "{}"'.format(
+                    roi.sources[si].name, min_dist, name))
+        self.source =roi.get_source(self.sources[0].name)
+
+    def pixels(self, source):
+        """ return the NEST pixel numbers within the radius of the source, in order, and their SkyDirs
+        """
         # use query_disc to get NEST pixel numbers within given radius of position
         # order them for easier search later
+        source_dir = source.skydir
         l,b = source_dir.l(), source_dir.b() 
         center = healpy.dir2vec(l,b, lonlat=True) 
         pix_nest = np.sort(healpy.query_disc(self.nside, center, 
@@ -74,54 +78,82 @@ class Weights(object):
         # convert to skydirs using pointlike code, which assumes RING
         bdir=Band(self.nside).dir
         pix_ring = healpy.nest2ring(self.nside, pix_nest)
-        pixel_dirs = map(bdir, pix_ring)
+        pixel_dirs = list(map(bdir, pix_ring))
 
-        # and get distances
-        pixel_dist = np.array(map(source_dir.difference, pixel_dirs))
         if self.verbose>0:
+            # and get distances
+            pixel_dist = np.array(list(map(source_dir.difference, pixel_dirs)))
             print ('Using {} nside={} pixels.  distance range {:.2f} to {:.2f} deg'.format(
              len(pix_nest), self.nside, np.degrees(pixel_dist.min()), np.degrees(pixel_dist.max())))
+        return pix_nest, pixel_dirs
 
-        # now loop over the bands and all pixels
-        wt_dict=dict()
+    def make_all_weights(self):
+        """ return a list of (pixels, weight dict) for each of the selected sources
+
+        The fluxes for all models are evaluated for each band once, at all the pixels
+        needed for any of the sources.
+        """
+        if self.verbose>0:
+            print ('Generating pixels with weights for {} energies'.format(len(self.energy_bins)))
+        pixel_sets = [self.pixels(source) for source in self.sources]
+        all_pix, inverse = np.unique(np.concatenate([p for p,_ in pixel_sets]), return_inverse=True)
+        bdir=Band(self.nside).dir
+        all_dirs = list(map(bdir, healpy.nest2ring(self.nside, all_pix)))
+        # index into all_pix for each source's pixels
+        offsets = np.cumsum([0]+[len(p) for p,_ in pixel_sets])
+        selections = [inverse[a:b] for a,b in zip(offsets[:-1], offsets[1:])]
+
+        # now loop over the bands, evaluating all pixels at once
+        wt_dicts = [dict() for source in self.sources]
         for band in self.roi: # loop over BandLike objects
             ie = np.searchsorted(self.energy_bins, band.band.energy)-1
-
             band_id = 2*ie+band.band.event_type
             if self.verbose>1:
                 print ('{}'.format(band_id),)
-            wt_dict[band_id] = np.array([ weight(band, pd) for pd in pixel_dirs]).astype(np.float32)
+            f = band.fluxes_at(all_dirs) # fluxes for all sources at all pixels
+            total = f.sum(axis=0)
+            for wt_dict, si, sel in zip(wt_dicts, self.source_indices, selections):
+                wt_dict[band_id] = (f[si,sel]/total[sel]).astype(np.float32)
         if self.verbose>1: print ()
-        
-        return  pix_nest, wt_dict
+        return [(p, w) for (p,_), w in zip(pixel_sets, wt_dicts)]
 
-    def write(self, filename):
+    def make_weights(self, ):
+        """ return the pixels and weight dict for the first source"""
+        return self.make_all_weights()[0]
 
-        pixels, weights = self.make_weights()
+    def write(self, filename):
+        """ write the weight file for the source, or files for all the sources if filename is a list,
+        one for each source
+        """
+        filenames = filename if type(filename)==list else [filename]
+        assert len(filenames)==len(self.sources), \
+            'Expected {} file names, one for each source, got {}'.format(len(self.sources), len(filenames))
+        results = self.make_all_weights()
         # note: avoid pointlike objects like SkyDir to unpickle w/ python3
         galactic = lambda x: (x.l(),x.b())
-        outdict = dict(
-            model_name = '/'.join(os.getcwd().split('/')[-2:]),
-            radius=self.radius,
-            nside=self.nside,
-            order='NEST',
-            energy_bins=self.energy_bins,
-            source_name= self.source.name,
-            source_lb=galactic(self.source.skydir),
-            roi_lb  = galactic(self.roi.roi_dir),
-            roi_name=self.roi.name,
-            pixels= pixels,
-            weights = weights,
-        )
-        pickle.dump(outdict, open(filename, 'wb'))
-        if self.verbose>1:
-            print ('wrote file {}'.format(filename))
+        for fname, source, (pixels, weights) in zip(filenames, self.sources, results):
+            outdict = dict(
+                model_name = '/'.join(os.getcwd().split('/')[-2:]),
+                radius=self.radius,
+                nside=self.nside,
+                order='NEST',
+                energy_bins=self.energy_bins,
+                source_name= source.name,
+                source_lb=galactic(source.skydir),
+                roi_lb  = galactic(self.roi.roi_dir),
+                roi_name=self.roi.name,
+                pixels= pixels,
+                weights = weights,
+            )
+            pickle.dump(outdict, open(fname, 'wb'))
+            if self.verbose>1:
+                print ('wrote file {}'.format(fname))
 
 def main(source_name, filename):
     """ Use model in which this is run to create a weight file
     parameters:
-        source_name 
-        filename : name of pickled file
+        source_name : name, or list of names of sources in the same ROI
+        filename : name of pickled file, or list of names corresponding to source_name
     """
     sw = Weights(source_name)
     sw.write(filename)
\ No newline at end of file
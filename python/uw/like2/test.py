@@ -22,7 +22,11 @@ from uw.like2 import ( configuration,
     sedfuns,
     associate,
     main,
+    convolution,
+    count_density,
     )
+from uw.utilities.convolution import HankelConvolution
+from uw.like.SpatialModels import Gaussian, Disk
 
 # globals: references set by setUp methods in classes as needed
 config_dir = '/tmp/like2' # os.path.expandvars('$HOME/test') #skymodels/P202/uw29')
@@ -338,6 +342,375 @@ class TestExtended(TestSetup):
     def test_Cygnus_Cocoon(self):
         self.extended('Cygnus Cocoon', expect=(0.611,), psf_check=False)
 
+class TestHankel(unittest.TestCase):
+    """ The Hankel transform convolution used by response.ExtendedResponse with analytic set, 
+    against the FFT convolution on the grid that it replaces
+    """
+    psf_r68 = 0.32 # approximate, for king below
+    
+    def king(self, r, sigma=np.radians(0.2), gamma=2.5):
+        return (1-1./gamma)*(1+0.5*(r/sigma)**2/gamma)**-gamma/(2*np.pi*sigma**2)
+
+    def compare(self, model):
+        """ return the maximum difference within 3 degrees, relative to the peak, and 
+        the relative difference of the totals """
+        grid = convolution.ConvolvableGrid(SkyDir(0,0,SkyDir.GALACTIC), pixelsize=0.05, npix=401)
+        grid.bg_vals = model.at_r(grid.dists)
+        grid.psf_fill(self.king)
+        grid.convolve()
+        # as in ExtendedResponse.hankel
+        rmax, npoints = HankelConvolution.sampling(np.radians(min(self.psf_r68, model.r68())), 
+            2*grid.dists.max(), rmin=np.radians(model.effective_edge()+10*self.psf_r68))
+        hvals = HankelConvolution(self.king, rmax, npoints)(model, grid.dists)
+        inside = grid.dists<np.radians(3)
+        return (np.abs(hvals-grid.cvals)[inside].max()/grid.cvals.max(), 
+            hvals.sum()/grid.cvals.sum()-1)
+
+    def test_gaussian(self):
+        for sigma in (0.1, 0.5):
+            diff, total = self.compare(Gaussian(sigma=sigma))
+            self.assertLess(diff, 1e-3)
+            self.assertLess(abs(total), 1e-3)
+
+    def test_disk(self):
+        # the difference is from the pixelization of the edge for the FFT
+        diff, total = self.compare(Disk(sigma=1.0))
+        self.assertLess(diff, 2e-2)
+        self.assertLess(abs(total), 1e-3)
+
+class TestTransferFunction(unittest.TestCase):
+    """ count_density.transfer_function, against the quadrature for each l used by 
+    convolution.SphericalHarmonicContent, and the closed form for a narrow gaussian
+    """
+    def test_gaussian(self):
+        for sigma, lmax in ((3.0, 100), (1.0, 150)):
+            s = np.radians(sigma)
+            f = lambda r: np.exp(-0.5*(r/s)**2)
+            b = count_density.transfer_function(f, lmax, 5*sigma)
+            shc = convolution.SphericalHarmonicContent(f, lmax, 5*sigma, tolerance=None)
+            for l in (0, 1, 10, 50, lmax):
+                self.assertAlmostEqual(b[l], shc.G(l)/shc.G(0), places=8)
+            ell = np.arange(lmax+1)
+            self.assertLess(np.abs(b-np.exp(-0.5*ell*(ell+1)*s**2)).max(), 1e-3)
+
+class TestRunMany(unittest.TestCase):
+    """ Process.run_many with stand-ins for the configuration and binned data: the ROI selection 
+    is applied only in the workers, so the data of the calling process are unchanged
+    """
+    class BinFile(object):
+        roi_mask = None
+        def select_rois(self, roi_list, radius=5):
+            self.roi_mask = None if roi_list is None else sorted(roi_list)
+
+    class Config(object):
+        def __init__(self, dmap):
+            self.dataset = self
+            self.dmap, self.diffuse, self.roi_spec = dmap, dict(), None
+        def load(self): pass
+
+    def test_selection(self):
+        from uw.like2 import process
+        class Worker(process.Process):
+            def __init__(self, config):
+                self.config, self.outdir = config, None
+            def process_roi(self, index):
+                assert self.config.dataset.dmap.roi_mask==[2, 840], 'not selected in worker'
+        dmap = self.BinFile()
+        df = Worker(self.Config(dmap)).run_many([840, 2], workers=2, costs=[1, 2])
+        self.assertEqual(list(df.index), [2, 840])
+        self.assertTrue(np.all(df.status=='ok'), msg=str(df.status))
+        self.assertTrue(dmap.roi_mask is None)
+
+class PlainModel(object):
+    """ a picklable stand-in for a spectral model, for TestModelStore """
+    def __init__(self, name, parameters, free):
+        self.name, self.parameters, self.free = name, np.asarray(parameters, float), np.asarray(free, bool)
+    def len(self): return len(self.parameters)
+    def get_cov_matrix(self): return np.diag((0.1*self.parameters)**2)
+
+class TestModelStore(unittest.TestCase):
+    """ model_store.ModelStore: the records from the consolidated tables are those of the 
+    pickled ROI dicts that skymodel.SkyModel uses
+    """
+    def setUp(self):
+        import tempfile
+        from uw.like2 import model_store
+        self.model_store = model_store
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.RandomState(11)
+        self.long_name = 'a source with a name much longer than the forty characters of the default'
+        self.outputs = []
+        for index in range(12):
+            sources = dict()
+            for k in range(index%3+1):
+                name = 'PS%02d%d' % (index, k)
+                if index==5 and k==0: name = self.long_name
+                if index==7 and k==0: name = model_store._str(u'S\xe9rsic %d' % index)
+                sources[name] = dict(skydir=SkyDir(30.*index+k, 10.-k), 
+                    model=PlainModel('LogParabola' if k else 'PLSuperExpCutoffWithAVeryLongModelName',
+                        rng.uniform(1, 2, 3+k), [True, k>0, False]+[True]*k),
+                    ts=rng.uniform(25, 1e4), band_ts=rng.uniform(25, 1e4), isextended=False,
+                    ellipse=rng.uniform(size=7) if k else None)
+            self.outputs.append(dict(sources=sources, diffuse_names=['ring', 'isotrop'],
+                diffuse=[PlainModel('Constant', [1+0.01*index], [True]), PlainModel('Constant', [1.], [False])],
+                diffuse_normalization=dict(iso=dict(front=index))))
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.folder)
+
+    def test_records(self):
+        store = self.model_store.ModelStore(self.folder, nside=1)
+        self.assertFalse(store.is_current())
+        for index, output in enumerate(self.outputs):
+            store.write_roi(index, output)
+        store.consolidate(quiet=True)
+        self.assertTrue(store.is_current())
+        nrec = 0
+        for (index, rec), output in zip(store.records(), self.outputs):
+            nrec += 1
+            self.assertEqual(sorted(rec['sources'].keys()), sorted(output['sources'].keys()))
+            for name, item in output['sources'].items():
+                r = rec['sources'][name]
+                self.assertEqual((r['skydir'].ra(), r['skydir'].dec()), (item['skydir'].ra(), item['skydir'].dec()))
+                self.assertEqual((r['ts'], r['band_ts'], r['isextended']), (item['ts'], item['band_ts'], False))
+                self.assertTrue(np.all(r['model'].parameters==item['model'].parameters))
+                self.assertEqual(r['model'].name, item['model'].name)
+                if item['ellipse'] is None: self.assertTrue(r['ellipse'] is None)
+                else: self.assertTrue(np.all(r['ellipse']==item['ellipse']))
+            self.assertEqual(rec['diffuse_names'], output['diffuse_names'])
+            self.assertEqual([m.parameters[0] for m in rec['diffuse']], [m.parameters[0] for m in output['diffuse']])
+            self.assertEqual(rec['diffuse_normalization'], output['diffuse_normalization'])
+        self.assertEqual(nrec, 12)
+        df = store.dataframe(['roi', 'modelname'])
+        self.assertEqual(df.loc[self.long_name, 'roi'], 5)
+        self.assertEqual(df.loc[self.long_name, 'modelname'], 'PLSuperExpCutoffWithAVeryLongModelName')
+        # a part newer than the tables
+        t = os.path.getmtime(store.filename('roi_index.npy'))+10
+        os.utime(store.part_filename(3), (t, t))
+        self.assertFalse(store.is_current())
+
+class TestDiffuseCache(unittest.TestCase):
+    """ diffuse_cache.DiffuseCache in a temporary folder, with stand-ins for the DiffuseResponse """
+    class Stub(object):
+        def __init__(self, **kw): self.__dict__.update(kw)
+
+    def setUp(self):
+        import tempfile
+        from uw.like2 import diffuse_cache
+        self.diffuse_cache = diffuse_cache
+        self.folder = tempfile.mkdtemp()
+        self.dfile = os.path.join(self.folder, 'diffuse.fits')
+        with open(self.dfile, 'w') as f:
+            f.write('diffuse')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.folder)
+
+    def response(self, emin=100., corr=1.0):
+        S = self.Stub
+        return S(band=S(event_type=0, emin=emin, emax=1.5*emin, radius=5., has_pixels=True, pixels=1000),
+            dmodel=S(fullfilename=self.dfile), corr=corr, roicenter=SkyDir(30, 40), 
+            grid_npix=61, pixelsize=0.25)
+
+    def cache(self, maxsize=4000):
+        return self.diffuse_cache.DiffuseCache(os.path.join(self.folder, 'cache'), ('irf', 'data'), maxsize)
+
+    def test_key(self):
+        c = self.cache()
+        key = c.key(self.response())
+        self.assertEqual(key, self.cache().key(self.response()))
+        self.assertNotEqual(key, c.key(self.response(emin=133.)))
+        self.assertNotEqual(key, c.key(self.response(corr=[1.0, 1.01])))
+        other = self.diffuse_cache.DiffuseCache(os.path.join(self.folder, 'cache'), ('irf', 'other data'))
+        self.assertNotEqual(key, other.key(self.response()))
+
+    def test_round_trip(self):
+        c = self.cache()
+        cvals, pv = np.arange(12.).reshape(3,4), np.arange(5.)
+        self.assertTrue(c.get('a') is None)
+        c.put('a', 2.5, cvals, pv)
+        entry = self.cache().get('a')
+        self.assertEqual(entry['ap_average'], 2.5)
+        self.assertTrue(np.all(entry['cvals']==cvals) and np.all(entry['pixel_values']==pv))
+        c.put('b', 1.0, cvals)
+        self.assertFalse('pixel_values' in c.get('b'))
+        self.assertEqual((c.hits, c.misses), (1, 1))
+
+    def test_lru(self):
+        """ the least recently used entries are deleted when the size exceeds maxsize """
+        cvals = np.zeros(50000) # 0.4 MB
+        c = self.cache(maxsize=1.0)
+        for key in 'ab':
+            c.put(key, 1.0, cvals)
+        t = os.path.getmtime(os.path.join(c.folder, 'a'))
+        for i, key in enumerate('ab'):
+            os.utime(os.path.join(c.folder, key), (t-10+i, t-10+i))
+        c.get('a') # now more recent than b
+        c.put('c', 1.0, cvals)
+        self.assertEqual(sorted(e[2][-1] for e in c.entries()), ['a', 'c'])
+        self.assertEqual(c.evicted, 1)
+
+    def test_scans(self):
+        """ the folder is scanned for the first put, then every purge_interval puts """
+        c = self.cache()
+        scans = []
+        entries = c.entries
+        c.entries = lambda: scans.append(1) or entries()
+        c.purge_interval = 10
+        for i in range(25):
+            c.put('e%02d' % i, 1.0, np.zeros(10))
+        self.assertEqual(len(scans), 3)
+
+class TestGridFill(unittest.TestCase):
+    """ ConvolvableGrid.fill for a function with eval_vectors, against the evaluation for each pixel
+    """
+    class Function(object):
+        """ a smooth function of the direction, as a function of the galactic unit vector """
+        def value(self, v):
+            v = np.atleast_2d(v)
+            return 2 + np.dot(v, [0.3, -0.5, 0.8]) + np.dot(v, [0.6, 0.0, 0.8])**2
+        def __call__(self, skydir):
+            l, b = np.radians([skydir.l(), skydir.b()])
+            return self.value([np.cos(b)*np.cos(l), np.cos(b)*np.sin(l), np.sin(b)])[0]
+
+    class VectorFunction(Function):
+        def eval_vectors(self, vecs):
+            return self.value(vecs)
+
+    def test_fill(self):
+        grid = convolution.ConvolvableGrid(SkyDir(120, 30, SkyDir.GALACTIC), npix=21, pixelsize=0.5)
+        for center in ((120, 30), (300, -60)):
+            grid.set_center(SkyDir(center[0], center[1], SkyDir.GALACTIC))
+            grid.setup_grid(grid.npix, grid.pixelsize)
+            fast, slow = grid.fill(self.VectorFunction()), grid.fill(self.Function())
+            self.assertLess(np.abs(fast-slow).max(), 1e-6, msg='center %s' % (center,))
+
+class TestExposureGridCache(unittest.TestCase):
+    """ convolution.ExposureGridCache, with a grid whose fill is log10 of the band energy
+    """
+    class Stub(object):
+        def __init__(self, **kw): self.__dict__.update(kw)
+
+    class Grid(object):
+        def __init__(self, center, npix=11, pixelsize=0.5):
+            self.center, self.npix, self.pixelsize = center, npix, pixelsize
+            self.filled = []
+        def fill(self, exposure):
+            self.filled.append(exposure.energy)
+            return np.log10(exposure.energy)*np.ones((self.npix, self.npix))
+
+    def setUp(self):
+        self.source = self.Stub() # the exposure for all energies
+        self.grid = self.Grid(SkyDir(30, 40))
+
+    def band(self, energy, event_type=0):
+        S = self.Stub
+        return S(exposure=S(eman=self.source, energy=energy), event_type=event_type, energy=energy)
+
+    def test_hits(self):
+        cache = convolution.ExposureGridCache()
+        v = cache(self.grid, self.band(100.))
+        self.assertTrue(cache(self.grid, self.band(100.)) is v)
+        self.assertFalse(v.flags.writeable)
+        cache(self.grid, self.band(100., event_type=1))
+        cache(self.Grid(SkyDir(30, 41)), self.band(100.))
+        self.assertEqual((cache.hits, cache.misses, len(cache.groups)), (1, 3, 3))
+        self.assertEqual(self.grid.filled, [100., 100.])
+
+    def test_interpolate(self):
+        """ log-energy interpolation between layers separated by at most max_dloge """
+        cache = convolution.ExposureGridCache(max_dloge=0.75)
+        for energy in (100., 200., 1000., 10000.):
+            cache(self.grid, self.band(energy))
+        for energy in (141.421, 500.):
+            v = cache(self.grid, self.band(energy))
+            self.assertLess(np.abs(v-np.log10(energy)).max(), 1e-12)
+        self.assertEqual(cache.interpolated, 2)
+        cache(self.grid, self.band(3162.278)) # layers a decade apart
+        cache(self.grid, self.band(20000.)) # beyond the last layer
+        self.assertEqual(self.grid.filled, [100., 200., 1000., 10000., 3162.278, 20000.])
+        # disabled by default
+        self.assertTrue(convolution.ExposureGridCache().interpolate({100.: 0., 200.: 1.}, 141.421) is None)
+
+    def test_purge(self):
+        """ the least recently used groups are discarded when the size exceeds maxsize """
+        nbytes = 11*11*8/1e6
+        cache = convolution.ExposureGridCache(maxsize=2.5*nbytes)
+        grids = [self.Grid(SkyDir(30, dec)) for dec in (40, 41, 42)]
+        cache(grids[0], self.band(100.))
+        cache(grids[1], self.band(100.))
+        cache(grids[0], self.band(100.)) # now more recent than grids[1]
+        cache(grids[2], self.band(100.))
+        self.assertEqual([key[3] for key in cache.groups], [40, 42])
+        self.assertAlmostEqual(cache.size, 2*nbytes)
+        cache(grids[2], self.band(1000.)) # a second layer for the most recent group
+        self.assertEqual([key[3] for key in cache.groups], [42])
+
+class TestSimulation(unittest.TestCase):
+    """ simulation.BandCounts and SimulatedPixels, with a synthetic model_counts folder 
+    """
+    def setUp(self):
+        import tempfile
+        from uw.like2 import simulation
+        self.simulation = simulation
+        self.folder = tempfile.mkdtemp()
+        self.countsfolder = os.path.join(self.folder, 'model_counts')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.folder)
+
+    def model_counts(self, channel):
+        """ predicted counts, different for each pixel """
+        npix = 12*self.simulation.ModelCountMaps.nside_array[channel]**2
+        return ((np.arange(npix)+1.)/npix + 0.1*channel).astype(np.float32)
+
+    def band_folder(self, channel):
+        path = os.path.join(self.countsfolder, '{:02d}'.format(channel))
+        os.makedirs(path)
+        return path
+
+    def write_pickles(self, channel):
+        """ the per-ROI files, as written by ModelCountMaps """
+        import pickle
+        from uw.utilities.healpix_index import make_index_table
+        path, counts = self.band_folder(channel), self.model_counts(channel)
+        table = make_index_table(12, self.simulation.ModelCountMaps.nside_array[channel])
+        for roi_index, ids in enumerate(table):
+            with open(os.path.join(path, 'HP12_{:04d}.pickle'.format(roi_index)), 'wb') as f:
+                pickle.dump(counts[ids], f)
+
+    def test_combine(self):
+        BandCounts = self.simulation.BandCounts
+        self.write_pickles(0)
+        bc = BandCounts(0, path=self.countsfolder)
+        self.assertTrue(np.all(bc.counts==self.model_counts(0)))
+        loaded = BandCounts(0, path=self.countsfolder)
+        self.assertTrue(isinstance(loaded.counts, np.memmap) and np.all(loaded.counts==bc.counts))
+        os.remove(os.path.join(bc.path, 'HP12_0100.pickle'))
+        self.assertRaises(AssertionError, BandCounts, 0, path=self.countsfolder, reload=True)
+
+    def test_simulate(self):
+        """ reproducible for a given seed and realization, whatever the number of processes """
+        sim = self.simulation
+        for channel in range(3):
+            np.save(os.path.join(self.band_folder(channel), 'counts.npy'), self.model_counts(channel))
+        def simulate(**kwargs):
+            pixels = sim.SimulatedPixels(self.folder, seed=5, **kwargs)
+            return pixels, np.array([pixels.pix, pixels.chn, pixels.cnt])
+        pixels, a = simulate(realization=1)
+        self.assertTrue(np.array_equal(a, simulate(realization=1, processes=2)[1]))
+        self.assertFalse(np.array_equal(a, simulate(realization=2)[1]))
+        for channel in range(3):
+            expect = sim.BandCounts(channel, path=self.countsfolder).simulate(
+                np.random.RandomState(sim.channel_seed(5, 1, channel)))
+            sel = a[1]==channel
+            self.assertTrue(np.array_equal(a[0][sel], expect[0]) and np.array_equal(a[2][sel], expect[1]))
+        header = pixels.make_hdu().header
+        self.assertEqual((header['SIMSEED'], header['SIMREAL']), (5, 1))
+
 class TestROImodel(TestSetup):
 
     def setUp(self):
@@ -463,6 +836,41 @@ class TestLikelihood(TestSetup):
         t = np.array(corr.T - corr).flatten()
         self.assertTrue( np.abs(t).max()<0.02)
 
+    def test_hessian_numerical(self):
+        """--> the analytic hessian, against the numerical derivative of the gradient"""
+        bl = self.bl
+        hess = bl.hessian()
+        num = bl.hessian(numerical=True, delta=1e-5)
+        num = (num+num.T)/2
+        s = np.sqrt(hess.diagonal())
+        diff = np.abs(hess-num)/np.outer(s,s)
+        self.assertTrue(diff.max()<0.01, msg='max difference of correlations: %.3g' % diff.max())
+
+    def test_packed(self):
+        """--> packed and unpacked update, likelihood and gradient agree, also after a rescale"""
+        bl = self.bl
+        def values(packed=None):
+            if packed is not None:
+                for b in bl:
+                    b.packed = packed
+                    if packed: b.pack()
+            bl.update()
+            return bl.log_like(), bl.gradient()
+        def check(a, b):
+            self.assertAlmostEquals(a[0], b[0], delta=1e-9*abs(b[0]))
+            self.assertTrue(np.allclose(a[1], b[1], rtol=1e-8, atol=1e-8*np.abs(b[1]).max()))
+        check(values(True), values(False))
+        # change the pixel values of the free diffuse responses after the packed matrix is made
+        values(True)
+        rescaled = [m for b in bl for m in b.free_sources if hasattr(m, 'rescale')]
+        self.assertTrue(len(rescaled)>0, 'no free diffuse source')
+        for m in rescaled: m.rescale(1.1)
+        try:
+            check(values(), values(False))
+        finally:
+            for m in rescaled: m.rescale(1/1.1)
+            values(True)
+
     def test_bandsubset(self):
         bl = self.bl
         bl.selected = bl
@@ -574,6 +982,22 @@ class TestROI(TestSetup):
     #    self.assertAlmostEquals(0.0062, t['a'], delta=1e-3)
     #    self.assertAlmostEquals(0.215, t['qual'], delta=1e-3)
  
+    def test_residual_ts(self):
+        """-->FastResidualTS, the engine for the ts table, against the refit of ResidualTS"""
+        from uw.like2 import maps
+        engine, kw = maps.table_info['ts']
+        self.assertTrue(engine is maps.FastResidualTS)
+        d = roi.roi_dir
+        skydirs = [SkyDir(d.ra()+dra, d.dec()+ddec) for dra, ddec in ((0,0), (0.5,0), (0,-1), (1.5,1))]
+        ts = engine(roi, refit_ts=None, **kw).batch(skydirs)
+        exact = maps.ResidualTS(roi, **kw)
+        try:
+            expect = np.array([exact.tsfun(sd) for sd in skydirs])
+        finally:
+            exact.reset()
+        self.assertTrue(np.allclose(ts, expect, rtol=0.05, atol=1.0), 
+            msg='fast: %s, refit: %s' % (ts.round(2), expect.round(2)))
+
     def testTS(self, source_name=sourcename, expect=3076):
         """-->compute a Test Statistic"""
         ts = roi.TS(source_name)
@@ -598,6 +1022,14 @@ test_cases = (
     TestPoint, 
     TestDiffuse, 
     TestExtended, 
+    TestHankel,
+    TestTransferFunction,
+    TestRunMany,
+    TestModelStore,
+    TestDiffuseCache,
+    TestGridFill,
+    TestExposureGridCache,
+    TestSimulation,
     TestROImodel, 
     TestXML,
     TestBands, 
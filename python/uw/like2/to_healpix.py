@@ -5,15 +5,20 @@ $Header: /nfs/slac/g/glast/ground/cvs/pointlike/python/uw/like2/to_healpix.py,v
 import os, pickle, time
 import numpy as np
 from skymaps import Band
+from . import model_store
 
 def pickle_dump(roi,  pickle_dir, dampen, ts_min=0, **kwargs):
     """ dump the source information from an ROI constructed from the sources here
     ts_min : float
         threshold for saving. But if name starts with 'PSR' or extended save anyway
+    store : bool
+        if True, and the name is a HEALPix ROI index, also save the record to the model store
+        in the parent folder of pickle_dir
     """
     assert os.path.exists(pickle_dir), 'output folder not found: %s' %pickle_dir
     name = roi.name.strip()
     fname = kwargs.pop('fname', name)
+    store = kwargs.pop('store', True)
     filename=os.path.join(pickle_dir,fname+'.pickle')
     
     # start output record, a dict
@@ -88,4 +93,6 @@ def pickle_dump(roi,  pickle_dir, dampen, ts_min=0, **kwargs):
     with open(filename,'wb') as f:  #perhaps overwrite
         pickle.dump(output,f)
     print ('saved pickle file to %s' % filename)
+    if store and fname[-4:].isdigit():
+        model_store.ModelStore(os.path.dirname(os.path.abspath(pickle_dir))).write_roi(int(fname[-4:]), output)
         
@@ -162,6 +162,14 @@ def create_jname(ra,dec):
             + sign+'{:02d}{:02.0f}'.format(int(dem/60),dem%60)
  
 
+def unit_vectors(skydirs):
+    """ return an (n,3) array of the cartesian unit vectors for a list of SkyDir objects
+    """
+    radec = np.radians(np.array([(s.ra(), s.dec()) for s in skydirs]).reshape(-1,2))
+    ra, dec = radec[:,0], radec[:,1]
+    return np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)]).T
+
+
 def find_close(A,B):
     """ Return a DataFrame with the A index containg
     columns of the  name of the closest entry in B, and its distance
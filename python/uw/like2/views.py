@@ -12,7 +12,7 @@ import sys, types
 import numpy as np
 from scipy import misc, optimize
 from skymaps import SkyDir
-from . import (roimodel, bandlike, tools, parameterset)
+from . import (roimodel, bandlike, tools, parameterset, sources)
 
 class FitterSummaryMixin(object):
     """mixin to summarize variables"""
@@ -454,6 +454,38 @@ class TSmapView(tools.WithMixin):
             self.set_dir(skydir)
         return 2*(self.func.log_like()-self.wzero)
 
+    def grid(self, skydirs):
+        """ return an array of the TS values for a list of directions, as would be returned by 
+        calling this object for each one, without moving the source.
+        
+        For each band, the contribution of the source is removed from the model pixels, and the 
+        likelihood evaluated with the PSF values for all the directions against the band's pixels,
+        with the spectrum of the source unchanged.
+        """
+        skydirs = list(skydirs)
+        if not isinstance(self.source, sources.PointSource):
+            # response is not just the PSF: evaluate each one
+            return np.array([self(sd) for sd in skydirs])
+        current = self.get_dir()
+        v = tools.unit_vectors(skydirs + [current])
+        loglike = np.zeros(len(v))
+        for bl in self.blike.selected:
+            band = bl.band
+            bs = bl[self.source.name]
+            if not bs.active:
+                continue # no contribution from this band
+            overlap = np.array([band.psf.overlap(band.skydir, band.radius, sd) for sd in skydirs+[current]])
+            counts = bl.counts - bs.counts + bs.expected * overlap
+            ll = -counts * bl.exposure_factor
+            if bl.pixels>0:
+                other = bl.model_pixels - bs.pix_counts
+                delta = np.arccos(np.clip(np.dot(v, tools.unit_vectors(bl.pixel_dirs).T), -1, 1))
+                psf = np.asarray(band.psf(delta.ravel())).reshape(delta.shape)
+                ll += np.dot(np.log(other + (bs.expected*band.pixel_area)*psf), bl.data)
+            loglike += bl.unweight * ll
+        # refer to the value at the current position, which is the likelihood of the model
+        return 2*(loglike[:-1] - loglike[-1] + self.func.log_like() - self.wzero)
+
 
 class EnergyFluxView(tools.WithMixin):
 
@@ -20,6 +20,7 @@ from copy import deepcopy
 import scipy
 from scipy.optimize import fmin,fmin_tnc,leastsq
 from uw.pulsar.stats import z2mw,hm,hmw
+from uw.pulsar import lcparallel
 
 SECSPERDAY = 86400.
 
@@ -349,34 +350,51 @@ class UnweightedLCFitter(object):
         self.template.set_errors(np.diag(self.cov_matrix)**0.5)
         return True
 
-    def bootstrap_errors(self,nsamp=100,fit_kwargs={},set_errors=False):
+    def bootstrap_fit(self,rng=np.random,fit_kwargs={}):
+        """ Fit a bootstrap resample of the photons drawn with rng, and
+            return the parameters, or None if the fit failed.  The photons
+            and the template parameters are restored afterwards."""
         p0 = self.phases; w0 = self.weights
         param0 = self.template.get_parameters().copy()
         n = len(p0)
-        results = np.empty([nsamp,len(self.template.get_parameters())])
-        fit_kwargs['estimate_errors'] = False # never estimate errors
-        if 'unbinned' not in fit_kwargs.keys():
-            fit_kwargs['unbinned'] = True
-        counter = 0
-        for i in range(nsamp*2):
-            if counter == nsamp:
-                break
-            if i == (2*nsamp-1):
-                self.phases = p0; self.weights = w0
-                raise ValueError('Could not construct bootstrap sample.  Giving up.')
-            a = (np.random.rand(n)*n).astype(int)
-            self.phases = p0[a]
-            if w0 is not None:
-                self.weights = w0[a]
-            if not fit_kwargs['unbinned']:
+        unbinned = fit_kwargs.get('unbinned',True)
+        a = (rng.rand(n)*n).astype(int)
+        self.phases = p0[a]
+        if w0 is not None:
+            self.weights = w0[a]
+        try:
+            if not unbinned:
                 self._hist_setup()
-            if self.fit(**fit_kwargs):
-                results[counter,:] = self.template.get_parameters()
-                counter += 1
+            ok = self.fit(**fit_kwargs)
+            result = self.template.get_parameters().copy() if ok else None
+        finally:
+            self.phases = p0; self.weights = w0
+            if not unbinned:
+                self._hist_setup()
+            elif unbinned == 'grid':
+                self._grid_setup()
             self.template.set_parameters(param0)
+        return result
+
+    def bootstrap_errors(self,nsamp=100,fit_kwargs={},set_errors=False,
+                         processes=None,seed=None,callback=None):
+        """ Refit nsamp bootstrap resamples; return the (nsamp,npar) array
+            of parameters.
+
+            processes -- if > 1, run the refits in a pool of processes
+            seed      -- seed for the resampling, see lcparallel.bootstrap
+            callback  -- optional function called with (index,parameters)
+                         for each successful refit, in order, e.g. to
+                         checkpoint a long run
+        """
+        results = np.empty([nsamp,len(self.template.get_parameters())])
+        for counter,(index,p) in enumerate(lcparallel.bootstrap(self,nsamp,
+                fit_kwargs=fit_kwargs,processes=processes,seed=seed)):
+            results[counter,:] = p
+            if callback is not None:
+                callback(index,p)
         if set_errors:
             self.template.set_errors(np.std(results,axis=0))
-        self.phases = p0; self.weights = w0
         return results
 
     def __str__(self):
@@ -508,6 +526,9 @@ class UnweightedLCFitter(object):
         return ts
 
 class WeightedLCFitter(UnweightedLCFitter):
+    # resolution of the phase grid for the approximate unbinned likelihood,
+    # used with fit(unbinned='grid')
+    grid_bins = 4096
 
     def _hist_setup(self):
         """ Setup binning for a quick chi-squared fit."""
@@ -530,18 +551,17 @@ class WeightedLCFitter(UnweightedLCFitter):
         a = np.argsort(self.phases)
         self.phases = self.phases[a]
         self.weights = self.weights[a]
-        self.counts_centers = []
-        self.slices = []
-        indices = np.arange(len(self.weights))
-        for i in range(nbins):
-            mask = (self.phases >= bins[i]) & (self.phases < bins[i+1])
-            if mask.sum() > 0:
-                w = self.weights[mask]
-                if w.sum()==0: continue
-                p = self.phases[mask]
-                self.counts_centers.append((w*p).sum()/w.sum())
-                self.slices.append(slice(indices[mask].min(),indices[mask].max()+1))
-        self.counts_centers = np.asarray(self.counts_centers)
+        # the bin for each photon, and the weighted mean phase of each bin
+        # with nonzero weight; the photon-to-center index array is used to
+        # gather the template values at the centers for each photon
+        ibin = np.clip(np.searchsorted(bins,self.phases,side='right')-1,0,nbins-1)
+        wsum = np.bincount(ibin,weights=self.weights,minlength=nbins)
+        wpsum = np.bincount(ibin,weights=self.weights*self.phases,minlength=nbins)
+        good = wsum > 0
+        self.counts_centers = wpsum[good]/wsum[good]
+        # photons in bins with no weight contribute nothing; use any center
+        center_index = np.maximum(np.cumsum(good)-1,0)
+        self.bin_index = center_index[ibin]
 
     def chi(self,p,*args):
         x,y,yerr = self.chistuff
@@ -568,10 +588,7 @@ class WeightedLCFitter(UnweightedLCFitter):
         if ((t.norm()>1) or (not params_ok)):
             return 2e20
         template_terms = t(self.counts_centers)-1
-        phase_template_terms = np.empty_like(self.weights)
-        for tt,sl in zip(template_terms,self.slices):
-            phase_template_terms[sl] = tt
-        return -np.log(1+self.weights*phase_template_terms).sum()
+        return -np.log(1+self.weights*template_terms[self.bin_index]).sum()
 
     def unbinned_gradient(self,p,*args):
         t = self.template
@@ -587,19 +604,70 @@ class WeightedLCFitter(UnweightedLCFitter):
         t.set_parameters(p)
         if t.norm()>1:
             return np.ones_like(p)*2e20
-        nump = len(p)
         template_terms = t(self.counts_centers)-1
         gradient_terms = t.gradient(self.counts_centers)
-        phase_template_terms = np.empty_like(self.weights)
-        phase_gradient_terms = np.empty([nump,len(self.weights)])
-        # distribute the central values to the unbinned phases/weights
-        for tt,gt,sl in zip(template_terms,gradient_terms.transpose(),self.slices):
-            phase_template_terms[sl] = tt
-            for j in range(nump):
-                phase_gradient_terms[j,sl] = gt[j]
-        numer = self.weights*phase_gradient_terms
-        denom = 1+self.weights*(phase_template_terms)
-        return -(numer/denom).sum(axis=1)
+        # the gradient is constant within a bin, so sum w/denom over each bin
+        w = self.weights
+        coeffs = np.bincount(self.bin_index,weights=w/(1+w*template_terms[self.bin_index]),
+            minlength=len(self.counts_centers))
+        return -np.dot(gradient_terms,coeffs)
+
+    def _grid_setup(self):
+        """ Setup the fixed-resolution phase grid used to approximate the
+            unbinned likelihood: for each photon, the grid interval containing
+            it and the fractional position within it."""
+        n = self.grid_bins
+        ph0 = self.phase_shift
+        self.grid = np.linspace(ph0,ph0+1,n+1)
+        x = np.clip((self.phases-ph0)*n,0,n*(1-1e-12))
+        self.grid_index = x.astype(int)
+        self.grid_frac = x-self.grid_index
+
+    def _grid_values(self,values):
+        """ Linear interpolation of template values on the grid at the phases."""
+        i,f = self.grid_index,self.grid_frac
+        return values[...,i]*(1-f) + values[...,i+1]*f
+
+    def grid_accuracy(self):
+        """ Return the maximum absolute error of the interpolated template
+            for the current parameters, evaluated at the centers of the grid
+            intervals, where linear interpolation is least accurate.  The
+            error scales as grid_bins**-2."""
+        t = self.template
+        g = t(self.grid)
+        return np.abs((g[1:]+g[:-1])/2-t((self.grid[1:]+self.grid[:-1])/2)).max()
+
+    def grid_loglikelihood(self,p,*args):
+        """ Approximate the unbinned likelihood using template values on a
+            grid of grid_bins phases, linearly interpolated to the photons."""
+        t = self.template
+        params_ok = t.set_parameters(p)
+        if ((t.norm()>1) or (not params_ok)):
+            return 2e20
+        return -np.log(1+self.weights*(self._grid_values(t(self.grid))-1)).sum()
+
+    def grid_gradient(self,p,*args):
+        """ Gradient of grid_loglikelihood.  The interpolation is linear in
+            the grid values, so the photon sums reduce to sums per grid point."""
+        t = self.template
+        t.set_parameters(p)
+        if t.norm()>1:
+            return np.ones_like(p)*2e20
+        w,i,f = self.weights,self.grid_index,self.grid_frac
+        c = w/(1+w*(self._grid_values(t(self.grid))-1))
+        n = len(self.grid)
+        coeffs = np.bincount(i,weights=c*(1-f),minlength=n) + np.bincount(i+1,weights=c*f,minlength=n)
+        return -np.dot(t.gradient(self.grid),coeffs)
+
+    def _set_unbinned(self,unbinned=True):
+        """ unbinned may be True, False for the binned likelihood, or 'grid'
+            for the unbinned likelihood approximated on a phase grid."""
+        if unbinned == 'grid':
+            self._grid_setup()
+            self.loglikelihood = self.grid_loglikelihood
+            self.gradient = self.grid_gradient
+        else:
+            super(WeightedLCFitter,self)._set_unbinned(unbinned)
 
 class ChiSqLCFitter(object):
     """ Fit binned data with a gaussian likelihood."""
@@ -693,30 +761,44 @@ def hessian(m,mf,*args,**kwargs):
     mf(p0,m,*args) #call likelihood with original values; this resets model and any other values that might be used later
     return hessian
 
-def get_errors(template,total,n=100):
-    """ This is, I think, for making MC estimates of TOA errors."""
-    from scipy.optimize import fmin
-    ph0 = template.get_location()
+def _get_errors_trial(shared,i):
+    """ One simulated data set for get_errors; return the fit phase,
+        the curvatures for the two step sizes, and the likelihood change."""
+    template,total,ph0,seed = shared
     def logl(phi,*args):
         phases = args[0]
         template.set_overall_phase(phi%1)
         return -np.log(template(phases)).sum()
-    errors = np.empty(n)
-    fitvals = np.empty(n)
-    errors_r = np.empty(n)
     delta = 0.01
-    mean = 0
-    for i in range(n):
-        template.set_overall_phase(ph0)
+    template.set_overall_phase(ph0)
+    # template.random (and the primitives) use the global generator, so
+    # seed it for this trial and restore the caller's state afterwards
+    state = np.random.get_state()
+    np.random.seed(lcparallel.task_rng(seed,i).randint(2**31))
+    try:
         ph = template.random(total)
-        results = fmin(logl,ph0,args=(ph,),full_output=1,disp=0)
-        phi0,fopt = results[0],results[1]
-        fitvals[i] = phi0
-        mean += logl(phi0+delta,ph)-logl(phi0,ph)
-        errors[i] = (logl(phi0+delta,ph)-fopt*2+logl(phi0-delta,ph))/delta**2
-        my_delta = errors[i]**-0.5
-        errors_r[i] = (logl(phi0+my_delta,ph)-fopt*2+logl(phi0-my_delta,ph))/my_delta**2
-    print ('Mean: %.2f'%(mean/n))
+    finally:
+        np.random.set_state(state)
+    results = fmin(logl,ph0,args=(ph,),full_output=1,disp=0)
+    phi0,fopt = results[0][0],results[1]
+    dl = logl(phi0+delta,ph)-logl(phi0,ph)
+    error = (logl(phi0+delta,ph)-fopt*2+logl(phi0-delta,ph))/delta**2
+    my_delta = error**-0.5
+    error_r = (logl(phi0+my_delta,ph)-fopt*2+logl(phi0-my_delta,ph))/my_delta**2
+    return phi0,error,error_r,dl
+
+def get_errors(template,total,n=100,processes=None,seed=None):
+    """ This is, I think, for making MC estimates of TOA errors.
+        The n trials may be run in a pool of processes; each is seeded
+        from seed and the trial index."""
+    ph0 = template.get_location()
+    if seed is None:
+        seed = np.random.randint(2**31)
+    trials = np.asarray(list(lcparallel.imap(_get_errors_trial,
+        (template,total,ph0,seed),range(n),processes=processes)),dtype=float)
+    fitvals,errors,errors_r = trials[:,0],trials[:,1],trials[:,2]
+    template.set_overall_phase(ph0)
+    print ('Mean: %.2f'%(trials[:,3].sum()/n))
     return fitvals-ph0,errors**-0.5,errors_r**-0.5
 
 def make_err_plot(template,totals=[10,20,50,100,500],n=1000):
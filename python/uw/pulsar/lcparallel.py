@@ -0,0 +1,91 @@
+"""
+Run light curve template fits and likelihood scans over a process pool.
+
+Each worker process receives a single pickled copy of the shared state, e.g.
+a fitter with its template and phase/weight arrays, when it starts; the tasks
+sent to it are only indices or grid points.  Tasks that need random numbers
+seed a RandomState with (seed, task index), so the results do not depend on
+the number of processes.  Results are returned in task order as they are
+completed, so that long runs can be checkpointed.
+
+With processes=None (the default) everything runs serially in the calling
+process, with the same seeding.
+"""
+
+import pickle
+import numpy as np
+from multiprocessing import Pool
+
+_state = None # the (func,shared) pair in a worker process
+
+def _init(state):
+    global _state
+    _state = pickle.loads(state)
+
+def _call(task):
+    func,shared = _state
+    return func(shared,task)
+
+def imap(func,shared,tasks,processes=None,chunksize=1):
+    """ Generate func(shared,task) for each task, in order.
+
+        func      -- a module-level function, so that it can be pickled
+        shared    -- state sent once to each worker
+        processes -- number of worker processes; None or 1 to run serially
+    """
+    if processes is None or processes <= 1:
+        for task in tasks:
+            yield func(shared,task)
+        return
+    state = pickle.dumps((func,shared),pickle.HIGHEST_PROTOCOL)
+    pool = Pool(processes,_init,(state,))
+    try:
+        for result in pool.imap(_call,tasks,chunksize):
+            yield result
+    finally:
+        pool.terminate()
+
+def task_rng(seed,index):
+    """ The RandomState for task index of a run with the given seed."""
+    return np.random.RandomState([seed,index])
+
+def _bootstrap_task(shared,index):
+    fitter,seed,fit_kwargs = shared
+    return fitter.bootstrap_fit(task_rng(seed,index),fit_kwargs)
+
+def bootstrap(fitter,nsamp=100,fit_kwargs={},processes=None,seed=None):
+    """ Generate (index,parameters) for successful refits of bootstrap
+        resamples of the fitter's photons, in order, until there are nsamp.
+        Resample index is drawn with task_rng(seed,index); if seed is None,
+        one is drawn from np.random.  Raises ValueError if 2*nsamp resamples
+        do not yield nsamp successful fits.
+    """
+    if seed is None:
+        seed = np.random.randint(2**31)
+    fit_kwargs = dict(fit_kwargs)
+    fit_kwargs['estimate_errors'] = False # never estimate errors
+    if 'unbinned' not in fit_kwargs:
+        fit_kwargs['unbinned'] = True
+    results = imap(_bootstrap_task,(fitter,seed,fit_kwargs),range(2*nsamp),
+                   processes=processes)
+    counter = 0
+    try:
+        for index,p in enumerate(results):
+            if p is None: continue
+            yield index,p
+            counter += 1
+            if counter == nsamp: return
+    finally:
+        results.close()
+    raise ValueError('Could not construct bootstrap sample.  Giving up.')
+
+def _logl_task(shared,x):
+    logl,args = shared
+    return logl(x,*args)
+
+def scan(logl,dom,args=(),processes=None,chunksize=None):
+    """ Return an array of logl(x,*args) for x in dom."""
+    if chunksize is None:
+        chunksize = 1 if processes is None else max(1,len(dom)//(4*processes))
+    return np.asarray(list(imap(_logl_task,(logl,args),dom,
+                       processes=processes,chunksize=chunksize)))
@@ -212,25 +212,39 @@ class Polyco:
         return polyconame
 
     def make_keys(self):
-        """Keys for a binary search.  Use the edges."""
+        """Keys for a binary search.  Use the edges.
+           Also pack the entries into arrays for vectorized evaluation; the
+           coefficients are zero-padded to the largest ncoeff."""
         keys = np.asarray([e.tstop for e in self.entries])
         sorting = np.argsort(keys)
         self.entries = np.asarray(self.entries)[sorting]
         self.keys = np.append(self.entries[0].tstart,keys[sorting])
+        ncoeff = max(e.ncoeff for e in self.entries)
+        self.coeffs = np.zeros((len(self.entries),ncoeff))
+        for i,e in enumerate(self.entries):
+            self.coeffs[i,:e.ncoeff] = e.coeffs[:e.ncoeff]
+        self.tmids = np.asarray([e.tmid for e in self.entries])
+        self.rphases = np.asarray([e.rphase for e in self.entries])
+        self.f0s = np.asarray([e.f0 for e in self.entries])
+        self.uids = np.asarray([e.uid for e in self.entries])
+
+    def getindex(self,t):
+        '''Returns the index of the polyco entry corresponding to time t (in MJD)'''
+        idx = np.searchsorted(self.keys,t)
+        if np.any(idx == len(self.keys)):
+            print ('The following MJDS were beyond the end of the polyco validity (%s):'%(self.keys[-1]))
+            print (t[idx == len(self.keys)] if type(t) is type(np.array([1])) else t)
+            raise IndexError
+        if np.any(idx==0):
+            print ('The following MJDS were before the start of the polyco validity (%s):'%(self.keys[0]))
+            print (t[idx == 0] if type(t) is type(np.array([1])) else t)
+            raise IndexError
+        return idx-1
 
     def getentry(self,t,use_keys=True):
         '''Returns the polyco entry corresponding to time t (in MJD)'''
         if use_keys:
-            idx = np.searchsorted(self.keys,t)
-            if np.any(idx == len(self.keys)):
-                print ('The following MJDS were beyond the end of the polyco validity (%s):'%(self.keys[-1]))
-                print (t[idx == len(self.keys)] if type(t) is type(np.array([1])) else t)
-                raise IndexError
-            if np.any(idx==0):
-                print ('The following MJDS were before the start of the polyco validity (%s):'%(self.keys[0]))
-                print (t[idx == 0] if type(t) is type(np.array([1])) else t)
-                raise IndexError
-            return self.entries[idx-1]
+            return self.entries[self.getindex(t)]
         for pe in self.entries:
             if pe.valid(t):
                 return pe
@@ -239,32 +253,70 @@ class Polyco:
         sys.exit(9)
         return None
 
-    def _vec_eval(self,times,func):
+    def _vec_eval(self,times,func,longdouble=False,chunk=1000000):
+        """ Evaluate func, one of the PolycoEntry methods evalphase,
+            evalabsphase, evalfreq, or evalfreqderiv, for a vector of times.
+
+            The entry for each time is found by binary search, and the
+            polynomials for all times are evaluated together with array
+            Horner steps, gathering one coefficient column per step.
+            Times are processed in chunks to bound the memory.
+
+            longdouble -- if True, use extended precision for the arithmetic
+        """
         if not hasattr(times,'__len__'):
             times = [times]
-        pces = self.getentry(times,use_keys=True)
-        self.ids = np.asarray([pc.uid for pc in pces])
-        return np.asarray(map(func,pces,times))
+        times = np.asarray(times)
+        idx = self.getindex(times)
+        self.ids = self.uids[idx]
+        dtype = np.longdouble if longdouble else np.float64
+        coeffs = self.coeffs.astype(dtype)
+        nc = coeffs.shape[1]
+        if func is PolycoEntry.evalfreq:
+            coeffs = coeffs[:,1:]*np.arange(1,nc)
+        elif func is PolycoEntry.evalfreqderiv:
+            coeffs = coeffs[:,2:]*(np.arange(2,nc)*np.arange(1,nc-1))
+        absphase = func is PolycoEntry.evalabsphase
+        phase = absphase or func is PolycoEntry.evalphase
+        tmids,rphases,f0s = [a.astype(dtype) for a in (self.tmids,self.rphases,self.f0s)]
+
+        result = np.empty(len(times),dtype=dtype)
+        for start in range(0,len(times),chunk):
+            sl = slice(start,start+chunk)
+            i = idx[sl]
+            dt = (times[sl].astype(dtype)-tmids[i])*1440.0
+            s = coeffs[i,-1] if coeffs.shape[1]>0 else np.zeros(len(dt),dtype=dtype)
+            for k in range(coeffs.shape[1]-2,-1,-1):
+                s = coeffs[i,k] + dt*s
+            if phase:
+                s += rphases[i] + dt*60.0*f0s[i]
+                if not absphase: s -= np.floor(s)
+            elif func is PolycoEntry.evalfreq:
+                s = f0s[i] + s/60.0
+            else:
+                s = s/(60.0*60.0)
+            result[sl] = s
+        return result
 
-    def vec_evalphase(self,times):
+    def vec_evalphase(self,times,**kwargs):
         """ Return the phases for a vector of times; NB times should be in
-            MJD @ GEO."""
-        return self._vec_eval(times,PolycoEntry.evalphase)
+            MJD @ GEO.  kwargs are passed to _vec_eval."""
+        return self._vec_eval(times,PolycoEntry.evalphase,**kwargs)
 
-    def vec_evalabsphase(self,times):
+    def vec_evalabsphase(self,times,**kwargs):
         """ Return the phases for a vector of times; NB times should be in
-            MJD @ GEO."""
-        return self._vec_eval(times,PolycoEntry.evalabsphase)
+            MJD @ GEO.  kwargs are passed to _vec_eval."""
+        return self._vec_eval(times,PolycoEntry.evalabsphase,**kwargs)
 
-    def vec_evalfreq(self,times):
+    def vec_evalfreq(self,times,**kwargs):
         """ Return the phases for a vector of times; NB times should be in
-            MJD @ GEO."""
-        return self._vec_eval(times,PolycoEntry.evalfreq)
+            MJD @ GEO.  kwargs are passed to _vec_eval."""
+        return self._vec_eval(times,PolycoEntry.evalfreq,**kwargs)
 
-    def vec_evalfreqderiv(self,times):
+    def vec_evalfreqderiv(self,times,**kwargs):
         """ Return the phases for a vector of times; NB times should be in
-            MJD @ GEO."""
-        return self._vec_eval(times,PolycoEntry.evalfreqderiv)
+            MJD @ GEO.  kwargs are passed to _vec_eval."""
+        return self._vec_eval(times,PolycoEntry.evalfreqderiv,**kwargs)
 
     def invert_phase_shift(self,t0,phi):
         """ Compute the time lapse (in s) corresponding to phi at t0."""
@@ -14,11 +14,18 @@ import numpy as N
 from math import sin,cos
 import astropy.io.fits as pf
 import uw.utilities.fitstools as fitstools
-from skymaps import Gti,Band,Healpix,SkyDir
+from skymaps import Gti,Band,SkyDir
 from os.path import join
+import healpy
 
 DEG2RAD = N.pi/180.
 
+def unit_vectors(ra,dec):
+    """Return an (n,3) array of unit vectors for ra, dec in radians."""
+    ra,dec = N.asarray(ra,dtype=float),N.asarray(dec,dtype=float)
+    cdec = N.cos(dec)
+    return N.asarray([cdec*N.cos(ra),cdec*N.sin(ra),N.sin(dec)]).T
+
 # TODO -- convert to the sqrt(1-cos(theta)) binning adopted in the ST
 
 class Livetime(object):
@@ -50,6 +57,8 @@ class Livetime(object):
             if ('DEC_' in field):
                 self.__dict__['COS_'+field] = N.cos(self.__dict__[field])
                 self.__dict__['SIN_'+field] = N.sin(self.__dict__[field])
+        self.SCZ_VEC    = unit_vectors(self.RA_SCZ,self.DEC_SCZ)
+        self.ZENITH_VEC = unit_vectors(self.RA_ZENITH,self.DEC_ZENITH)
 
     def __init__(self,ft2files,ft1files,**kwargs):
         self.init()
@@ -207,9 +216,83 @@ class Livetime(object):
             return self.prev_val
 
         # return a time series for the livetime at the given position
-        overlaps = [self.__process_ft2_fast([intervals[i][0]],[intervals[i][1]])[mask] for i in range(len(starts))]
-        livetimes= [N.histogram(scosines[mask],bins=self.cosbins,weights=self.LIVETIME[mask]*ol,new=True) for ol in overlaps]
-        return livetimes
+        livetimes = self.batch([skydir],intervals)[0]
+        return [(lt,self.cosbins) for lt in livetimes]
+
+    def _cosine_function(self,vecs):
+        """Return a function of a slice of FT2 rows that returns the cosines
+           of the angles between the directions with unit vectors vecs and the
+           S/C z-axis, and zenith (or None if no zenith cut), shape (N,rows)."""
+        s,z = self.SCZ_VEC,self.ZENITH_VEC
+        zenith = self.zenithcut > -1
+        return lambda sl: (N.dot(vecs,s[sl].T), N.dot(vecs,z[sl].T) if zenith else None)
+
+    def batch(self,skydirs,intervals=None,chunk=None,threads=None):
+        """Return the livetime for N directions and M time intervals, an
+           array with shape (N,M,nbins) binned in cos(theta) with self.cosbins.
+           If intervals is None, M=1 for the full livetime.
+
+           The FT2 rows are processed in chunks, once for all the directions
+           and intervals, rather than once per direction per interval.
+
+           skydirs   -- a list of SkyDir objects, or an (N,2) array of (ra,dec)
+                        in degrees
+           intervals -- optional list of (tstart,tstop) pairs in MET
+           chunk     -- number of FT2 rows per chunk; default limits the
+                        (N,chunk) arrays to 4M elements
+           threads   -- if > 1, process chunks with a pool of this many
+                        threads; numpy releases the GIL for the arithmetic
+        """
+        if len(skydirs)>0 and hasattr(skydirs[0],'ra'):
+            radec = N.asarray([(sd.ra(),sd.dec()) for sd in skydirs])
+        else:
+            radec = N.asarray(skydirs,dtype=float).reshape(-1,2)
+        vecs = unit_vectors(*N.radians(radec).T)
+        ndir,nbins = len(vecs),len(self.cosbins)-1
+        cosfun = self._cosine_function(vecs)
+        t1,t2,lt = self.START,self.STOP,self.LIVETIME
+        if intervals is None:
+            i_starts = i_stops = None
+            nint = 1
+        else:
+            i_starts,i_stops = N.asarray(intervals,dtype=float).reshape(-1,2).T
+            nint = len(i_starts)
+        if chunk is None: chunk = max(1000,int(4e6)//max(ndir,1))
+
+        def chunk_livetime(start):
+            sl = slice(start,start+chunk)
+            scos,zcos = cosfun(sl)
+            # drop cosines outside the bins, as np.histogram does: the bins are made in init
+            # with the default fovcut, before a fovcut keyword is applied
+            mask = (scos >= self.fovcut) & (scos >= self.cosbins[0]) & (scos <= self.cosbins[-1])
+            if zcos is not None: mask &= zcos >= self.zenithcut
+            ibin = N.minimum(N.searchsorted(self.cosbins,scos,side='right')-1,nbins-1)
+            ibin = (N.arange(ndir)[:,None]*nbins + ibin)[mask]
+            rows = N.nonzero(mask)[1]
+            out = N.zeros((ndir,nint,nbins))
+            if intervals is None:
+                out[:,0,:] = N.bincount(ibin,weights=lt[sl][rows],minlength=ndir*nbins).reshape(ndir,nbins)
+                return out
+            a,b = t1[sl],t2[sl]
+            # only intervals overlapping this chunk contribute
+            for i in N.nonzero((i_stops > a[0]) & (i_starts < b[-1]))[0]:
+                frac = N.maximum(0,N.minimum(b,i_stops[i])-N.maximum(a,i_starts[i]))/(b-a)
+                w = (lt[sl]*frac)[rows]
+                sel = w > 0
+                out[:,i,:] = N.bincount(ibin[sel],weights=w[sel],minlength=ndir*nbins).reshape(ndir,nbins)
+            return out
+
+        starts = range(0,len(lt),chunk)
+        if threads is not None and threads > 1 and len(starts) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(threads)
+            try:
+                results = pool.map(chunk_livetime,starts)
+            finally:
+                pool.close()
+        else:
+            results = [chunk_livetime(start) for start in starts]
+        return N.sum(results,axis=0) if len(results)>0 else N.zeros((ndir,nint,nbins))
 
 #===============================================================================================#
 class BinnedLivetime(Livetime):
@@ -222,15 +305,17 @@ class BinnedLivetime(Livetime):
     """
 
     def finish(self):
-        hp = Healpix(self.nside,Healpix.RING,SkyDir.EQUATORIAL)
-        ras,decs = N.asarray( [hp.py_pix2ang(i) for i in range(12*self.nside**2)]).transpose()
+        # RING scheme in equatorial coordinates, with theta = pi/2 - dec, phi = ra
+        theta,ras = healpy.pix2ang(self.nside,N.arange(12*self.nside**2))
+        decs = N.pi/2 - theta
         self.COS_HP_DEC = N.cos(decs)
         self.SIN_HP_DEC = N.sin(decs)
         self.HP_RA = ras
+        self.HP_VEC = unit_vectors(ras,decs)
         ra_s,dec_s = self.RA_SCZ,self.DEC_SCZ
         ra_z,dec_z = self.RA_ZENITH,self.DEC_ZENITH
-        self.S_PIX = N.fromiter((hp.py_ang2pix(ra_s[i],dec_s[i]) for i in range(len(ra_s))),dtype=int)
-        self.Z_PIX = N.fromiter((hp.py_ang2pix(ra_z[i],dec_z[i]) for i in range(len(ra_z))),dtype=int)
+        self.S_PIX = healpy.ang2pix(self.nside,N.pi/2-dec_s,ra_s)
+        self.Z_PIX = healpy.ang2pix(self.nside,N.pi/2-dec_z,ra_z)
 
     def __init__(self,nside=59,*args,**kwargs):
         self.nside = nside
@@ -249,6 +334,11 @@ class BinnedLivetime(Livetime):
             mask = (scosines>=self.fovcut)
         return scosines,mask
 
+    def _cosine_function(self,vecs):
+        cosines = N.dot(vecs,self.HP_VEC.T)
+        zenith = self.zenithcut > -1
+        return lambda sl: (cosines[:,self.S_PIX[sl]], cosines[:,self.Z_PIX[sl]] if zenith else None)
+
 #===============================================================================================#
 class EfficiencyCorrection(object):
     v1 = [-1.381,  5.632, -0.830, 2.737, -0.127, 4.640]  # p0, front
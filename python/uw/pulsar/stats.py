@@ -104,39 +104,75 @@ def sigma_trials(sigma,trials):
       return (sigma**2 - 2*np.log(trials))**0.5
 
 
-def z2m(phases,m=2):
-    """ Return the Z^2_m test for each harmonic up to the specified m.
-        See de Jager et al. 1989 for definition.    
-    """
-
-    phases = np.asarray(phases)*TWOPI #phase in radians
-    n = len(phases)
+def harmonic_sums(phases,m=2,weights=None,chunk=65536,threads=None):
+    """ Return the complex sums over photons of weights*exp(2 pi i k phase), k = 1..m.
+        The real and imaginary parts are the cosine and sine sums used by the
+        Z^2_m and H tests, and the empirical Fourier coefficients.
 
-    if n < 5e3:  #faster for 100s to 1000s of phases, but requires ~20x memory of alternative
+        Successive harmonics are obtained by the recurrence z_k = z_(k-1)*z_1,
+        so only one complex exponential is evaluated per photon.  Photons are
+        processed in chunks to bound the memory.
 
-        s = (np.cos(np.outer(np.arange(1,m+1),phases))).sum(axis=1)**2 +\
-            (np.sin(np.outer(np.arange(1,m+1),phases))).sum(axis=1)**2
+        args
+        ----
+        phases  photon phases, 0 to 1
+        m       maximum harmonic
+
+        kwargs
+        ------
+        weights [None] photon weights; if None, all weights are 1
+        chunk   [65536] number of photons per chunk
+        threads [None] if > 1, sum the chunks with a pool of this many
+                       threads; numpy releases the GIL for the arithmetic
+    """
+    phases = np.asarray(phases,dtype=float).ravel()
+    if weights is not None:
+        weights = np.asarray(weights,dtype=float).ravel()
+    n = len(phases)
 
+    def chunk_sums(start):
+        z1 = np.exp((TWOPI*1j)*phases[start:start+chunk])
+        w = None if weights is None else weights[start:start+chunk]
+        z = z1.copy()
+        sums = np.empty(m,dtype=complex)
+        for k in range(m):
+            sums[k] = z.sum() if w is None else np.dot(w,z)
+            if k < m-1: z *= z1
+        return sums
+
+    starts = range(0,n,chunk)
+    if threads is not None and threads > 1 and len(starts) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+        try:
+            results = pool.map(chunk_sums,starts)
+        finally:
+            pool.close()
     else:
+        results = [chunk_sums(start) for start in starts]
+    return np.sum(results,axis=0) if len(results)>0 else np.zeros(m,dtype=complex)
 
-        s = (np.asarray([(np.cos(k*phases)).sum() for k in range(1,m+1)]))**2 +\
-            (np.asarray([(np.sin(k*phases)).sum() for k in range(1,m+1)]))**2
+def z2m(phases,m=2,**kwargs):
+    """ Return the Z^2_m test for each harmonic up to the specified m.
+        See de Jager et al. 1989 for definition.    
+        kwargs are passed to harmonic_sums.
+    """
 
+    n = len(phases)
+    s = np.abs(harmonic_sums(phases,m,**kwargs))**2
     return (2./n)*np.cumsum(s)
 
-def z2mw(phases,weights,m=2):
+def z2mw(phases,weights,m=2,**kwargs):
    """ Return the Z^2_m test for each harmonic up to the specified m.
 
        The user provides a list of weights.  In the case that they are
        well-distributed or assumed to be fixed, the CLT applies and the
        statistic remains calibrated.  Nice!
+       kwargs are passed to harmonic_sums.
     """
 
-   phases = np.asarray(phases)*(2*np.pi) #phase in radians
-
-   s = (np.asarray([(np.cos(k*phases)*weights).sum() for k in range(1,m+1)]))**2 +\
-       (np.asarray([(np.sin(k*phases)*weights).sum() for k in range(1,m+1)]))**2
-
+   weights = np.asarray(weights)
+   s = np.abs(harmonic_sums(phases,m,weights=weights,**kwargs))**2
    return np.cumsum(s) * (2./(weights**2).sum())
 
 def sf_z2m(ts,m=2):
@@ -158,15 +194,11 @@ def em_four(phases,m=2,weights=None):
     """ Return the empirical Fourier coefficients up to the mth harmonic.
         These are derived from the empirical trignometric moments."""
    
-    phases = np.asarray(phases)*TWOPI #phase in radians
-
     n = len(phases) if weights is None else weights.sum()
-    weights = 1. if weights is None else weights
 
-    aks = (1./n)*np.asarray([(weights*np.cos(k*phases)).sum() for k in range(1,m+1)])
-    bks = (1./n)*np.asarray([(weights*np.sin(k*phases)).sum() for k in range(1,m+1)])
+    sums = (1./n)*harmonic_sums(phases,m,weights=weights)
 
-    return aks,bks
+    return sums.real,sums.imag
 
 def em_lc(coeffs,dom):
     """ Evaluate the light curve at the provided phases (0 to 1) for the
@@ -180,32 +212,24 @@ def em_lc(coeffs,dom):
         rval += 2*(aks[i-1]*np.cos(i*dom) + bks[i-1]*np.sin(i*dom))
     return rval
 
-def hm(phases,m=20,c=4):
+def hm(phases,m=20,c=4,**kwargs):
     """ Calculate the H statistic (de Jager et al. 1989) for given phases.
         H_m = max(Z^2_k - c*(k-1)), 1 <= k <= m
         m == maximum search harmonic
         c == offset for each successive harmonic
+        kwargs are passed to harmonic_sums
     """
-    phases = np.asarray(phases)*(2*np.pi) #phase in radians
-
-    s = (np.asarray([(np.cos(k*phases)).sum() for k in range(1,m+1)]))**2 +\
-        (np.asarray([(np.sin(k*phases)).sum() for k in range(1,m+1)]))**2
-
-    return ((2./len(phases))*np.cumsum(s) - c*np.arange(0,m)).max()
+    return (z2m(phases,m,**kwargs) - c*np.arange(0,m)).max()
 
 
-def hmw(phases,weights,m=20,c=4):
+def hmw(phases,weights,m=20,c=4,**kwargs):
     """ Calculate the H statistic (de Jager et al. 1989) and weight each
         sine/cosine with the weights in the argument.  The distribution
         is corrected such that the CLT still applies, i.e., it maintains
-        the same calibration as the unweighted version."""
-
-    phases = np.asarray(phases)*(2*np.pi) #phase in radians
-
-    s = (np.asarray([(weights*np.cos(k*phases)).sum() for k in range(1,m+1)]))**2 +\
-        (np.asarray([(weights*np.sin(k*phases)).sum() for k in range(1,m+1)]))**2
+        the same calibration as the unweighted version.
+        kwargs are passed to harmonic_sums"""
 
-    return ( (2./(weights**2).sum()) * np.cumsum(s) - c*np.arange(0,m) ).max()
+    return (z2mw(phases,weights,m,**kwargs) - c*np.arange(0,m)).max()
 
 
 #@vec
@@ -0,0 +1,102 @@
+"""
+Tests of the light curve fitters: run with python -m unittest uw.pulsar.test_lcfitters
+"""
+import unittest
+import numpy as np
+from uw.pulsar import lctemplate, lcfitters
+
+def slice_binning(f):
+    """ the weighted bin centers and photon slices of the previous mask loop in _hist_setup """
+    bins = np.linspace(0+f.phase_shift, 1+f.phase_shift, f.binned_bins+1)
+    centers, slices = [], []
+    indices = np.arange(len(f.weights))
+    for i in range(f.binned_bins):
+        mask = (f.phases >= bins[i]) & (f.phases < bins[i+1])
+        if mask.sum() > 0:
+            w = f.weights[mask]
+            if w.sum()==0: continue
+            centers.append((w*f.phases[mask]).sum()/w.sum())
+            slices.append(slice(indices[mask].min(), indices[mask].max()+1))
+    return np.asarray(centers), slices
+
+def numerical_gradient(func, p, eps=1e-6):
+    g = []
+    for k in range(len(p)):
+        q = p.copy(); q[k] += eps; a = func(q)
+        q[k] -= 2*eps; g.append((a-func(q))/(2*eps))
+    return np.asarray(g)
+
+class TestWeightedFitter(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(3)
+        self.template = lctemplate.get_gauss2(pulse_frac=0.3)
+        self.phases = self.template.random(2000)
+        self.weights = np.random.uniform(0.2, 1, 2000)
+        self.fitter = lcfitters.LCFitter(self.template, self.phases, self.weights)
+        self.p = self.template.get_parameters().copy()
+
+    def test_bootstrap_restores_grid(self):
+        """ the grid likelihood is for the original photons after a bootstrap """
+        f = self.fitter
+        f._set_unbinned('grid')
+        ll = f.loglikelihood(self.p)
+        f.bootstrap_errors(nsamp=2, fit_kwargs=dict(unbinned='grid'), seed=1)
+        self.assertAlmostEqual(f.loglikelihood(self.p), ll, places=8)
+        self.assertTrue(np.all(self.template.get_parameters()==self.p))
+
+    def test_bootstrap_processes(self):
+        """ the refits in a pool are the same as the serial ones for a given seed """
+        serial = self.fitter.bootstrap_errors(nsamp=4, seed=5)
+        pooled = self.fitter.bootstrap_errors(nsamp=4, seed=5, processes=2)
+        self.assertTrue(np.all(pooled==serial))
+        self.assertTrue(np.all(self.template.get_parameters()==self.p))
+
+    def test_get_errors_seed(self):
+        """ the trials depend only on the seed, and leave the global generator alone """
+        state = np.random.get_state()
+        serial = lcfitters.get_errors(self.template, 200, n=3, seed=2)
+        self.assertTrue(np.all(np.random.get_state()[1]==state[1]))
+        pooled = lcfitters.get_errors(self.template, 200, n=3, seed=2, processes=2)
+        # set_overall_phase may move the template by a rounding error between the runs
+        for a, b in zip(serial, pooled):
+            self.assertTrue(np.allclose(a, b, rtol=1e-10, atol=0))
+
+    def test_binned(self):
+        """ the binned likelihood and gradient, as with the previous slice loops """
+        f, t = self.fitter, self.template
+        centers, slices = slice_binning(f)
+        self.assertTrue(np.allclose(f.counts_centers, centers, rtol=0, atol=1e-12))
+        template_terms = np.empty_like(f.weights)
+        gradient_terms = np.empty([len(self.p), len(f.weights)])
+        for tt, gt, sl in zip(t(centers)-1, t.gradient(centers).transpose(), slices):
+            template_terms[sl] = tt
+            gradient_terms[:, sl] = gt[:, None]
+        denom = 1+f.weights*template_terms
+        f._set_unbinned(False)
+        self.assertAlmostEqual(f.loglikelihood(self.p), -np.log(denom).sum(), places=8)
+        self.assertTrue(np.allclose(f.gradient(self.p), -(f.weights*gradient_terms/denom).sum(axis=1),
+            rtol=1e-10, atol=1e-8))
+        g = numerical_gradient(f.loglikelihood, self.p)
+        self.assertLess(np.abs(f.gradient(self.p)-g).max(), 1e-4*np.abs(g).max())
+
+    def test_grid(self):
+        """ the grid likelihood is close to the unbinned one, and its gradient is exact """
+        f = self.fitter
+        f._set_unbinned(True)
+        ll, grad = f.loglikelihood(self.p), f.gradient(self.p)
+        f._set_unbinned('grid')
+        accuracy = f.grid_accuracy()
+        self.assertLess(accuracy, 1e-3)
+        self.assertAlmostEqual(f.loglikelihood(self.p), ll, delta=5e-3)
+        self.assertLess(np.abs(f.gradient(self.p)-grad).max(), 5e-3*np.abs(grad).max())
+        g = numerical_gradient(f.loglikelihood, self.p)
+        self.assertLess(np.abs(f.gradient(self.p)-g).max(), 1e-4*np.abs(g).max())
+        # the interpolation error scales as grid_bins**-2
+        f.grid_bins = 2*lcfitters.WeightedLCFitter.grid_bins
+        f._set_unbinned('grid')
+        self.assertAlmostEqual(f.grid_accuracy()/accuracy, 0.25, delta=0.05)
+
+
+if __name__=='__main__':
+    unittest.main()
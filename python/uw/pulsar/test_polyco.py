@@ -0,0 +1,69 @@
+"""
+Tests of the vectorized polyco evaluation: run with python -m unittest uw.pulsar.test_polyco
+"""
+import unittest
+import numpy as np
+from uw.pulsar.polyco import Polyco, PolycoEntry
+
+def make_polyco(nentries=8, mjd0=55000., span=360):
+    """ a Polyco with contiguous entries of span minutes, not all with the same number of coefficients """
+    rng = np.random.RandomState(6)
+    p = Polyco.__new__(Polyco)
+    p.verbose = False
+    mjdspan = span/1440.
+    p.entries = []
+    for k in range(nentries):
+        ncoeff = 12 if k%3 else 8
+        coeffs = rng.normal(size=ncoeff)*10.**(-3*np.arange(ncoeff))
+        p.entries.append(PolycoEntry(mjd0+(k+0.5)*mjdspan, span/1440., 1e6*k+rng.uniform(),
+            29.7+1e-6*k, ncoeff, coeffs, 'coe'))
+    # the keys are sorted in make_keys
+    p.entries = p.entries[::-1]
+    p.make_keys()
+    return p
+
+
+class TestPolyco(unittest.TestCase):
+
+    def setUp(self):
+        self.polyco = make_polyco()
+        lo, hi = self.polyco.keys[0], self.polyco.keys[-1]
+        self.times = np.random.RandomState(7).uniform(lo, hi, 2000)
+
+    def scalar(self, func):
+        """ evaluate with the entry for each time, as before """
+        return np.asarray([func(self.polyco.getentry(t), t) for t in self.times])
+
+    def check(self, func, vfunc, tol, wrap=False):
+        expect = self.scalar(func)
+        for kwargs in (dict(), dict(chunk=300), dict(longdouble=True)):
+            diff = vfunc(self.times, **kwargs)-expect
+            if wrap: diff -= np.round(diff)
+            self.assertLess(np.abs(diff).max(), tol*max(1, np.abs(expect).max()), str(kwargs))
+
+    def test_phase(self):
+        self.check(PolycoEntry.evalphase, self.polyco.vec_evalphase, 1e-9, wrap=True)
+
+    def test_absphase(self):
+        self.check(PolycoEntry.evalabsphase, self.polyco.vec_evalabsphase, 1e-14)
+
+    def test_freq(self):
+        self.check(PolycoEntry.evalfreq, self.polyco.vec_evalfreq, 1e-12)
+
+    def test_freqderiv(self):
+        self.check(PolycoEntry.evalfreqderiv, self.polyco.vec_evalfreqderiv, 1e-12)
+
+    def test_ids(self):
+        self.polyco.vec_evalphase(self.times)
+        self.assertTrue(np.all(self.polyco.ids==[self.polyco.getentry(t).uid for t in self.times]))
+
+    def test_scalar_time(self):
+        t = self.times[0]
+        self.assertAlmostEqual(self.polyco.vec_evalfreq(t)[0], self.polyco.getentry(t).evalfreq(t), places=10)
+
+    def test_bounds(self):
+        self.assertRaises(IndexError, self.polyco.vec_evalphase, [self.polyco.keys[-1]+1])
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Tests of the livetime calculation: run with python -m unittest uw.pulsar.test_py_exposure
+"""
+import unittest
+import numpy as np
+from skymaps import SkyDir
+from uw.pulsar import py_exposure
+
+def synthetic_livetime(nrows=5000, **kwargs):
+    """ a Livetime with a synthetic FT2 array of contiguous 30 s intervals, set up as by __init__ 
+    after reading the files and applying the GTI """
+    rng = np.random.RandomState(9)
+    lt = py_exposure.Livetime.__new__(py_exposure.Livetime)
+    lt.init()
+    lt.__dict__.update(kwargs)
+    lt.prev_vals = lt.prev_ra = lt.prev_dec = None
+    lt.fields = ['START','STOP','LIVETIME','RA_SCZ','DEC_SCZ','RA_ZENITH','DEC_ZENITH']
+    lt.START = 1e8+30.*np.arange(nrows)
+    lt.STOP = lt.START+30
+    lt.LIVETIME = rng.uniform(20, 28, nrows)
+    # a slowly rocking pointing, with the zenith about 50 degrees away
+    phase = np.arange(nrows)*(2*np.pi/190)
+    lt.RA_SCZ, lt.DEC_SCZ = np.mod(phase, 2*np.pi), np.radians(50*np.sin(phase/3))
+    lt.RA_ZENITH, lt.DEC_ZENITH = np.mod(phase+0.9, 2*np.pi), np.radians(50*np.sin(phase/3+0.3))
+    lt.finish()
+    return lt
+
+
+class TestLivetime(unittest.TestCase):
+
+    def setUp(self):
+        self.skydirs = [SkyDir(ra, dec) for ra, dec in ((0, 0), (83.6, 22.0), (250, -40), (180, 60))]
+
+    def histogram(self, lt, skydir, weights=None):
+        """ the unbinned calculation before batch """
+        scosines, mask = lt.get_cosines(skydir)
+        w = lt.LIVETIME if weights is None else lt.LIVETIME*weights
+        return np.histogram(scosines[mask], bins=lt.cosbins, weights=w[mask])[0]
+
+    def check(self, lt):
+        expect = np.array([self.histogram(lt, sd) for sd in self.skydirs])
+        self.assertGreater(expect.sum(), 0)
+        for kwargs in (dict(), dict(chunk=700), dict(chunk=700, threads=3)):
+            result = lt.batch(self.skydirs, **kwargs)
+            self.assertEqual(result.shape, (4, 1, lt.nbins))
+            self.assertTrue(np.allclose(result[:,0,:], expect, rtol=1e-12, atol=1e-6), str(kwargs))
+        radec = [(sd.ra(), sd.dec()) for sd in self.skydirs]
+        self.assertTrue(np.allclose(lt.batch(radec)[:,0,:], expect, rtol=1e-12, atol=1e-6))
+
+    def test_batch(self):
+        self.check(synthetic_livetime())
+        self.check(synthetic_livetime(zenithcut=-1))
+
+    def test_fovcut(self):
+        """ cosines between fovcut and the first bin are dropped """
+        lt = synthetic_livetime(fovcut=0.2)
+        self.assertEqual(lt.cosbins[0], 0.4)
+        self.check(lt)
+
+    def test_intervals(self):
+        """ time-binned livetimes, as from the overlap of each interval with the FT2 rows """
+        lt = synthetic_livetime()
+        t0, t1 = lt.START[0], lt.STOP[-1]
+        edges = np.linspace(t0+100, t1-100, 7)
+        # include an interval within a single FT2 row, and one not overlapping the chunks
+        intervals = list(zip(edges[:-1], edges[1:])) + [(t0+1000, t0+1010), (t0+2000.5, t0+2000.5)]
+        result = lt.batch(self.skydirs, intervals, chunk=700)
+        for i, (a, b) in enumerate(intervals):
+            overlap = lt._Livetime__process_ft2_fast([a], [b])
+            for k, sd in enumerate(self.skydirs):
+                expect = self.histogram(lt, sd, overlap)
+                self.assertTrue(np.allclose(result[k,i], expect, rtol=1e-10, atol=1e-6), 'interval %d' % i)
+        # the calls for a single direction
+        for (lts, bins), expect in zip(lt(self.skydirs[1], intervals), result[1]):
+            self.assertTrue(np.allclose(lts, expect, rtol=1e-12, atol=1e-6))
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+"""
+Tests of the pulsation test statistics: run with python -m unittest uw.pulsar.test_stats
+"""
+import unittest
+import numpy as np
+from uw.pulsar import stats
+
+def direct_sums(phases, m, weights=None):
+    """ cosine and sine sums evaluated for each harmonic, as before the recurrence """
+    phases = np.asarray(phases)*stats.TWOPI
+    w = np.ones_like(phases) if weights is None else weights
+    return np.asarray([(w*np.cos(k*phases)).sum()+1j*(w*np.sin(k*phases)).sum() for k in range(1, m+1)])
+
+
+class TestHarmonicSums(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.phases = np.mod(rng.normal(0.3, 0.05, 20003), 1)
+        self.phases[:10000] = rng.uniform(0, 1, 10000)
+        self.weights = rng.uniform(0, 1, 20003)
+
+    def check(self, actual, expect):
+        self.assertLess(np.abs(actual-expect).max(), 1e-8*np.abs(expect).max())
+
+    def test_sums(self):
+        m = 20
+        for weights in (None, self.weights):
+            expect = direct_sums(self.phases, m, weights)
+            for kwargs in (dict(), dict(chunk=1000), dict(chunk=1000, threads=4)):
+                self.check(stats.harmonic_sums(self.phases, m, weights=weights, **kwargs), expect)
+
+    def test_statistics(self):
+        s = np.abs(direct_sums(self.phases, 20))**2
+        self.check(stats.z2m(self.phases, 20), (2./len(self.phases))*np.cumsum(s))
+        self.assertAlmostEqual(stats.hm(self.phases),
+            ((2./len(self.phases))*np.cumsum(s)-4*np.arange(20)).max(), places=6)
+        w = self.weights
+        s = np.abs(direct_sums(self.phases, 20, w))**2
+        self.assertAlmostEqual(stats.hmw(self.phases, w, chunk=1000),
+            ((2./(w**2).sum())*np.cumsum(s)-4*np.arange(20)).max(), places=6)
+
+    def test_empty(self):
+        self.assertTrue(np.all(stats.harmonic_sums([], 3)==0))
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+Tests of the clock corrections: run with python -m unittest uw.pulsar.test_timeman
+"""
+import os, shutil, tempfile, unittest
+import numpy as np
+import astropy.io.fits as pyfits
+from uw.pulsar import timeman
+
+# MJD and TAI-UTC of the leap seconds from 2006 to 2017, as in utc2tai.clk
+leapsecs = [(53736, 33), (54832, 34), (56109, 35), (57204, 36), (57754, 37)]
+mjdref = 51910+7.428703703703703e-4
+
+def scalar_corr(cc, utc):
+    """ the previous ClockCorr.getcorr, for a single time """
+    return cc.dt[np.where(cc.mjds<utc)[0][-1]]
+
+
+class TestClockCorr(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.folder, 'clock'))
+        np.savetxt(os.path.join(self.folder, 'clock', 'utc2tai.clk'), leapsecs, fmt='%d')
+        self.saved = os.environ.get('TEMPO2')
+        os.environ['TEMPO2'] = self.folder
+        self.cc = timeman.ClockCorr()
+        rng = np.random.RandomState(8)
+        mjds = np.array([m for m, dt in leapsecs])
+        # random times, and times at and within a minute of each leap second
+        self.utc = np.concatenate([rng.uniform(53737, 58500, 1000),
+            mjds[1:], mjds[1:]+1e-9, mjds[1:]-1e-9, mjds[1:]+5e-4, mjds[1:]-5e-4])
+
+    def tearDown(self):
+        if self.saved is None: os.environ.pop('TEMPO2')
+        else: os.environ['TEMPO2'] = self.saved
+        shutil.rmtree(self.folder)
+
+    def test_getcorr(self):
+        expect = [scalar_corr(self.cc, t) for t in self.utc]
+        self.assertTrue(np.all(self.cc.getcorr(self.utc)==expect))
+        self.assertEqual(self.cc.getcorr(self.utc[0]), expect[0])
+        self.assertRaises(IndexError, self.cc.getcorr, [leapsecs[0][0]-1])
+
+    def test_conversions(self):
+        cc = self.cc
+        tt = cc.tai2tt(self.utc)
+        utc = cc.tt2utc(tt)
+        for i in range(0, len(tt), 50):
+            self.assertEqual(utc[i], cc.tt2utc(tt[i]))
+        self.assertTrue(np.all(cc.utc2tai(self.utc)==[cc.utc2tai(t) for t in self.utc]))
+
+    def test_met_converter(self):
+        """ the chunked conversion is the same as the loop over photons """
+        met = (self.utc-mjdref)*timeman.SECSPERDAY+40
+        hdu = pyfits.BinTableHDU.from_columns([pyfits.Column(name='TIME', format='D', array=met)],
+            name='EVENTS')
+        for key, value in dict(TIMEREF='GEOCENTRIC', TIMESYS='TT', TIMEZERO=0., MJDREF=mjdref,
+                TSTART=met.min(), TSTOP=met.max()).items():
+            hdu.header[key] = value
+        ft1 = os.path.join(self.folder, 'ft1.fits')
+        pyfits.HDUList([pyfits.PrimaryHDU(), hdu]).writeto(ft1)
+        mc = timeman.METConverter(ft1)
+        expect = [self.cc.tt2utc(t/timeman.SECSPERDAY+mjdref) for t in met]
+        self.assertTrue(np.all(mc(met, chunk=100)==expect))
+        self.assertEqual(mc(met[0]), expect[0])
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -22,9 +22,11 @@ class ClockCorr(object):
         self.mjds = mjd
         self.dt = dt
     def getcorr(self,utc):
-        '''Return value of TAI-UTC at a given MJD(UTC)'''
-        idx = np.where(self.mjds<utc)[0][-1]
-        #print (utc, idx, self.mjds[idx], self.dt[idx])
+        '''Return value of TAI-UTC at a given MJD(UTC), or array of MJDs'''
+        # index of the last table entry before each time
+        idx = np.searchsorted(self.mjds,utc,side='left') - 1
+        if np.any(idx < 0):
+            raise IndexError('MJD before start of clock correction table (%s)'%self.mjds[0])
         corr = self.dt[idx]
         return(corr)
     def tt2tai(self,tt):
@@ -164,25 +166,26 @@ class METConverter(object):
 
         hdulist.close()
 
-    def __call__(self,times):
-        """ Convert MET to MJD(UTC)/GEO."""
+    def __call__(self,times,chunk=1000000):
+        """ Convert MET to MJD(UTC)/GEO.
+            The geo/bary step, the conversion to MJD, and the clock
+            correction are applied together to chunks of the times."""
         times = np.asarray([times] if not hasattr(times,'__iter__') else times)
-        times = self.timecon(times)
-        times = times/SECSPERDAY + self.MJDREF + self.TIMEZERO
         # disable clock corrections for SSB times
-        if (not self.bary) and (not self.noprocess):
-            for i in range(len(times)):
-                times[i] = self.clockcorr.tt2utc(times[i])
-        if len(times) == 1: return times[0]
-        return times
+        clockcorr = (not self.bary) and (not self.noprocess)
+        mjds = np.empty(len(times),dtype=np.float64)
+        for start in range(0,len(times),chunk):
+            t = self.timecon(times[start:start+chunk])
+            t = t/SECSPERDAY + self.MJDREF + self.TIMEZERO
+            mjds[start:start+chunk] = self.clockcorr.tt2utc(t) if clockcorr else t
+        if len(mjds) == 1: return mjds[0]
+        return mjds
 
 # standalone function for converting non-FT1 based METs
 def met2mjd_utc(times,mjdref=51910+7.428703703703703e-4,tzero=0):
     clockcorr = ClockCorr()
     times = np.asarray([times] if not hasattr(times,'__iter__') else times)
-    times = times/SECSPERDAY + mjdref + tzero # copy
-    for i in range(len(times)):
-        times[i] = clockcorr.tt2utc(times[i])
+    times = clockcorr.tt2utc(times/SECSPERDAY + mjdref + tzero)
     if len(times) == 1: return times[0]
     return times
     
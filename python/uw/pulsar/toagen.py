@@ -7,6 +7,7 @@ Authors: Paul S. Ray <paul.ray@nrl.navy.mil>
 
 from __future__ import division
 import sys
+import copy
 import numpy as np
 import pylab as pl
 import scipy.stats
@@ -14,6 +15,7 @@ from scipy.optimize import fmin,golden,brentq
 from stats import hm,hmw,sf_hm
 from edf import EDF,find_alignment
 from collections import deque
+import lcparallel
 
 try:
     import fftfit
@@ -142,6 +144,7 @@ class UnbinnedTOAGenerator(TOAGenerator):
         self.plot_stem = None
         self.display = True
         self.likelihood_threshold = 5
+        self.processes = None # if > 1, scan the likelihood profile in parallel
 
     def __toa_error__(self,val,*args):
         f      = self.__toa_loglikelihood__
@@ -252,9 +255,15 @@ class UnbinnedTOAGenerator(TOAGenerator):
             seed = self.prev_peak
         else:
             seed = None
+        logl,logl_args = f,(phases,weights)
+        if self.processes is not None and self.processes > 1:
+            # a bound method does not pickle under python 2, so the pool
+            # gets a module function and a copy of self without the data
+            g = copy.copy(self); g.data = g.polyco = None
+            logl,logl_args = _toa_loglikelihood,(g,phases,weights)
         x0,x0_err,best_ll = profile_analysis(
-            f,(phases,weights),pred_phase=seed,plot_output=plot_output,
-            thresh=self.likelihood_threshold)
+            logl,logl_args,pred_phase=seed,plot_output=plot_output,
+            thresh=self.likelihood_threshold,processes=self.processes)
         if x0_err < 1e2:
             self.prev_peak = x0
         else:
@@ -399,7 +408,6 @@ class UnbinnedTOAGeneratorProfileAmplitude(UnbinnedTOAGenerator):
     def init(self):
         super(UnbinnedTOAGeneratorProfileAmplitude,self).init()
         #self._saved_p = self.template.get_parameters()
-        self.basic_likelihood = super(UnbinnedTOAGeneratorProfileAmplitude,self).__toa_loglikelihood__
 
     def __toa_loglikelihood__(self,p,*args):
 
@@ -431,7 +439,7 @@ class UnbinnedTOAGeneratorProfileAmplitude(UnbinnedTOAGenerator):
         logls = np.asarray(map(logl,grid))
         bestidx = np.argmin(logls)
         self.template.norms.set_total(grid[bestidx])
-        return self.basic_likelihood(p,*args)
+        return super(UnbinnedTOAGeneratorProfileAmplitude,self).__toa_loglikelihood__(p,*args)
 
 class BinnedTOAGenerator(TOAGenerator):
 
@@ -570,13 +578,19 @@ class EDFTOAGenerator(TOAGenerator):
         #tau_err = 0.02
         return peak_shift-polyco_phase0,tau_err,sf_hm(hm(phases)),0
 
+def _toa_loglikelihood(p,generator,*args):
+    """ generator.__toa_loglikelihood__(p,*args), picklable for a pool."""
+    return generator.__toa_loglikelihood__(p,*args)
+
 def profile_analysis(logl,logl_args,pred_phase=None,nsamp=100,thresh=5,
-    plot_output=None,max_jump=0.25):
+    plot_output=None,max_jump=0.25,processes=None):
+    """ processes -- if > 1, evaluate the profile grid in a pool of
+                     processes; logl must then be picklable."""
 
     # (0) establish profile
     f = lambda x: logl([x],*logl_args)
     dom = np.linspace(0,1,nsamp+1)[:-1]
-    cod = np.asarray(map(f,dom))
+    cod = lcparallel.scan(logl,[[x] for x in dom],logl_args,processes=processes)
 
     # (1) find all local minima
     mask = (cod < np.roll(cod,1)) & (cod < np.roll(cod,-1))
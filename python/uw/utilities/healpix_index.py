@@ -0,0 +1,113 @@
+"""
+Tables relating HEALPix pixelizations with different nside, RING ordering
+
+The main use is to find the nside=512 (say) pixels that belong to each nside=12 ROI.
+A table for (nside, subnside) is a CSR-style pair of arrays:
+    children : all subnside pixels, sorted by parent pixel, then index
+    offsets  : for each nside pixel, the start of its children, with the total as the last entry
+so the children of pixel i are children[offsets[i]:offsets[i+1]].
+
+The parent of each sub-pixel is the nside pixel containing its center. When both nside values are
+powers of 2, this is a shift in the NEST scheme; otherwise the centers are used.
+Tables are kept in memory, and, if the folder is writable, saved there as .npy files that are
+memory-mapped when loaded.
+
+functions:
+    index_table : return an IndexTable object
+    make_index_table : same, replaces the versions that generated pickled lists of arrays
+"""
+import os
+import numpy as np
+import healpy
+
+# folder for saved tables
+folder = '$FERMI/misc'
+
+# tables already created or loaded by this process
+_tables = dict()
+
+def parents(nside, subnside):
+    """ return an array with the RING index of the nside pixel containing each subnside pixel
+    """
+    nsubpix = 12*subnside**2
+    if healpy.isnsideok(nside, nest=True) and healpy.isnsideok(subnside, nest=True) and subnside>=nside:
+        shift = 2*int(round(np.log2(subnside//nside)))
+        sub_nest = healpy.ring2nest(subnside, np.arange(nsubpix))
+        return healpy.nest2ring(nside, np.right_shift(sub_nest, shift))
+    theta, phi = healpy.pix2ang(subnside, np.arange(nsubpix))
+    return healpy.ang2pix(nside, theta, phi)
+
+
+class IndexTable(object):
+    """ The subnside pixels within each nside pixel. Indexing with an nside pixel
+    returns a (read-only, if memory-mapped) array of its subnside pixels, in increasing order
+    """
+    def __init__(self, nside, subnside, children=None, offsets=None):
+        self.nside, self.subnside = nside, subnside
+        if children is None:
+            parent = parents(nside, subnside)
+            children = np.argsort(parent, kind='mergesort').astype(np.int32)
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(parent, minlength=12*nside**2))])
+        self.children, self.offsets = children, offsets
+
+    def __repr__(self):
+        return '%s.%s: nside %d -> %d' % (self.__module__, self.__class__.__name__, self.nside, self.subnside)
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self, index):
+        return self.children[self.offsets[index]:self.offsets[index+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def parent(self):
+        """ return the array of parent pixels for all the subnside pixels"""
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))[np.argsort(self.children)]
+
+    def filenames(self, path):
+        base = os.path.join(path, 'index_table_%02d_%04d' % (self.nside, self.subnside))
+        return base+'_children.npy', base+'_offsets.npy'
+
+    def save(self, path):
+        """ save the arrays in the folder path, if possible; return True if successful"""
+        try:
+            if not os.path.exists(path): os.makedirs(path)
+            for filename, a in zip(self.filenames(path), (self.children, self.offsets)):
+                tmp = filename+'.%d.npy' % os.getpid()
+                np.save(tmp, a)
+                os.rename(tmp, filename)
+        except (OSError, IOError):
+            return False
+        return True
+
+    @classmethod
+    def load(cls, nside, subnside, path):
+        """ return a memory-mapped table from the folder path, or None if not there"""
+        t = cls.__new__(cls)
+        t.nside, t.subnside = nside, subnside
+        files = t.filenames(path)
+        if not all(os.path.exists(f) for f in files): return None
+        t.children, t.offsets = [np.load(f, mmap_mode='r') for f in files]
+        return t
+
+
+def index_table(nside=12, subnside=512, usefile=True):
+    """ return an IndexTable for (nside, subnside), from memory, the file cache, or created
+    usefile : bool
+        if True, look for, or save to, the file cache in folder
+    """
+    key = (nside, subnside)
+    if key in _tables: return _tables[key]
+    path = os.path.expandvars(folder)
+    usefile = usefile and '$' not in path # environment variable not defined
+    table = IndexTable.load(nside, subnside, path) if usefile else None
+    if table is None:
+        table = IndexTable(nside, subnside)
+        if usefile: table.save(path)
+    _tables[key] = table
+    return table
+
+make_index_table = index_table
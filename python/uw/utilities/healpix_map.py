@@ -21,6 +21,7 @@ from skymaps import Band, SkyDir, Hep3Vector, PySkyFunction, SkyImage, Healpix
 import skymaps
 from pointlike import IntVector
 from . import image
+from .healpix_index import make_index_table
 
 class HParray(object):
     """ base class, implement a HEALPix array, provide AIT plot
@@ -273,21 +274,6 @@ class HPGaussSmooth(HParray):
         """
         return np.asarray([self(self.dirfun(i)) for i in range(len(self.vec))], type)     
         
-def make_index_table(nside=12, subnside=512, usefile=True):
-    """create, and/or use a table to convert between different nside pixelizations
-    """
-    filename = os.path.expandvars('$FERMI/misc/index_table_%02d_%03d.pickle' % (nside, subnside) )
-    if os.path.exists(filename) and usefile:
-        return pickle.load(open(filename))
-    print ('generating index table for nside, subnside= %d %d' % (nside, subnside))
-    band, subband = Band(nside), Band(subnside)
-    npix, nsubpix = 12*nside**2, 12*subnside**2
-    t=np.array([band.index(subband.dir(i)) for i in range(nsubpix)])
-    a = np.arange(nsubpix)
-    index_table = [a[t==i] for i in range(npix)]
-    if usefile:
-        pickle.dump(index_table, open(filename,'w'))
-    return index_table
     
 def gaussian_mask(center, sigma, nside):
     """Return a HEALPix array 
@@ -343,8 +329,7 @@ class HPtables(HParray):
         index_table = make_index_table(roi_nside, nside)
         for index, pk in zip(i12,pklist):
             indeces = index_table[index]
-            for i,v in enumerate(pk):
-                self.vec[indeces[i]] = tmap(v) 
+            self.vec[indeces[:len(pk)]] = [tmap(v) for v in pk]
         bad = sum(self.vec==fill)
         if bad>0: print ('WARNING: %d pixels not filled in table %s' % (bad, tname))
         else:
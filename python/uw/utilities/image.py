@@ -633,11 +633,22 @@ class ZEA(object):
         """ is the direction sdir inside the boundary """
         x,y =self.pixel(sdir)
         return x> 0 and y>0 and x<self.nx and  y<self.ny
-    def fill(self, skyfun):
+    def fill(self, skyfun, grid=None):
         """ fill the image from a SkyFunction
             sets self.image with numpy array appropriate for imshow
+            grid : function | None
+                if set, a function of a list of SkyDirs that returns the array of values. 
+                It is called once with the directions of all pixels, instead of skyfun for each.
         """
-        if skyfun.__class__.__name__ !='PySkyFunction':
+        if grid is not None:
+            dirs = []
+            def collect(v):
+                dirs.append(SkyDir(Hep3Vector(v[0],v[1],v[2])))
+                return 0
+            self.skyimage.fill(PySkyFunction(collect))
+            values = iter(np.asarray(grid(dirs), float))
+            self.skyimage.fill(PySkyFunction(lambda v: next(values)))
+        elif skyfun.__class__.__name__ !='PySkyFunction':
             def pyskyfun(v):
                 return skyfun(SkyDir(Hep3Vector(v[0],v[1],v[2])))
             self.skyimage.fill(PySkyFunction(pyskyfun))
@@ -962,11 +973,13 @@ class TSplot(object):
         *fitsfile*[''] 
         *galmap* [True] overplot a little map in galactic coordinates showing the position
         *scalebar" [True] overplot a scalebar in lower left
+        *grid*   [None] function of a list of SkyDirs returning the tsmap values, used to fill the image
         **kwargs  additional args for ZEA, like galactic
         """
         self.__dict__.update(TSplot.defaults) 
         for key in self.__dict__.keys():
             if key in kwargs: self.__dict__[key] = kwargs.pop(key)
+        grid = kwargs.pop('grid', None)
         self.tsmap = tsmap
         self.size=size
         if self.pixelsize is None: self.pixelsize=size/10.
@@ -976,7 +989,7 @@ class TSplot(object):
                 nticks=self.nticks,fitsfile=self.fitsfile, **kwargs)
         print ('TSplot: filling %d pixels (size=%.2f, npix=%d)...'%( (size/self.pixelsize)**2, size, npix))
         sys.stdout.flush()
-        self.zea.fill(tsmap)
+        self.zea.fill(tsmap, grid=grid)
         # create new image that is the significance in sigma with respect to local max
         self.tsmaxpos=tsmaxpos = find_local_maximum(tsmap, center) # get local maximum, then check that is in the image
         x,y = self.zea.pixel(tsmaxpos)
@@ -0,0 +1,81 @@
+"""
+Tests of HankelConvolution: run with python -m unittest uw.utilities.test_convolution
+"""
+import unittest
+import numpy as np
+from uw.utilities.convolution import HankelConvolution
+from uw.like.SpatialModels import Gaussian, Disk
+
+def gaussian(r, sigma):
+    """ normalized 2-d gaussian density, r and sigma in radians """
+    return np.exp(-0.5*(r/sigma)**2)/(2*np.pi*sigma**2)
+
+class Tabulated(object):
+    """ wrap a spatial model to hide its closed-form transform, so that the profile is tabulated """
+    def __init__(self, model):
+        self.model = model
+    def hankel_transform(self, k):
+        return None
+    def at_r(self, r):
+        return self.model.at_r(r)
+
+
+class TestHankelConvolution(unittest.TestCase):
+
+    def convolution(self, psf_sigma, model):
+        """ HankelConvolution for a gaussian PSF, sigma in degrees, with the sampling used by
+        like2.response.ExtendedResponse for a 20 degree grid """
+        p = np.radians(psf_sigma)
+        rmax, npoints = HankelConvolution.sampling(min(p, np.radians(model.r68())), np.radians(20),
+            rmin=np.radians(model.effective_edge()+10*psf_sigma))
+        return HankelConvolution(lambda r: gaussian(r, p), rmax, npoints)
+
+    def check_gaussians(self, psf_sigma, source_sigma, tol):
+        """ gaussian source and PSF, against the closed form """
+        model = Gaussian(sigma=source_sigma)
+        hc = self.convolution(psf_sigma, model)
+        total = np.radians(np.hypot(psf_sigma, source_sigma))
+        r = np.linspace(0, 3*total, 50)
+        expect = gaussian(r, total)
+        for m in (model, Tabulated(model)):
+            self.assertLess(np.abs(hc(m, r)-expect).max()/expect[0], tol)
+
+    def test_compact(self):
+        self.check_gaussians(0.02, 0.05, 1e-3)
+        self.check_gaussians(0.01, 0.02, 1e-3)
+
+    def test_degree_scale(self):
+        self.check_gaussians(1.0, 1.0, 1e-4)
+
+    def test_disk_normalization(self):
+        model = Disk(sigma=0.5)
+        hc = self.convolution(0.1, model)
+        total = 2*np.pi*np.sum(hc.r*hc.profile(model))*hc.dr
+        self.assertAlmostEqual(total, 1, delta=1e-3)
+
+    def test_sampling(self):
+        """ the step is small compared with the scale, and rmax is kept to at least rmin """
+        rmax, npoints = HankelConvolution.sampling(np.radians(0.01), np.radians(20))
+        self.assertLessEqual(rmax/npoints, np.radians(0.01)/20)
+        rmax, npoints = HankelConvolution.sampling(np.radians(0.01), np.radians(20), rmin=np.radians(5))
+        self.assertAlmostEqual(rmax, np.radians(5))
+        self.assertEqual(HankelConvolution.sampling(np.radians(1), np.radians(20)), (np.radians(20), 1024))
+
+    def test_tables(self):
+        """ only the max_tables most recently used Bessel matrices are kept """
+        tables = HankelConvolution.bessel_tables
+        saved = tables.copy()
+        tables.clear()
+        try:
+            t16 = HankelConvolution.tables(16)
+            HankelConvolution.tables(32)
+            self.assertTrue(HankelConvolution.tables(16) is t16)
+            HankelConvolution.tables(64)
+            self.assertEqual(list(tables.keys()), [16, 64])
+        finally:
+            tables.clear()
+            tables.update(saved)
+
+
+if __name__=='__main__':
+    unittest.main()
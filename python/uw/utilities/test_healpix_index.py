@@ -0,0 +1,64 @@
+"""
+Tests of the HEALPix index tables: run with python -m unittest uw.utilities.test_healpix_index
+"""
+import shutil, tempfile, unittest
+import numpy as np
+import healpy
+from uw.utilities import healpix_index
+
+def center_parents(nside, subnside):
+    """ the nside pixel containing the center of each subnside pixel, as Band(nside).index(subband.dir(i)) """
+    theta, phi = healpy.pix2ang(subnside, np.arange(12*subnside**2))
+    return healpy.ang2pix(nside, theta, phi)
+
+
+class TestIndexTable(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = healpix_index.folder, dict(healpix_index._tables)
+        healpix_index.folder = self.folder
+        healpix_index._tables.clear()
+
+    def tearDown(self):
+        healpix_index.folder = self.saved[0]
+        healpix_index._tables.clear()
+        healpix_index._tables.update(self.saved[1])
+        shutil.rmtree(self.folder)
+
+    def check(self, nside, subnside):
+        """ same as the per-pixel lists of the old make_index_table """
+        table = healpix_index.IndexTable(nside, subnside)
+        parent = center_parents(nside, subnside)
+        pixels = np.arange(len(parent))
+        self.assertEqual(len(table), 12*nside**2)
+        for i, children in enumerate(table):
+            self.assertTrue(np.array_equal(children, pixels[parent==i]), 'pixel %d' % i)
+        self.assertTrue(np.array_equal(table.parent(), parent))
+
+    def test_nest_shift(self):
+        """ powers of 2, using the NEST hierarchy """
+        self.check(8, 64)
+        self.check(4, 16)
+
+    def test_centers(self):
+        """ nside=12 is not a power of 2 """
+        self.check(12, 64)
+
+    def test_parents(self):
+        self.assertTrue(np.array_equal(healpix_index.parents(16, 128), center_parents(16, 128)))
+
+    def test_cache(self):
+        """ the table is saved, then memory-mapped from the file once the memory cache is cleared """
+        table = healpix_index.index_table(12, 32)
+        self.assertTrue(healpix_index.index_table(12, 32) is table)
+        healpix_index._tables.clear()
+        loaded = healpix_index.index_table(12, 32)
+        self.assertTrue(isinstance(loaded.children, np.memmap))
+        self.assertTrue(np.array_equal(loaded.children, table.children))
+        self.assertTrue(np.array_equal(loaded.offsets, table.offsets))
+        self.assertTrue(healpix_index.IndexTable.load(12, 64, self.folder) is None)
+
+
+if __name__=='__main__':
+    unittest.main()